@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django import forms
+from django.conf import settings
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.utils.translation import ugettext_lazy as _
@@ -73,6 +74,13 @@ class MyUserAdmin(UserAdmin):
         (_('Important dates'), {'fields': ('last_login', )}),
     )
 
+    def get_readonly_fields(self, request, obj=None):
+        readonly_fields = super(MyUserAdmin, self).get_readonly_fields(request, obj)
+        if settings.TRADE_EXECUTION_MODE == 'redis':
+            # Redis holds the cash of loaded users, top up with UserProfile.topup_cash instead
+            readonly_fields = tuple(readonly_fields) + ('total_cash', 'total_given_cash')
+        return readonly_fields
+
     add_fieldsets = (
         (None, {'fields': ('username', 'password1', 'password2', 'email'), 'classes': ('wide',)}),
         (None, {'fields': ('name',)}),
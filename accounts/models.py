@@ -3,6 +3,7 @@ import datetime
 import logging
 import urllib2
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, User
 from django.core.files.base import ContentFile
 from django.db import models, transaction
@@ -10,6 +11,7 @@ from django.db.models import F, Q
 from django.core.urlresolvers import reverse
 from politikon.settings import STATIC_URL
 
+from bladepolska.redis_connection import RedisConnection
 from bladepolska.snapshots import SnapshotAddon
 from constance import config
 
@@ -21,6 +23,8 @@ from events.models import Bet, Event
 
 logger = logging.getLogger(__name__)
 
+FRIENDS_KEY = 'friends:%d'
+
 
 class UserProfile(AbstractBaseUser):
 
@@ -106,6 +110,10 @@ class UserProfile(AbstractBaseUser):
             second_way_qs = Q(to_user=self, from_user__in=stale_friends_ids)
             friends_manager.filter(first_way_qs | second_way_qs).delete()
 
+        if new_friends_ids or stale_friends_ids:
+            changed_ids = [self.id] + new_friends_ids + stale_friends_ids
+            RedisConnection.redis().delete(*[FRIENDS_KEY % user_id for user_id in changed_ids])
+
     @property
     def statistics_dict(self):
         return {
@@ -132,6 +140,21 @@ class UserProfile(AbstractBaseUser):
 
         return current_friends_ids_set
 
+    def friends_key(self):
+        """
+        The key of a Redis set of friends_ids_set, cached for FRIENDS_CACHE_TIMEOUT seconds
+        or until synchronize_facebook_friends changes it. It always holds 0, so that it
+        exists for users without friends too.
+        """
+        key = FRIENDS_KEY % self.id
+        if not RedisConnection.redis().exists(key):
+            with RedisConnection.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.sadd(key, 0, *self.friends_ids_set)
+                pipe.expire(key, settings.FRIENDS_CACHE_TIMEOUT)
+                pipe.execute()
+        return key
+
 
     def get_full_name(self):
         return "%s (%s)" % (self.name, self.username)
@@ -186,6 +209,12 @@ class UserProfile(AbstractBaseUser):
             return self.facebook_user.profile_photo
 
     def topup_cash(self, amount):
+        if settings.TRADE_EXECUTION_MODE == 'redis':
+            # cash lives in Redis, the flush writes the top up and its Transaction
+            from events.redis_market import market
+            market.credit_user_cash(self.id, amount)
+            return
+
         self.total_cash = F('total_cash') + amount
         self.total_given_cash = F('total_given_cash') + amount
 
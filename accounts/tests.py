@@ -1,3 +1,33 @@
 from django.test import TestCase
 
-# Create your tests here.
+from bladepolska.tokens import make_api_token, user_from_api_token
+from .models import UserProfile
+
+
+class ApiTokenTests(TestCase):
+    """ Tokens for the X-Api-Token header, bladepolska.tokens. """
+
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('token', 'token@example.com', 'password')
+
+    def test_token_authenticates_its_user(self):
+        self.assertEqual(user_from_api_token(make_api_token(self.user)), self.user)
+
+    def test_token_of_an_inactive_user_is_rejected(self):
+        token = make_api_token(self.user)
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(user_from_api_token(token))
+
+    def test_new_password_revokes_tokens(self):
+        token = make_api_token(self.user)
+        self.user.set_password('another password')
+        self.user.save()
+
+        self.assertIsNone(user_from_api_token(token))
+        self.assertEqual(user_from_api_token(make_api_token(self.user)), self.user)
+
+    def test_forged_token_is_rejected(self):
+        self.assertIsNone(user_from_api_token(make_api_token(self.user) + 'x'))
+        self.assertIsNone(user_from_api_token(''))
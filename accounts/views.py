@@ -1,8 +1,16 @@
+import json
+
+from django.conf import settings
 from django.http import HttpResponsePermanentRedirect
 from django.contrib.auth import logout as auth_logout
+from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse_lazy
+from django.views.decorators.http import require_http_methods
 from django.views.generic import RedirectView, ListView, DetailView
 
+from bladepolska.http import JSONResponse
+from bladepolska.tokens import make_api_token
+
 from models import UserProfile
 
 
@@ -31,3 +39,15 @@ class UserDetailView(DetailView):
         user_detail = super(UserDetailView, self).get_object(**kwargs)
 #        user_detail.bets.all()
         return user_detail
+
+
+@login_required
+@require_http_methods(["POST"])
+def api_token(request):
+    """
+    Issues a token for the X-Api-Token header of /api/ requests
+    """
+    return JSONResponse(json.dumps({
+        'token': make_api_token(request.user),
+        'expires_in': settings.API_TOKEN_MAX_AGE,
+    }))
@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+
+import redis
+from constance.backends.database import DatabaseBackend
+from django.conf import settings
+
+from .redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+INVALIDATION_CHANNEL = 'constance:invalidate'
+
+
+class CachedDatabaseBackend(DatabaseBackend):
+    """
+    DatabaseBackend keeping all values in process memory. They are read with a single
+    query and reloaded after CONSTANCE_CACHE_TIMEOUT seconds, or as soon as any process
+    changes a value: set() announces it on Redis pub/sub and every process listens for
+    that in a daemon thread, started lazily so that it runs in forked workers too.
+    """
+
+    def __init__(self):
+        super(CachedDatabaseBackend, self).__init__()
+        self._values = {}
+        self._loaded_at = 0
+        self._listener_pid = None
+
+    def _current_values(self):
+        if time.time() - self._loaded_at <= settings.CONSTANCE_CACHE_TIMEOUT:
+            return self._values
+
+        self._ensure_listening()
+        # taken before the query, so that an invalidation during it is not lost
+        self._loaded_at = time.time()
+        self._values = dict(super(CachedDatabaseBackend, self).mget(settings.CONSTANCE_CONFIG.keys()))
+        return self._values
+
+    def invalidate(self):
+        self._loaded_at = 0
+
+    def get(self, key):
+        return self._current_values().get(key)
+
+    def mget(self, keys):
+        values = self._current_values()
+        for key in keys:
+            if key in values:
+                yield key, values[key]
+
+    def set(self, key, value):
+        super(CachedDatabaseBackend, self).set(key, value)
+        self.invalidate()
+        try:
+            RedisConnection.redis().publish(INVALIDATION_CHANNEL, key)
+        except redis.RedisError:
+            logger.warning("Could not announce the change of config.%s, other processes see it within %ss" % (
+                key, settings.CONSTANCE_CACHE_TIMEOUT))
+
+    def _ensure_listening(self):
+        if self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+
+        listener = threading.Thread(target=self._listen, name='constance-invalidation')
+        listener.daemon = True
+        listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = RedisConnection.blocking_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # values loaded while the subscription was down may have missed a change
+                self.invalidate()
+                for message in pubsub.listen():
+                    self.invalidate()
+            except redis.RedisError:
+                logger.warning("Lost the config invalidation subscription, reconnecting")
+                time.sleep(5)
@@ -3,3 +3,11 @@ from django.conf import settings as app_settings
 
 def settings(request):
     return {'settings': app_settings}
+
+
+def realtime(request):
+    """ Where browsers subscribe to realtime channels, see bladepolska.realtime. """
+    return {
+        'REALTIME_SSE_URL': app_settings.REALTIME_SSE_URL,
+        'PUBNUB_SUBSCRIBE_KEY': getattr(app_settings, 'PUBNUB_SUBSCRIBE_KEY', ''),
+    }
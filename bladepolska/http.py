@@ -28,6 +28,10 @@ class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
 
+class HttpResponseUnprocessableEntity(HttpResponse):
+    status_code = 422
+
+
 class HttpResponseNotImplemented(HttpResponse):
     status_code = 501
 
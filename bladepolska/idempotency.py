@@ -0,0 +1,92 @@
+import hashlib
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from .http import HttpResponseServiceUnavailable, HttpResponseUnprocessableEntity
+from .redis_connection import RedisConnection
+
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+RESPONSE_KEY = 'idempotency:response:%s'
+IN_FLIGHT_KEY = 'idempotency:in_flight:%s'
+POLL_INTERVAL = 0.05
+
+
+def _request_key(request, key):
+    user_id = request.user.pk if request.user.is_authenticated() else None
+    return hashlib.sha1('%s:%s:%s' % (user_id, request.path, key)).hexdigest()
+
+
+def _body_hash(request):
+    return hashlib.sha1(request.body).hexdigest()
+
+
+def _load_response(stored, body_hash):
+    stored = json.loads(stored)
+    if stored.get('body_hash', body_hash) != body_hash:
+        return _key_reused()
+    return HttpResponse(stored['content'], status=stored['status'], content_type=stored['content_type'])
+
+
+def _key_reused():
+    return HttpResponseUnprocessableEntity("Idempotency-Key was already used for another request.")
+
+
+def _store_response(r, request_key, body_hash, response):
+    r.set(RESPONSE_KEY % request_key, json.dumps({
+        'body_hash': body_hash,
+        'status': response.status_code,
+        'content_type': response['Content-Type'],
+        'content': response.content,
+    }), ex=settings.IDEMPOTENCY_KEY_TIMEOUT)
+
+
+def idempotent(view):
+    """
+    Makes a view safe to retry with an Idempotency-Key header. The first response for
+    a key (per user and path) is kept in Redis for IDEMPOTENCY_KEY_TIMEOUT seconds and
+    repeats get it back without calling the view. A repeat that comes while the first
+    request is still running waits for its response instead of racing it. A request
+    reusing a key with another body gets 422 Unprocessable Entity.
+    Server errors are not kept, so those can be retried for real.
+    Requests without the header are passed through untouched.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+
+        request_key = _request_key(request, key)
+        body_hash = _body_hash(request)
+        r = RedisConnection.redis()
+
+        deadline = time.time() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            stored = r.get(RESPONSE_KEY % request_key)
+            if stored is not None:
+                return _load_response(stored, body_hash)
+
+            if r.set(IN_FLIGHT_KEY % request_key, body_hash, nx=True, ex=settings.IDEMPOTENCY_IN_FLIGHT_TIMEOUT):
+                break
+            if r.get(IN_FLIGHT_KEY % request_key) not in (None, body_hash):
+                return _key_reused()
+
+            if time.time() > deadline:
+                return HttpResponseServiceUnavailable()
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            response = view(request, *args, **kwargs)
+            if response.status_code < 500 and not response.streaming:
+                _store_response(r, request_key, body_hash, response)
+        finally:
+            r.delete(IN_FLIGHT_KEY % request_key)
+
+        return response
+
+    return wrapper
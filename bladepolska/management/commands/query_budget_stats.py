@@ -0,0 +1,33 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from bladepolska.query_budget import STATS_KEY
+from bladepolska.redis_connection import RedisConnection
+
+
+class Command(BaseCommand):
+    help = "Shows the average queries, duplicate queries and database time of views with a query budget."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        r = RedisConnection.redis()
+
+        views = defaultdict(dict)
+        for field, value in r.hgetall(STATS_KEY).items():
+            view, _, name = field.rpartition(':')
+            views[view][name] = value
+
+        for view, stats in sorted(views.items()):
+            requests = float(stats.get('requests', 0)) or 1
+            self.stdout.write("%-48s %8s requests  %6.1f queries  %5.1f duplicates  %7.1fms in db  budget %s" % (
+                view, stats.get('requests', 0),
+                int(stats.get('queries', 0)) / requests,
+                int(stats.get('duplicates', 0)) / requests,
+                1000 * float(stats.get('time', 0)) / requests,
+                stats.get('budget')))
+
+        if options['reset']:
+            r.delete(STATS_KEY)
@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bladepolska.redis_connection import RedisConnection, POOL_STATS_KEY
+
+
+class Command(BaseCommand):
+    help = "Shows the Redis connection pool stats published by running processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help="Include processes that stopped publishing, most likely gone.")
+
+    def handle(self, *args, **options):
+        r = RedisConnection.redis()
+        stale = time.time() - 2 * settings.REDIS_POOL_STATS_INTERVAL
+
+        for process, stats in sorted(r.hgetall(POOL_STATS_KEY).items()):
+            stats = dict(item.split('=', 1) for item in stats.split(','))
+            if int(stats['updated']) < stale and not options['all']:
+                continue
+
+            self.stdout.write("%-32s in use %3s/%-3s  created %5s  waits %6s  blocking in use %3s/%-3s" % (
+                process, stats['in_use'], stats['max_connections'], stats['created'], stats['waits'],
+                stats.get('blocking_in_use', 0), stats.get('blocking_max_connections', '-')))
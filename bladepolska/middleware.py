@@ -22,13 +22,21 @@
 
 import cProfile
 from datetime import datetime
-from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.middleware import AuthenticationMiddleware, SessionAuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.messages.middleware import MessageMiddleware
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.middleware.csrf import CsrfViewMiddleware
 import os
+import random
 import StringIO
 
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+from .profiling import Profiler
+from .tokens import user_from_api_token
+
 isAPIRequest = lambda request: request.path_info[0:5] == '/api/'
 
 
@@ -54,6 +62,25 @@ class AuthenticationMiddlewareOmitApi(AuthenticationMiddleware):
         super(AuthenticationMiddlewareOmitApi, self).process_request(request)
 
 
+class SessionAuthenticationMiddlewareOmitApi(SessionAuthenticationMiddleware):
+    def process_request(self, request):
+        if isAPIRequest(request):
+            return
+        super(SessionAuthenticationMiddlewareOmitApi, self).process_request(request)
+
+
+class TokenAuthenticationMiddleware(object):
+    """
+    Authenticates /api/ requests with the signed token of bladepolska.tokens sent in the
+    X-Api-Token header. Checking it needs no session, only the user's row.
+    """
+    def process_request(self, request):
+        if not isAPIRequest(request):
+            return
+
+        request.user = user_from_api_token(request.META.get('HTTP_X_API_TOKEN', '')) or AnonymousUser()
+
+
 class MessageMiddlewareOmitApi(MessageMiddleware):
     def process_request(self, request):
         if isAPIRequest(request):
@@ -79,9 +106,34 @@ class CsrfViewMiddlewareOmitApi(CsrfViewMiddleware):
 
 
 # Instrumentation
+class SamplingProfilerMiddleware(object):
+    """
+    Samples the stack of PROFILER_SAMPLE_RATE of requests, and of every request sent with
+    an X-Profile header carrying PROFILER_SECRET, with bladepolska.profiling.Profiler.
+    It runs before authentication, so the header is checked against the secret instead
+    of the user. Unsampled requests pay for one random number. The stacks are served by
+    politikon.views.profiler_stacks.
+    """
+    def process_request(self, request):
+        if self.profiling_requested(request) or random.random() < settings.PROFILER_SAMPLE_RATE:
+            request.profiled = True
+            Profiler.start()
+
+    def process_response(self, request, response):
+        if getattr(request, 'profiled', False):
+            Profiler.stop()
+            Profiler.flush()
+        return response
+
+    def profiling_requested(self, request):
+        header = request.META.get('HTTP_X_PROFILE')
+        return bool(header and settings.PROFILER_SECRET and constant_time_compare(header, settings.PROFILER_SECRET))
+
+
 class InstrumentMiddleware(object):
+    """ Full cProfile and SQL dump to stderr of requests with a profile parameter, for development only. """
     def process_request(self, request):
-        if 'profile' in request.REQUEST or 1:
+        if 'profile' in request.REQUEST:
             request.profiler = cProfile.Profile()
             request.profiler.enable()
 
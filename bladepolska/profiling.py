@@ -0,0 +1,121 @@
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import redis
+from django.conf import settings
+
+from .redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+STACKS_KEY = 'profiler:stacks'
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '%s:%s' % (frame.f_globals.get('__name__', os.path.basename(code.co_filename)), code.co_name)
+
+
+def collapse(frame):
+    """ The stack of frame in collapsed-stack format, outermost call first. """
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of threads that registered with start() every PROFILER_INTERVAL
+    seconds, from one daemon thread per process that only wakes up while any are
+    registered. Stacks are counted in memory and added to a Redis hash by flush(), so
+    that the stacks of all processes can be read in one place.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.active = threading.Event()
+        self.stacks = defaultdict(int)
+        self.flushed_at = time.time()
+        self.sampler_pid = None
+
+    def start(self):
+        self._ensure_sampling()
+        with self.lock:
+            self.threads.add(threading.current_thread().ident)
+            self.active.set()
+
+    def stop(self):
+        with self.lock:
+            self.threads.discard(threading.current_thread().ident)
+            if not self.threads:
+                self.active.clear()
+
+    def _ensure_sampling(self):
+        if self.sampler_pid == os.getpid():
+            return
+        with self.lock:
+            if self.sampler_pid == os.getpid():
+                return
+            self.sampler_pid = os.getpid()
+            # a forked child inherits the parent's registrations and counts, not its thread
+            self.threads = set()
+            self.stacks = defaultdict(int)
+
+        sampler = threading.Thread(target=self._sample, name='sampling-profiler')
+        sampler.daemon = True
+        sampler.start()
+
+    def _sample(self):
+        while True:
+            self.active.wait()
+            time.sleep(settings.PROFILER_INTERVAL)
+            with self.lock:
+                threads = list(self.threads)
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = collapse(frame)
+                    with self.lock:
+                        self.stacks[stack] += 1
+
+    def flush(self, force=False):
+        """ Adds the stacks counted since the last flush to Redis, at most every PROFILER_FLUSH_INTERVAL. """
+        now = time.time()
+        if not force and now - self.flushed_at < settings.PROFILER_FLUSH_INTERVAL:
+            return
+        with self.lock:
+            stacks, self.stacks = self.stacks, defaultdict(int)
+            self.flushed_at = now
+        if not stacks:
+            return
+
+        try:
+            with RedisConnection.pipeline() as pipe:
+                for stack, count in stacks.iteritems():
+                    pipe.hincrby(STACKS_KEY, stack, count)
+                pipe.execute()
+        except redis.RedisError:
+            logger.warning("Could not save %d profiled stacks" % len(stacks))
+
+
+Profiler = SamplingProfiler()
+
+
+def collapsed_stacks():
+    """ All saved stacks as 'frame;frame;frame count' lines, the input of flamegraph.pl. """
+    stacks = RedisConnection.redis().hgetall(STACKS_KEY)
+    return ''.join('%s %s\n' % item for item in sorted(stacks.items()))
+
+
+def reset_stacks():
+    RedisConnection.redis().delete(STACKS_KEY)
@@ -1,12 +1,191 @@
 from django.conf import settings
 
 from vendor import Pubnub as pubnub_api
-from threading import local
+from threading import local, BoundedSemaphore
+from Queue import LifoQueue, Empty
+import httplib
+import json
+import socket
+import ssl
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _PipelinedResponses(object):
+    """
+    One buffered reader for all responses of a pipeline, handed to each httplib.HTTPResponse
+    in place of the socket. Responses must not close it, the connection is kept alive.
+    """
+
+    def __init__(self, sock):
+        self.fp = sock.makefile('rb')
+
+    def makefile(self, *args, **kwargs):
+        return self
+
+    def readline(self, *args):
+        return self.fp.readline(*args)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def close(self):
+        pass
+
+
+class HTTPConnectionPool(object):
+    """
+    Keep-alive connections to a single host, shared by all threads of the process.
+    At most `size` connections are open at once. Requests are sent pipelined: a whole
+    batch is written to one connection before the responses are read back in order.
+    """
+
+    def __init__(self, host, port=None, use_ssl=False, size=4, connect_timeout=2., read_timeout=5.,
+                 pipeline_depth=50):
+        self.host = host
+        self.port = port or (443 if use_ssl else 80)
+        self.use_ssl = use_ssl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pipeline_depth = pipeline_depth
+        # verifies the certificate and its hostname against the system's CAs
+        self.ssl_context = ssl.create_default_context() if use_ssl else None
+
+        self.idle = LifoQueue()
+        self.slots = BoundedSemaphore(size)
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.use_ssl:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+        sock.settimeout(self.read_timeout)
+        return sock
+
+    def request_many(self, paths):
+        """ GETs every path and returns the JSON decoded responses, None for each one that failed. """
+        results = []
+        for start in range(0, len(paths), self.pipeline_depth):
+            results.extend(self._pipeline(paths[start:start + self.pipeline_depth]))
+        return results
+
+    def _pipeline(self, paths):
+        self.slots.acquire()
+        try:
+            try:
+                sock, reused = self.idle.get_nowait(), True
+            except Empty:
+                sock, reused = None, False
+
+            while True:
+                try:
+                    if sock is None:
+                        sock = self.connect()
+                    results, keep_alive = self._send(sock, paths)
+                except (socket.error, httplib.HTTPException) as e:
+                    self._close(sock)
+                    sock = None
+                    if reused:
+                        # the server may have dropped an idle connection, try once on a fresh one
+                        reused = False
+                        continue
+                    logger.warning("Request to %s failed: %s" % (self.host, e))
+                    return [None] * len(paths)
+                break
+
+            if keep_alive:
+                self.idle.put(sock)
+            else:
+                self._close(sock)
+            return results
+        finally:
+            self.slots.release()
+
+    def _send(self, sock, paths):
+        sock.sendall(''.join(
+            'GET %s HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n' % (path, self.host) for path in paths
+        ))
+
+        responses = _PipelinedResponses(sock)
+        results = []
+        for path in paths:
+            response = httplib.HTTPResponse(responses, method='GET')
+            response.begin()
+            body = response.read()
+            try:
+                results.append(json.loads(body) if response.status == 200 else None)
+            except ValueError:
+                results.append(None)
+            if response.will_close:
+                return results + [None] * (len(paths) - len(results)), False
+
+        return results, True
+
+    def _close(self, sock):
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+
+class PooledPubnub(pubnub_api.Pubnub):
+    """ The vendor client sending its requests through an HTTPConnectionPool instead of urllib2. """
+
+    _collected = None
+
+    def __init__(self, pool, *args, **kwargs):
+        pubnub_api.Pubnub.__init__(self, *args, **kwargs)
+        self.pool = pool
+
+    def _request(self, request, origin=None, encode=True, params=None):
+        path = '/' + '/'.join(encode and self._encode(request) or request)
+        if params:
+            path = path + '?' + '&'.join(params)
+
+        if self._collected is not None:
+            self._collected.append(path)
+            return len(self._collected)
+
+        return self.pool.request_many([path])[0]
+
+    def publish_many(self, messages):
+        """ publish() for each of `messages`, all sent in one pipeline. """
+        self._collected = []
+        try:
+            infos = [pubnub_api.Pubnub.publish(self, args) for args in messages]
+            paths = self._collected
+        finally:
+            self._collected = None
+
+        responses = self.pool.request_many(paths)
+        results = []
+        for info in infos:
+            # publish() returns what _request returned, i.e. the position of its path,
+            # or an error list for messages it did not even try to send
+            if isinstance(info, int):
+                info = responses[info - 1] or [0, "Not Sent", "0"]
+            results.append(info)
+        return results
 
 
 class _PubNub(object):
     def __init__(self):
         self.local_storage = local()
+        self.pool = None
+
+    def get_pool(self):
+        if self.pool is None:
+            host, _, port = settings.PUBNUB_ORIGIN.partition(':')
+            self.pool = HTTPConnectionPool(
+                host, int(port) if port else None, settings.PUBNUB_IS_SSL,
+                size=settings.PUBNUB_POOL_SIZE,
+                connect_timeout=settings.PUBNUB_CONNECT_TIMEOUT,
+                read_timeout=settings.PUBNUB_READ_TIMEOUT,
+                pipeline_depth=settings.PUBNUB_PIPELINE_DEPTH,
+            )
+        return self.pool
 
     def __call__(self):
         if not hasattr(self.local_storage, 'Pubnub'):
@@ -15,8 +194,9 @@ class _PubNub(object):
                 settings.PUBNUB_SUBSCRIBE_KEY,
                 settings.PUBNUB_SECRET_KEY,
                 settings.PUBNUB_IS_SSL,
+                settings.PUBNUB_ORIGIN,
             )
-            self.local_storage.Pubnub = pubnub_api.Pubnub(*pubnub_args)
+            self.local_storage.Pubnub = PooledPubnub(self.get_pool(), *pubnub_args)
 
         return self.local_storage.Pubnub
 
@@ -0,0 +1,143 @@
+import re
+import time
+from collections import defaultdict
+from functools import wraps
+
+import redis
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+from .redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+STATS_KEY = 'query_budget:stats'
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def query_shape(sql):
+    """ sql with its literals replaced, the same for each run of an N+1 query. """
+    return _literals.sub('?', sql)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats(CaptureQueriesContext):
+    """ Records the queries run on a database connection inside the with block, even with DEBUG off. """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        super(QueryStats, self).__init__(connections[using])
+
+    @property
+    def queries(self):
+        return self.captured_queries
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(float(query['time']) for query in self.queries)
+
+    def repeated(self):
+        """ {query shape: times run} for the shapes run more than once. """
+        shapes = defaultdict(int)
+        for query in self.queries:
+            shapes[query_shape(query['sql'])] += 1
+        return dict((shape, count) for shape, count in shapes.items() if count > 1)
+
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.repeated().values())
+
+
+class QueryBudget(object):
+    def __init__(self, name, queries=None, duplicates=None):
+        self.name = name
+        self.queries = queries
+        self.duplicates = duplicates
+
+    def violations(self, stats):
+        violations = []
+        if self.queries is not None and stats.count > self.queries:
+            violations.append("%d queries, budget %d" % (stats.count, self.queries))
+        if self.duplicates is not None and stats.duplicates > self.duplicates:
+            violations.append("%d duplicate queries, budget %d: %s" % (
+                stats.duplicates, self.duplicates,
+                '; '.join('%dx %s' % (count, shape) for shape, count in stats.repeated().items())))
+        return violations
+
+    def check(self, stats):
+        """ Logs, or raises QueryBudgetExceeded with QUERY_BUDGET_RAISE, if stats are over the budget. """
+        violations = self.violations(stats)
+        if not violations:
+            return
+        message = "%s over its query budget: %s" % (self.name, ', '.join(violations))
+        if settings.QUERY_BUDGET_RAISE:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    def record(self, stats):
+        """ Adds the request to the per view totals shown by manage.py query_budget_stats. """
+        try:
+            with RedisConnection.pipeline() as pipe:
+                pipe.hincrby(STATS_KEY, '%s:requests' % self.name, 1)
+                pipe.hincrby(STATS_KEY, '%s:queries' % self.name, stats.count)
+                pipe.hincrby(STATS_KEY, '%s:duplicates' % self.name, stats.duplicates)
+                pipe.hincrbyfloat(STATS_KEY, '%s:time' % self.name, stats.time)
+                pipe.hset(STATS_KEY, '%s:budget' % self.name, '%s/%s' % (self.queries, self.duplicates))
+                pipe.execute()
+        except redis.RedisError:
+            pass
+
+
+def query_budget(queries=None, duplicates=None):
+    """
+    Counts the queries of a view, template rendering included, and checks them against
+    a budget of `queries` in total and `duplicates` runs of the same query with other
+    parameters, the sign of an N+1 pattern. Decorates view functions and class based
+    views alike. The stats are set on the response as `query_stats`.
+    """
+    def decorator(view):
+        budget = QueryBudget('%s.%s' % (view.__module__, view.__name__), queries, duplicates)
+
+        def measure(call):
+            if not settings.QUERY_BUDGET_ENABLED:
+                return call()
+
+            started = time.time()
+            with QueryStats() as stats:
+                response = call()
+                if hasattr(response, 'render') and not response.is_rendered:
+                    response.render()
+            logger.debug("%s: %d queries, %d duplicates, %.3fs in the database, %.3fs overall" % (
+                budget.name, stats.count, stats.duplicates, stats.time, time.time() - started))
+
+            response.query_stats = stats
+            response.query_budget = budget
+            budget.record(stats)
+            budget.check(stats)
+            return response
+
+        if isinstance(view, type):
+            dispatch = view.dispatch
+
+            def budgeted_dispatch(self, request, *args, **kwargs):
+                return measure(lambda: dispatch(self, request, *args, **kwargs))
+
+            view.dispatch = budgeted_dispatch
+            return view
+
+        @wraps(view)
+        def budgeted_view(request, *args, **kwargs):
+            return measure(lambda: view(request, *args, **kwargs))
+
+        return budgeted_view
+    return decorator
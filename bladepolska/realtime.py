@@ -0,0 +1,77 @@
+import abc
+import json
+
+import redis
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .pubnub import PubNub
+from .redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RealtimeBackend(object):
+    """ Pushes messages to the browsers subscribed to a channel. """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def publish(self, channel, message):
+        """ Returns whether the message was handed over for delivery. """
+
+    def publish_many(self, messages):
+        """ publish() for each (channel, message) pair, returns a list of results. """
+        return [self.publish(channel, message) for channel, message in messages]
+
+
+class PubNubBackend(RealtimeBackend):
+    """ The hosted PubNub service, browsers subscribe with the PubNub JS client. """
+
+    def publish(self, channel, message):
+        info = PubNub().publish({
+            'channel': channel,
+            'message': message,
+        })
+        return bool(info and info[0] == 1)
+
+    def publish_many(self, messages):
+        infos = PubNub().publish_many([{
+            'channel': channel,
+            'message': message,
+        } for channel, message in messages])
+        return [bool(info and info[0] == 1) for info in infos]
+
+
+class RedisBackend(RealtimeBackend):
+    """
+    Self-hosted: messages go to Redis pub/sub and browsers get them through the
+    Server-Sent Events gateway in politikon.sse.
+    """
+
+    def publish(self, channel, message):
+        try:
+            RedisConnection.redis().publish(settings.REALTIME_REDIS_PREFIX + channel,
+                                            json.dumps(message, separators=(',', ':')))
+        except redis.RedisError:
+            logger.warning("Could not publish to %s" % channel)
+            return False
+        return True
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.REALTIME_BACKEND)()
+    return _backend
+
+
+def publish(channel, message):
+    return get_backend().publish(channel, message)
+
+
+def publish_many(messages):
+    return get_backend().publish_many(messages)
@@ -1,43 +1,151 @@
 from django.conf import settings
 from django.core import signals
 
+import os
 import redis
-from threading import local
+import socket
+import time
+
+
+POOL_STATS_KEY = 'redis:pool_stats'
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """
+    A BlockingConnectionPool that counts connections created, connections handed out
+    and how often a caller had to wait for one. redis-py resets the pool in a forked
+    child on first use, so a pool created before gunicorn forks (--preload) is safe.
+    """
+
+    def reset(self):
+        super(InstrumentedConnectionPool, self).reset()
+        self.created = 0
+        self.in_use = 0
+        self.waits = 0
+
+    def make_connection(self):
+        self.created += 1
+        return super(InstrumentedConnectionPool, self).make_connection()
+
+    def get_connection(self, command_name, *keys, **options):
+        self._checkpid()
+        if self.pool.empty():
+            self.waits += 1
+        connection = super(InstrumentedConnectionPool, self).get_connection(command_name, *keys, **options)
+        self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid:
+            self.in_use -= 1
+        super(InstrumentedConnectionPool, self).release(connection)
+
+    def stats(self):
+        return {
+            'max_connections': self.max_connections,
+            'created': self.created,
+            'in_use': self.in_use,
+            'waits': self.waits,
+        }
+
 
 class _RedisConnection(object):
+    """
+    One thread-safe client on one connection pool, shared by the whole process, and
+    one on a pool of its own for commands that hold their connection for long: BLPOP
+    and subscriptions would otherwise starve the short commands of the shared pool.
+    """
+
     def __init__(self, db=0):
-        self.connection = local()
+        self.r = None
+        self.blocking_r = None
         self.db = getattr(settings, 'REDIS_DB', 0)
- 
+        self.stats_published_at = 0
+
     def connect(self):
+        self.r = redis.StrictRedis(connection_pool=self.make_pool(settings.REDIS_MAX_CONNECTIONS))
+
+    def make_pool(self, max_connections):
+        pool_args = {
+            'max_connections': max_connections,
+            'timeout': settings.REDIS_POOL_TIMEOUT,
+        }
         if hasattr(settings, 'REDIS_BASE_URL') and settings.REDIS_BASE_URL is not None:
-            self.connection.r = redis.from_url(settings.REDIS_BASE_URL)
+            pool = InstrumentedConnectionPool.from_url(settings.REDIS_BASE_URL, **pool_args)
+        elif hasattr(settings, 'REDIS_PATH'):
+            pool = InstrumentedConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                              path=getattr(settings, 'REDIS_PATH'), db=self.db, **pool_args)
         else:
-            if hasattr(settings, 'REDIS_PATH'):
-                self.connection.r = redis.StrictRedis(unix_socket_path=getattr(settings, 'REDIS_PATH'), db=self.db)
-            else:
-                self.connection.r = redis.StrictRedis(host=getattr(settings, 'REDIS_HOST', 'localhost'), port=getattr(settings, 'REDIS_PORT', 6379), password=getattr(settings, 'REDIS_PASSWORD', None), db=self.db)
+            pool = InstrumentedConnectionPool(host=getattr(settings, 'REDIS_HOST', 'localhost'),
+                                              port=getattr(settings, 'REDIS_PORT', 6379),
+                                              password=getattr(settings, 'REDIS_PASSWORD', None),
+                                              db=self.db, **pool_args)
+        return pool
 
     def is_connected(self):
-        return hasattr(self.connection, 'r')
+        return self.r is not None
 
     def disconnect(self, **kwargs):
         if self.is_connected():
-            self.connection.r.connection_pool.disconnect()
+            self.r.connection_pool.disconnect()
+        if self.blocking_r is not None:
+            self.blocking_r.connection_pool.disconnect()
 
     def redis(self):
         if not self.is_connected():
             self.connect()
-        return self.connection.r
+        return self.r
 
-    def __enter__(self):
+    def blocking_redis(self):
+        """ The client for BLPOP, pub/sub and other commands that wait on the server. """
+        if self.blocking_r is None:
+            self.blocking_r = redis.StrictRedis(connection_pool=self.make_pool(settings.REDIS_BLOCKING_MAX_CONNECTIONS))
+        return self.blocking_r
+
+    def pipeline(self, transaction=False):
+        """ Batches commands into one round trip, not wrapped in MULTI unless asked to. """
+        return self.redis().pipeline(transaction=transaction)
+
+    def batch(self, commands):
+        """
+        Runs [(command, arg, ...), ...] in one round trip and returns their results,
+        e.g. batch([('hgetall', 'a'), ('hgetall', 'b')]).
+        """
+        with self.pipeline() as pipe:
+            for command in commands:
+                getattr(pipe, command[0])(*command[1:])
+            return pipe.execute()
+
+    def stats(self):
         if not self.is_connected():
-            self.connect()
-        return self.connection.r
+            return None
+        stats = self.r.connection_pool.stats()
+        if self.blocking_r is not None:
+            for name, value in self.blocking_r.connection_pool.stats().items():
+                stats['blocking_' + name] = value
+        return stats
+
+    def publish_stats(self, **kwargs):
+        """ Saves this process' pool stats for manage.py redis_pool_stats, at most every REDIS_POOL_STATS_INTERVAL. """
+        now = time.time()
+        if not self.is_connected() or now - self.stats_published_at < settings.REDIS_POOL_STATS_INTERVAL:
+            return
+        self.stats_published_at = now
+
+        stats = self.stats()
+        stats['updated'] = int(now)
+        try:
+            self.r.hset(POOL_STATS_KEY, '%s:%d' % (socket.gethostname(), os.getpid()),
+                        ','.join('%s=%s' % item for item in sorted(stats.items())))
+        except redis.RedisError:
+            pass
+
+    def __enter__(self):
+        return self.redis()
 
     def __exit__(self, type, value, traceback):
         pass
 
 RedisConnection = _RedisConnection()
 
-signals.request_finished.connect(RedisConnection.disconnect)
+signals.request_finished.connect(RedisConnection.publish_stats)
@@ -0,0 +1,105 @@
+import socket
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from unittest import SkipTest
+
+import redis
+from django.conf import settings
+from django.test.utils import override_settings
+
+from .redis_connection import RedisConnection
+
+
+REDIS_TEST_DB = 15
+
+
+class RedisTestMixin(object):
+    """
+    Points RedisConnection at database REDIS_TEST_DB of the configured Redis server,
+    emptied before each test. Tests are skipped when no Redis server is running.
+    """
+
+    def setUp(self):
+        url = urlparse.urlparse(settings.REDIS_BASE_URL)
+        self.redis_settings = override_settings(REDIS_BASE_URL='%s://%s/%d' % (url.scheme, url.netloc, REDIS_TEST_DB))
+        self.redis_settings.enable()
+        self.reconnect_redis()
+        try:
+            RedisConnection.redis().flushdb()
+        except redis.ConnectionError:
+            self.redis_settings.disable()
+            self.reconnect_redis()
+            raise SkipTest("No Redis server at %s" % settings.REDIS_BASE_URL)
+        super(RedisTestMixin, self).setUp()
+
+    def tearDown(self):
+        super(RedisTestMixin, self).tearDown()
+        self.redis_settings.disable()
+        self.reconnect_redis()
+
+    def reconnect_redis(self):
+        RedisConnection.disconnect()
+        RedisConnection.r = None
+        RedisConnection.blocking_r = None
+
+
+class QueryBudgetTestMixin(object):
+    """ For TestCases checking views decorated with bladepolska.query_budget.query_budget. """
+
+    def assertWithinQueryBudget(self, method, path, *args, **kwargs):
+        """ Requests path with self.client and fails if the view went over its query budget. """
+        with override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_RAISE=False):
+            response = getattr(self.client, method)(path, *args, **kwargs)
+
+        stats = getattr(response, 'query_stats', None)
+        self.assertIsNotNone(stats, "%s %s is not served by a view with a query budget" % (method.upper(), path))
+        self.assertEqual(response.query_budget.violations(stats), [],
+                         "%s over its query budget:\n%s" % (response.query_budget.name,
+                                                            '\n'.join(query['sql'] for query in stats.queries)))
+        return response
+
+
+class StubPubNubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request like a successful PubNub publish, keeping the connection open.
+    Paths containing 'fail' get a 500, paths containing 'close' get the connection closed.
+    """
+    protocol_version = 'HTTP/1.1'
+    # each response goes out in one write without Nagle delays, like from the real service
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    body = '[1,"Sent","13710000000000000"]'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.connection)
+
+    def do_GET(self):
+        self.send_response(500 if 'fail' in self.path else 200)
+        self.send_header('Content-Type', 'text/javascript; charset="UTF-8"')
+        self.send_header('Content-Length', str(len(self.body)))
+        if 'close' in self.path:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubPubNubServer(ThreadingMixIn, HTTPServer):
+    """ Stands in for PubNub in events.tests and manage.py benchmark_publish. """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = []
+
+    def drop_connections(self):
+        """ Closes all connections, like a server dropping idle keep-alive connections. """
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
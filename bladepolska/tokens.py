@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+
+API_TOKEN_SALT = 'bladepolska.tokens.api'
+
+
+def _password_key(user):
+    """ Changes with the user's password hash, so a new password revokes all of the user's tokens. """
+    return salted_hmac(API_TOKEN_SALT, user.password).hexdigest()[:16]
+
+
+def make_api_token(user):
+    """ A signed token for user, valid for API_TOKEN_MAX_AGE seconds or until the password changes. """
+    return signing.dumps([user.pk, _password_key(user)], salt=API_TOKEN_SALT, compress=True)
+
+
+def user_from_api_token(token):
+    """ The active user the token was made for, or None if it is forged, expired or revoked. """
+    try:
+        user_id, key = signing.loads(token, salt=API_TOKEN_SALT, max_age=settings.API_TOKEN_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+    user = get_user_model().objects.filter(pk=user_id, is_active=True).first()
+    if user is None or not constant_time_compare(key, _password_key(user)):
+        return None
+    return user
@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.contrib import admin
 
 from models import *
+from page_cache import bump_market_version
 
 
 class EventAdmin(admin.ModelAdmin):
@@ -13,11 +15,27 @@ class EventAdmin(admin.ModelAdmin):
         'last_transaction_date',
         'Q_for',
         'Q_against',
+        'version',
+        'price_change',
+        'absolute_price_change',
+        'price_change_1h',
+        'price_change_7d',
     ]
 
     list_display = ['id', 'title', 'is_featured', 'outcome', 'created_date', 'estimated_end_date', 'current_buy_for_price', 'current_buy_against_price', 'Q_for', 'Q_against',
 ]
 
+    def save_model(self, request, obj, form, change):
+        super(EventAdmin, self).save_model(request, obj, form, change)
+        if change and settings.TRADE_EXECUTION_MODE == 'redis':
+            from .redis_market import market
+            market.sync_event_settings(obj)
+        bump_market_version()
+
+    def delete_model(self, request, obj):
+        super(EventAdmin, self).delete_model(request, obj)
+        bump_market_version()
+
 
 class BetAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'event', 'outcome', 'has', 'bought', 'sold', 'bought_avg_price', 'sold_avg_price', 'rewarded_total']
@@ -27,6 +45,11 @@ class TransactionAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'event', 'type', 'date', 'quantity', 'price']
 
 
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ['id', 'channel', 'created_date', 'attempts', 'next_attempt_date']
+
+
 admin.site.register(Event, EventAdmin)
 admin.site.register(Bet, BetAdmin)
 admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
@@ -0,0 +1,51 @@
+import json
+
+from django.conf import settings
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from bladepolska.http import JSONResponse
+from bladepolska.idempotency import idempotent
+from bladepolska.rest import rest_api_login_required
+from .models import Event
+from .views import handle_create_transaction, handle_create_transactions, event_quote
+
+
+# Views under /api/, see politikon.settings.MIDDLEWARE_CLASSES: no sessions, CSRF or
+# messages, users are authenticated by the X-Api-Token header.
+
+@require_http_methods(["GET"])
+def events(request, mode='popular'):
+    queryset = Event.objects.get_events(mode)
+    if queryset is None:
+        raise Http404
+
+    return JSONResponse(json.dumps({
+        'events': [event.event_dict for event in queryset[:settings.API_EVENTS_LIMIT]]
+    }))
+
+
+@require_http_methods(["GET"])
+def event(request, event_id):
+    return JSONResponse(json.dumps(get_object_or_404(Event, id=event_id).event_dict))
+
+
+quote = event_quote
+
+
+@rest_api_login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+@idempotent
+def create_transaction(request, event_id):
+    return handle_create_transaction(request, event_id)
+
+
+@rest_api_login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+@idempotent
+def create_transactions(request):
+    return handle_create_transactions(request)
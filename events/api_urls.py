@@ -0,0 +1,11 @@
+from django.conf.urls import patterns, url
+
+
+urlpatterns = patterns('',
+    url(r'^events/$', 'events.api.events', name="events"),
+    url(r'^events/(?P<mode>popular|latest|changed|finished)/$', 'events.api.events', name="events"),
+    url(r'^events/transactions/create/$', 'events.api.create_transactions', name="create_transactions"),
+    url(r'^event/(?P<event_id>\d+)/$', 'events.api.event', name="event"),
+    url(r'^event/(?P<event_id>\d+)/quote/$', 'events.api.quote', name="event_quote"),
+    url(r'^event/(?P<event_id>\d+)/transaction/create/$', 'events.api.create_transaction', name="create_transaction"),
+)
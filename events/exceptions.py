@@ -29,3 +29,7 @@ class InsufficientBets(Exception):
         super(InsufficientBets, self).__init__(message)
 
         self.updated_bet = updated_bet
+
+
+class ConcurrentUpdate(Exception):
+    pass
@@ -0,0 +1,156 @@
+from __future__ import division
+
+from math import exp, floor, log, log1p
+
+
+PRICE_FACTOR = 100.
+
+
+class LMSRMarket(object):
+    """
+    Logarithmic market scoring rule for a YES/NO event, independent of the ORM.
+
+    The cost function is C(Q_for, Q_against) = B * ln(e^(Q_for/B) + e^(Q_against/B)),
+    computed as max(Q) + B * ln(1 + e^(-|Q_for - Q_against|/B)) so that it never overflows.
+    Money only ever moves as differences of cost_cents(), C scaled by PRICE_FACTOR and
+    rounded to whole cents, so a trade costs the same whether it is made at once or
+    share by share and buying then selling the same shares always nets zero. The
+    procedure (migrations 0011 and 0012) and the Redis script (events.redis_market)
+    compute the very same formula.
+    """
+
+    __slots__ = ('Q_for', 'Q_against', 'B')
+
+    def __init__(self, Q_for=0, Q_against=0, B=5.):
+        self.Q_for = Q_for
+        self.Q_against = Q_against
+        self.B = B
+
+    def quantities_after(self, outcome, delta):
+        if outcome == 'YES':
+            return self.Q_for + delta, self.Q_against
+        return self.Q_for, self.Q_against + delta
+
+    def held(self, outcome):
+        """ Shares of `outcome` held by all users together. """
+        if outcome == 'YES':
+            return self.Q_for
+        return self.Q_against
+
+    def cost(self, Q_for=None, Q_against=None):
+        if Q_for is None:
+            Q_for = self.Q_for
+        if Q_against is None:
+            Q_against = self.Q_against
+
+        B = float(self.B)
+        return max(Q_for, Q_against) + B * log(1. + exp(-abs(Q_for - Q_against) / B))
+
+    def cost_cents(self, Q_for=None, Q_against=None):
+        """ PRICE_FACTOR * C rounded half up, the same way as floor(x + 0.5) in SQL and Lua. """
+        return int(floor(PRICE_FACTOR * self.cost(Q_for, Q_against) + .5))
+
+    def price(self, outcome, direction='BUY'):
+        """
+        Price of the next share, cost_of one share. While nobody holds any shares of
+        `outcome` none can be sold and the buy price is shown as the sell price.
+        """
+        if direction == 'SELL' and self.held(outcome) < 1:
+            direction = 'BUY'
+        return self.cost_of(outcome, 1, direction)
+
+    def prices(self):
+        """
+        (buy_for, buy_against, sell_for, sell_against) prices of the next share.
+
+        cost_cents inlined: the five costs involved only differ by |Q_for - Q_against|
+        in three ways, so each log-sum-exp term is computed once and reused, with the
+        very same float operations as cost() to round to the same cents. Costs are
+        never negative, so int() rounds them down like floor().
+        """
+        Q_for, Q_against = self.Q_for, self.Q_against
+        B = float(self.B)
+        d = Q_for - Q_against
+        term = B * log(1. + exp(-abs(d) / B))
+        term_up = B * log(1. + exp(-abs(d + 1) / B))
+        term_down = B * log(1. + exp(-abs(d - 1) / B))
+
+        # max(Q_for, Q_against) before and after each trade
+        if d > 0:
+            top, top_for, top_against = Q_for, Q_for + 1, Q_for
+        elif d < 0:
+            top, top_for, top_against = Q_against, Q_against, Q_against + 1
+        else:
+            top, top_for, top_against = Q_for, Q_for + 1, Q_for + 1
+
+        now = int(PRICE_FACTOR * (top + term) + .5)
+        buy_for = int(PRICE_FACTOR * (top_for + term_up) + .5) - now
+        buy_against = int(PRICE_FACTOR * (top_against + term_down) + .5) - now
+        # selling lowers max(Q) by one exactly when buying the other outcome raises it
+        if Q_for > 0:
+            sell_for = now - int(PRICE_FACTOR * (top_against - 1 + term_down) + .5)
+        else:
+            sell_for = buy_for
+        if Q_against > 0:
+            sell_against = now - int(PRICE_FACTOR * (top_for - 1 + term_up) + .5)
+        else:
+            sell_against = buy_against
+
+        return buy_for, buy_against, sell_for, sell_against
+
+    def ladder(self, outcome, direction='BUY', shares=10):
+        """ Prices of each of the next `shares` shares when traded one by one. """
+        if direction == 'BUY':
+            delta = 1
+        else:
+            delta = -1
+            shares = min(shares, self.held(outcome))
+
+        market = LMSRMarket(self.Q_for, self.Q_against, self.B)
+        prices = []
+        for i in range(shares):
+            prices.append(market.cost_of(outcome, 1, direction))
+            market.Q_for, market.Q_against = market.quantities_after(outcome, delta)
+
+        return prices
+
+    def cost_of(self, outcome, quantity, direction='BUY'):
+        """
+        Total price of trading `quantity` shares: cost_cents after the trade minus before
+        for a purchase, before minus after for a sale. Raises ValueError for a sale of
+        more shares than are held.
+        """
+        if quantity < 1:
+            raise ValueError("Quantity must be positive, got %r" % quantity)
+
+        if direction == 'BUY':
+            return self.cost_cents(*self.quantities_after(outcome, quantity)) - self.cost_cents()
+
+        if quantity > self.held(outcome):
+            raise ValueError("Cannot sell %d shares of %s, only %d are held" % (quantity, outcome,
+                                                                               self.held(outcome)))
+        return self.cost_cents() - self.cost_cents(*self.quantities_after(outcome, -quantity))
+
+    def shares_for_budget(self, outcome, budget):
+        """ The largest number of shares of `outcome` that can be bought for `budget`. """
+        if budget < self.price(outcome, 'BUY'):
+            return 0
+
+        B = self.B
+        if outcome == 'YES':
+            Q_own, Q_other = self.Q_for, self.Q_against
+        else:
+            Q_own, Q_other = self.Q_against, self.Q_for
+
+        # C(q + n) = C(q) + budget solved for n: n = Q_other - Q_own + B * ln(e^y - 1)
+        y = (budget / PRICE_FACTOR + self.cost() - Q_other) / B
+        shares = int(floor(Q_other - Q_own + B * (y + log1p(-exp(-y)))))
+
+        # the closed form is exact up to the rounding of totals, settle it on whole shares
+        shares = max(shares, 1)
+        while shares > 1 and self.cost_of(outcome, shares) > budget:
+            shares -= 1
+        while self.cost_of(outcome, shares + 1) <= budget:
+            shares += 1
+
+        return shares
@@ -0,0 +1,55 @@
+from math import exp
+from timeit import timeit
+
+from django.core.management.base import BaseCommand
+
+from events.lmsr import LMSRMarket
+
+
+def legacy_prices(Q_for, Q_against, B):
+    """ Event.recalculate_prices as it was before events.lmsr, kept as the baseline. """
+    factor = 100.
+
+    Q_for_sell = max(0, Q_for - 1)
+    Q_against_sell = max(0, Q_against - 1)
+
+    e_for_buy = exp(Q_for / B)
+    e_against_buy = exp(Q_against / B)
+    e_for_sell = exp(Q_for_sell / B)
+    e_against_sell = exp(Q_against_sell / B)
+
+    buy_for_price = e_for_buy / float(e_for_buy + e_against_buy)
+    buy_against_price = e_against_buy / float(e_for_buy + e_against_buy)
+    sell_for_price = e_for_sell / float(e_for_sell + e_against_buy)
+    sell_against_price = e_against_sell / float(e_for_buy + e_against_sell)
+
+    return (round(factor * buy_for_price, 0), round(factor * buy_against_price, 0),
+            round(factor * sell_for_price, 0), round(factor * sell_against_price, 0))
+
+
+class Command(BaseCommand):
+    help = "Compares events.lmsr.LMSRMarket with the legacy per-call exp price computation."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        states = [(Q_for, Q_against, 5.) for Q_for in range(0, 60, 7) for Q_against in range(0, 60, 11)]
+
+        # the legacy prices are marginal prices, LMSRMarket charges the cost of a whole share
+        difference = max(abs(legacy - engine) for state in states
+                         for legacy, engine in zip(legacy_prices(*state), LMSRMarket(*state).prices()))
+        self.stdout.write("largest price difference:  %d" % difference)
+
+        legacy = timeit(lambda: [legacy_prices(*state) for state in states], number=number // len(states))
+        engine = timeit(lambda: [LMSRMarket(*state).prices() for state in states], number=number // len(states))
+
+        self.stdout.write("legacy recalculate_prices: %.3fs" % legacy)
+        self.stdout.write("LMSRMarket.prices:         %.3fs" % engine)
+        self.stdout.write("legacy / LMSRMarket time:  %.2f" % (legacy / engine))
+
+        try:
+            legacy_prices(5000, 0, 5.)
+        except OverflowError:
+            self.stdout.write("legacy overflows at Q/B = 1000, LMSRMarket gives %s" % (LMSRMarket(5000, 0, 5.).prices(),))
@@ -0,0 +1,52 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from bladepolska.pubnub import HTTPConnectionPool, PooledPubnub
+from bladepolska.testing import StubPubNubHandler, StubPubNubServer
+from vendor import Pubnub as pubnub_api
+
+
+class Command(BaseCommand):
+    help = ("Measures publish throughput against a local stub PubNub server: urllib2 per message "
+            "(the vendor client), pooled keep-alive connections and pooled pipelines.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--pipeline-depth', type=int, default=50)
+
+    def handle(self, *args, **options):
+        count = options['messages']
+
+        server = StubPubNubServer(('127.0.0.1', 0), StubPubNubHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        origin = '127.0.0.1:%d' % server.server_address[1]
+
+        messages = [{'channel': 'event_%d' % (i % 20), 'message': {'updates': {'events': [{'event_id': i % 20}]}}}
+                    for i in range(count)]
+
+        def pooled():
+            pool = HTTPConnectionPool('127.0.0.1', server.server_address[1],
+                                      pipeline_depth=options['pipeline_depth'])
+            return PooledPubnub(pool, 'pub', 'sub', False, False, origin)
+
+        runs = [
+            ('urllib2', pubnub_api.Pubnub('pub', 'sub', False, False, origin), False),
+            ('keep-alive', pooled(), False),
+            ('pipelined', pooled(), True),
+        ]
+        for name, client, pipelined in runs:
+            start = time.time()
+            if pipelined:
+                infos = client.publish_many(messages)
+            else:
+                infos = [client.publish(message) for message in messages]
+            elapsed = time.time() - start
+
+            sent = len([info for info in infos if info and info[0] == 1])
+            self.stdout.write("%-12s %6d sent in %.3fs, %8.0f messages/s" % (name, sent, elapsed, sent / elapsed))
+
+        server.shutdown()
@@ -0,0 +1,29 @@
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+
+from events.models import Bet
+from events.positions import rebuild_holders, rebuild_positions
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the positions cache of every user with bets, and the holder sets of every event, "
+            "from the database, e.g. after Redis lost its data. With TRADE_EXECUTION_MODE 'redis' run it "
+            "once the trades are flushed.")
+
+    def handle(self, *args, **options):
+        bets = Bet.objects.filter(has__gt=0).order_by('user_id').values_list(
+            'user_id', 'event_id', 'outcome', 'has', 'bought_avg_price')
+
+        users = 0
+        holders = {}
+        for user_id, positions in groupby(bets.iterator(), key=lambda bet: bet[0]):
+            positions = [position[1:] for position in positions]
+            rebuild_positions(user_id, positions)
+            for event_id, outcome, has, avg_price in positions:
+                holders.setdefault((event_id, outcome), []).append(user_id)
+            users += 1
+
+        rebuild_holders(holders)
+
+        self.stdout.write("Rebuilt the positions of %d users and %d holder sets" % (users, len(holders)))
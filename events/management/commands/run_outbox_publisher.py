@@ -0,0 +1,15 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from events.outbox import deliver
+
+
+class Command(BaseCommand):
+    help = "Publishes outbox messages to the realtime backend as soon as their transactions commit."
+
+    def handle(self, *args, **options):
+        while True:
+            if deliver() < settings.OUTBOX_BATCH_SIZE:
+                time.sleep(settings.OUTBOX_POLL_INTERVAL)
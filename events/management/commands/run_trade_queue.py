@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from events.trade_queue import TradeQueueWorker
+
+
+class Command(BaseCommand):
+    help = "Runs the single trade writer for hot events of one shard."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, default=0)
+
+    def handle(self, *args, **options):
+        TradeQueueWorker(options['shard']).run()
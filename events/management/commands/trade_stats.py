@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from events.stats import get_trade_stats, reset_trade_stats
+
+
+class Command(BaseCommand):
+    help = ("Shows trade counters per execution mode, including optimistic contention "
+            "and how many retries price limits saved, and the price broadcast counters.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help="Reset the counters after printing them.")
+
+    def handle(self, *args, **options):
+        stats = get_trade_stats()
+
+        for mode in sorted(stats.keys()):
+            counters = stats[mode]
+            self.stdout.write("%s:" % mode)
+            for name in sorted(counters.keys()):
+                self.stdout.write("    %-16s %d" % (name, counters[name]))
+
+            attempts = counters.get('attempts', 0)
+            if attempts:
+                self.stdout.write("    %-16s %.2f%%" % ('contention', 100. * counters.get('conflicts', 0) / attempts))
+
+            # a slippage fill is a trade that would have been rejected, and retried, without a price limit
+            slippage_fills = counters.get('slippage_fills', 0)
+            price_checks = slippage_fills + counters.get('price_mismatches', 0)
+            if price_checks:
+                self.stdout.write("    %-16s %.2f%%" % ('retries saved', 100. * slippage_fills / price_checks))
+
+            # outbox messages merged into broadcasts that were actually sent
+            messages = counters.get('messages', 0)
+            if messages:
+                saved = messages - counters.get('sent', 0)
+                self.stdout.write("    %-16s %d (%.2f%%)" % ('messages saved', saved, 100. * saved / messages))
+
+        if options['reset']:
+            reset_trade_stats()
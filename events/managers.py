@@ -1,4 +1,74 @@
-from django.db import models
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import local
+
+from django.conf import settings
+from django.contrib import auth
+from django.db import connection, models, transaction
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from .exceptions import NonexistantEvent, PriceMismatch, EventNotInProgress, \
+    UnknownOutcome, InsufficientCash, InsufficientBets, ConcurrentUpdate
+from .page_cache import bump_market_version
+from .positions import friend_holders, update_position
+from .stats import incr_trade_stat
+
+
+_coalesced = local()
+
+
+@contextmanager
+def coalesced_publishes():
+    """
+    Within the block after_trade only remembers the last state of each traded event.
+    Every one of them is published once, queued in the outbox when the block exits
+    without an exception; exit it before the surrounding transaction commits.
+    """
+    _coalesced.events = OrderedDict()
+    try:
+        yield
+        events = _coalesced.events.values()
+    finally:
+        del _coalesced.events
+
+    for event, trades in events:
+        publish_event_update(event, trades)
+
+
+def publish_event_update(event, trades=1):
+    from .models import OutboxMessage
+
+    OutboxMessage.objects.enqueue(event.publish_channel, {
+        'updates': {
+            'events': [event.event_dict]
+        },
+        'trades': trades
+    })
+
+
+def check_trade_price(event, direction, price, price_limit, current_price, total, quantity):
+    """
+    Without a price_limit the trade has to happen exactly at the requested price of the
+    next share. With one, it is filled whenever the executed price per share is within
+    the limit: at most price_limit when buying, at least price_limit when selling.
+    """
+    if price_limit is None:
+        accepted = (price == current_price)
+    elif direction == 'BUY':
+        accepted = (total <= price_limit * quantity)
+    else:
+        accepted = (total >= price_limit * quantity)
+
+    if not accepted:
+        incr_trade_stat(settings.TRADE_EXECUTION_MODE, 'price_mismatches')
+        raise PriceMismatch(_("Price has changed."), event)
+
+    if price is not None and price != current_price:
+        incr_trade_stat(settings.TRADE_EXECUTION_MODE, 'slippage_fills')
 
 
 class EventManager(models.Manager):
@@ -28,19 +98,17 @@ class EventManager(models.Manager):
             return None
 
     def associate_people_with_events(self, user, events_list):
-        event_ids = set([e.id for e in events_list])
-        # friends = user.friends.all()
-        bets = Bet.objects.select_related('user__facebook_user__profile_photo').filter(user__in=user.friends_ids_set, event__in=event_ids, has__gt=0)
+        """ {event_id: {'YES': [friend, ...], 'NO': [friend, ...]}} of the user's friends holding shares. """
+        from .models import BET_OUTCOMES_INV_DICT
 
-        result = {
-                    event_id: defaultdict(list)
-                        # { outcome: defaultdict(list) for outcome in BET_OUTCOMES_DICT.keys() }
-                            for event_id in event_ids
-                 }
+        event_ids = [e.id for e in events_list]
+        holders = friend_holders(user, event_ids)
+        friends = auth.get_user_model().objects.in_bulk(set().union(*holders.values()))
 
-        for bet in bets:
-            outcome = BET_OUTCOMES_INV_DICT[bet.outcome]
-            result[bet.event_id][outcome].append(bet.user)
+        result = dict((event_id, {'YES': [], 'NO': []}) for event_id in event_ids)
+        for (event_id, outcome), user_ids in holders.items():
+            result[event_id][BET_OUTCOMES_INV_DICT[outcome]] = [friends[user_id] for user_id in user_ids
+                                                                 if user_id in friends]
 
         return result
 
@@ -50,6 +118,8 @@ class BetManager(models.Manager):
         return self.filter(user__id=user.id, event__in=events)
 
     def get_user_event_and_bet_for_update(self, user, event_id, for_outcome):
+        from .models import Event, BET_OUTCOMES_DICT
+
         event = list(Event.objects.select_for_update().filter(id=event_id))
         try:
             event = event[0]
@@ -70,29 +140,46 @@ class BetManager(models.Manager):
 
         return user, event, bet
 
-    def buy_a_bet(self, user, event_id, for_outcome, price):
+    def lock_events_and_user(self, user, event_ids):
+        """
+        Takes the row locks of a trade on many events up front: the events by ascending
+        id and then the user. A single trade also locks its event before the user, so
+        batches cannot deadlock with each other or with single trades.
+        """
+        from .models import Event
+
+        list(Event.objects.select_for_update().filter(id__in=event_ids).order_by('id').values_list('id', flat=True))
+        list(auth.get_user_model().objects.select_for_update().filter(id=user.id).values_list('id', flat=True))
+
+    def buy_a_bet(self, user, event_id, for_outcome, price, quantity=1, price_limit=None):
         """ Always remember about wrapping this in a transaction! """
+        if settings.TRADE_EXECUTION_MODE == 'procedure':
+            return self.trade_in_database(user, event_id, for_outcome, price, quantity, price_limit, buy=True)
+        elif settings.TRADE_EXECUTION_MODE == 'optimistic':
+            return self.trade_optimistically(user, event_id, for_outcome, price, quantity, price_limit, buy=True)
+        elif settings.TRADE_EXECUTION_MODE == 'redis':
+            from .redis_market import market
+            return market.trade(user, event_id, for_outcome, price, quantity, price_limit, buy=True)
+
+        from .models import Transaction
+
         user, event, bet = self.get_user_event_and_bet_for_update(user, event_id, for_outcome)
 
         if for_outcome == 'YES':
-            transaction_type = self.model.TRANSACTION_TYPE_CHOICES.BUY_YES
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.BUY_YES
         else:
-            transaction_type = self.model.TRANSACTION_TYPE_CHOICES.BUY_NO
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.BUY_NO
 
-        requested_price = price
         current_tx_price = event.price_for_outcome(for_outcome, direction='BUY')
-        if requested_price != current_tx_price:
-            raise PriceMismatch(_("Price has changed."), event)
-
-        quantity = 1
-        bought_for_total = current_tx_price * quantity
+        bought_for_total = event.price_for_quantity(for_outcome, quantity, direction='BUY')
+        check_trade_price(event, 'BUY', price, price_limit, current_tx_price, bought_for_total, quantity)
 
         if (user.total_cash < bought_for_total):
             raise InsufficientCash(_("You don't have enough cash."), user)
 
         transaction = Transaction.objects.create(
                         user_id=user.id, event_id=event.id, type=transaction_type,
-                        quantity=quantity, price=current_tx_price)
+                        quantity=quantity, price=int(round(bought_for_total / float(quantity))))
 
         event_total_bought_price = (bet.bought_avg_price * bet.bought)
         after_bought_quantity = bet.bought + quantity
@@ -113,40 +200,39 @@ class BetManager(models.Manager):
         # from canvas.models import ActivityLog
         # ActivityLog.objects.register_transaction_activity(user, transaction)
 
-        PubNub().publish({
-            'channel': event.publish_channel,
-            'message': {
-                'updates': {
-                    'events': [event.event_dict]
-                }
-            }
-        })
+        self.after_trade(user, event, bet)
 
         return user, event, bet
 
-    def sell_a_bet(self, user, event_id, for_outcome, price):
+    def sell_a_bet(self, user, event_id, for_outcome, price, quantity=1, price_limit=None):
         """ Always remember about wrapping this in a transaction! """
-        user, event, bet = self.get_user_event_and_bet_for_update(user, event_id, for_outcome)
+        if settings.TRADE_EXECUTION_MODE == 'procedure':
+            return self.trade_in_database(user, event_id, for_outcome, price, quantity, price_limit, buy=False)
+        elif settings.TRADE_EXECUTION_MODE == 'optimistic':
+            return self.trade_optimistically(user, event_id, for_outcome, price, quantity, price_limit, buy=False)
+        elif settings.TRADE_EXECUTION_MODE == 'redis':
+            from .redis_market import market
+            return market.trade(user, event_id, for_outcome, price, quantity, price_limit, buy=False)
 
-        requested_price = price
-        current_tx_price = event.price_for_outcome(for_outcome, direction='SELL')
-        if requested_price != current_tx_price:
-            raise PriceMismatch(_("Price has changed."), event)
+        from .models import Transaction
 
-        quantity = 1
-        sold_for_total = current_tx_price * quantity
+        user, event, bet = self.get_user_event_and_bet_for_update(user, event_id, for_outcome)
 
         if (bet.has < quantity):
             raise InsufficientBets(_("You don't have enough shares."), bet)
 
+        current_tx_price = event.price_for_outcome(for_outcome, direction='SELL')
+        sold_for_total = event.price_for_quantity(for_outcome, quantity, direction='SELL')
+        check_trade_price(event, 'SELL', price, price_limit, current_tx_price, sold_for_total, quantity)
+
         if for_outcome == 'YES':
-            transaction_type = self.model.TRANSACTION_TYPE_CHOICES.SELL_YES
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.SELL_YES
         else:
-            transaction_type = self.model.TRANSACTION_TYPE_CHOICES.SELL_NO
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.SELL_NO
 
         transaction = Transaction.objects.create(
                         user_id=user.id, event_id=event.id, type=transaction_type,
-                        quantity=quantity, price=current_tx_price)
+                        quantity=quantity, price=int(round(sold_for_total / float(quantity))))
 
         event_total_sold_price = (bet.sold_avg_price * bet.sold)
         after_sold_quantity = bet.sold + quantity
@@ -165,18 +251,214 @@ class BetManager(models.Manager):
         # from canvas.models import ActivityLog
         # ActivityLog.objects.register_transaction_activity(user, transaction)
 
-        PubNub().publish({
-            'channel': event.publish_channel,
-            'message': {
-                'updates': {
-                    'events': [event.event_dict]
-                }
-            }
-        })
+        self.after_trade(user, event, bet)
 
         return user, event, bet
 
+    def trade_in_database(self, user, event_id, for_outcome, price, quantity=1, price_limit=None, buy=True):
+        """
+        Executes the whole trade with a single call to the events_execute_trade procedure
+        (see migrations 0003 and 0006) instead of a round trip per lock, insert and update.
+        Raises the same exceptions as buy_a_bet and sell_a_bet.
+        """
+        from .models import Event, BET_OUTCOMES_DICT
+
+        if for_outcome not in BET_OUTCOMES_DICT:
+            raise UnknownOutcome()
+        bet_outcome = BET_OUTCOMES_DICT[for_outcome]
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM events_execute_trade(%s, %s, %s, %s, %s, %s, %s)",
+                       [user.id, event_id, bet_outcome, buy, price, quantity, price_limit])
+        columns = [column[0] for column in cursor.description]
+        row = dict(zip(columns, cursor.fetchone()))
+        status = row['trade_status']
+
+        if status == 'NONEXISTANT_EVENT':
+            raise NonexistantEvent(_("Requested event does not exist."))
+        if status == 'EVENT_NOT_IN_PROGRESS':
+            raise EventNotInProgress(_("Event is no longer in progress."))
+
+        event = Event(
+            id=row['ev_id'],
+            current_buy_for_price=row['ev_buy_for_price'],
+            current_buy_against_price=row['ev_buy_against_price'],
+            current_sell_for_price=row['ev_sell_for_price'],
+            current_sell_against_price=row['ev_sell_against_price'],
+            Q_for=row['ev_q_for'],
+            Q_against=row['ev_q_against'],
+            turnover=row['ev_turnover'],
+        )
+
+        user.total_cash = row['us_total_cash']
+        user.portfolio_value = row['us_portfolio_value']
+        user.reputation = row['us_reputation']
+
+        bet = self.model(
+            id=row['bt_id'], user=user, event=event, outcome=bet_outcome,
+            has=row['bt_has'],
+            bought=row['bt_bought'],
+            sold=row['bt_sold'],
+            bought_avg_price=row['bt_bought_avg_price'],
+            sold_avg_price=row['bt_sold_avg_price'],
+            rewarded_total=row['bt_rewarded_total'],
+        )
+
+        if status == 'PRICE_MISMATCH':
+            incr_trade_stat(settings.TRADE_EXECUTION_MODE, 'price_mismatches')
+            raise PriceMismatch(_("Price has changed."), event)
+        if status == 'INSUFFICIENT_CASH':
+            raise InsufficientCash(_("You don't have enough cash."), user)
+        if status == 'INSUFFICIENT_BETS':
+            raise InsufficientBets(_("You don't have enough shares."), bet)
+
+        if price is not None and price != row['tx_quoted_price']:
+            incr_trade_stat(settings.TRADE_EXECUTION_MODE, 'slippage_fills')
+
+        self.after_trade(user, event, bet)
+
+        return user, event, bet
+
+    def trade_optimistically(self, user, event_id, for_outcome, price, quantity=1, price_limit=None, buy=True):
+        """
+        Executes the trade without SELECT ... FOR UPDATE. Event and bet are written with
+        UPDATE ... WHERE version = n and the attempt is retried, up to
+        TRADE_OPTIMISTIC_RETRIES times, whenever another trade got there first.
+        Raises the same exceptions as buy_a_bet and sell_a_bet.
+        """
+        from .models import Event
+
+        for attempt in range(settings.TRADE_OPTIMISTIC_RETRIES + 1):
+            incr_trade_stat('optimistic', 'attempts')
+            try:
+                with transaction.atomic():
+                    user, event, bet = self._optimistic_trade_attempt(user, event_id, for_outcome, price, quantity,
+                                                                          price_limit, buy)
+            except ConcurrentUpdate:
+                incr_trade_stat('optimistic', 'conflicts')
+                continue
+
+            self.after_trade(user, event, bet)
+
+            return user, event, bet
+
+        incr_trade_stat('optimistic', 'exhausted')
+        raise PriceMismatch(_("Price has changed."), Event.objects.get(id=event_id))
+
+    def _optimistic_trade_attempt(self, user, event_id, for_outcome, price, quantity, price_limit, buy):
+        from .models import Event, Transaction, BET_OUTCOMES_DICT
+
+        event = list(Event.objects.filter(id=event_id))
+        try:
+            event = event[0]
+        except IndexError:
+            raise NonexistantEvent(_("Requested event does not exist."))
+
+        if not event.is_in_progress:
+            raise EventNotInProgress(_("Event is no longer in progress."))
+
+        if for_outcome not in BET_OUTCOMES_DICT:
+            raise UnknownOutcome()
+
+        bet, created = self.get_or_create(user_id=user.id, event_id=event.id, outcome=BET_OUTCOMES_DICT[for_outcome])
+        user = auth.get_user_model().objects.get(id=user.id)
+
+        if buy:
+            direction = 'BUY'
+        else:
+            direction = 'SELL'
+
+        if not buy and bet.has < quantity:
+            raise InsufficientBets(_("You don't have enough shares."), bet)
+
+        current_tx_price = event.price_for_outcome(for_outcome, direction=direction)
+        total = event.price_for_quantity(for_outcome, quantity, direction=direction)
+        check_trade_price(event, direction, price, price_limit, current_tx_price, total, quantity)
+
+        if buy and user.total_cash < total:
+            raise InsufficientCash(_("You don't have enough cash."), user)
+
+        event_version = event.version
+        if buy:
+            event.increment_quantity(for_outcome, by_amount=quantity)
+            event.increment_turnover(quantity)
+        else:
+            event.increment_quantity(for_outcome, by_amount=-quantity)
+
+        event_fields = ['Q_for', 'Q_against', 'turnover', 'current_buy_for_price', 'current_buy_against_price',
+                        'current_sell_for_price', 'current_sell_against_price']
+        updated = Event.objects.filter(id=event.id, version=event_version) \
+            .update(version=F('version') + 1, **dict((field, getattr(event, field)) for field in event_fields))
+        if not updated:
+            raise ConcurrentUpdate()
+        event.version = event_version + 1
+
+        bet_version = bet.version
+        if buy:
+            bet.bought_avg_price = (bet.bought_avg_price * bet.bought + total) / (bet.bought + quantity)
+            bet.has += quantity
+            bet.bought += quantity
+            bet_fields = ['bought_avg_price', 'has', 'bought']
+        else:
+            bet.sold_avg_price = (bet.sold_avg_price * bet.sold + total) / (bet.sold + quantity)
+            bet.has -= quantity
+            bet.sold += quantity
+            bet_fields = ['sold_avg_price', 'has', 'sold']
+
+        updated = self.filter(id=bet.id, version=bet_version) \
+            .update(version=F('version') + 1, **dict((field, getattr(bet, field)) for field in bet_fields))
+        if not updated:
+            raise ConcurrentUpdate()
+        bet.version = bet_version + 1
+
+        users = auth.get_user_model().objects.filter(id=user.id)
+        if buy:
+            updated = users.filter(total_cash__gte=total).update(total_cash=F('total_cash') - total)
+            if not updated:
+                user.refresh_from_db(fields=['total_cash'])
+                raise InsufficientCash(_("You don't have enough cash."), user)
+        else:
+            users.update(total_cash=F('total_cash') + total)
+        user.refresh_from_db(fields=['total_cash'])
+
+        if buy and for_outcome == 'YES':
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.BUY_YES
+        elif buy:
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.BUY_NO
+        elif for_outcome == 'YES':
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.SELL_YES
+        else:
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.SELL_NO
+
+        Transaction.objects.create(
+            user_id=user.id, event_id=event.id, type=transaction_type,
+            quantity=quantity, price=int(round(total / float(quantity))))
+
+        return user, event, bet
+
+    def after_trade(self, user, event, bet):
+        incr_trade_stat(settings.TRADE_EXECUTION_MODE, 'trades')
+        bump_market_version()
+        # trades in Redis are committed as soon as they are made
+        update_position(bet, deferred=(settings.TRADE_EXECUTION_MODE != 'redis'))
+
+        coalesced_events = getattr(_coalesced, 'events', None)
+        if coalesced_events is not None:
+            trades = coalesced_events.get(event.id, (None, 0))[1]
+            coalesced_events[event.id] = (event, trades + 1)
+        else:
+            publish_event_update(event)
+
 
 class TransactionManager(models.Manager):
     pass
 
+
+class OutboxMessageManager(models.Manager):
+    def enqueue(self, channel, message):
+        """ Saves a message to be published once the current transaction commits. """
+        return self.create(channel=channel, message=json.dumps(message, cls=DjangoJSONEncoder))
+
+    def due(self):
+        return self.filter(attempts__lt=settings.OUTBOX_MAX_ATTEMPTS, next_attempt_date__lte=timezone.now())
+
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+LMSR_COST_SQL = """
+CREATE OR REPLACE FUNCTION events_lmsr_cost(q_for integer, q_against integer, b double precision)
+RETURNS double precision AS $$
+    SELECT b * ln(exp(q_for / b) + exp(q_against / b));
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+LMSR_PRICES_SQL = """
+CREATE OR REPLACE FUNCTION events_lmsr_prices(
+    q_for integer, q_against integer, b double precision,
+    OUT buy_for integer, OUT buy_against integer, OUT sell_for integer, OUT sell_against integer
+) AS $$
+DECLARE
+    e_for_buy double precision := exp(q_for / b);
+    e_against_buy double precision := exp(q_against / b);
+    e_for_sell double precision := exp(greatest(0, q_for - 1) / b);
+    e_against_sell double precision := exp(greatest(0, q_against - 1) / b);
+BEGIN
+    buy_for := round((100 * e_for_buy / (e_for_buy + e_against_buy))::numeric);
+    buy_against := round((100 * e_against_buy / (e_for_buy + e_against_buy))::numeric);
+    sell_for := round((100 * e_for_sell / (e_for_sell + e_against_buy))::numeric);
+    sell_against := round((100 * e_against_sell / (e_for_buy + e_against_sell))::numeric);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+EXECUTE_TRADE_SQL = """
+CREATE OR REPLACE FUNCTION events_execute_trade(
+    p_user_id integer, p_event_id integer, p_outcome boolean, p_buy boolean,
+    p_price integer, p_quantity integer,
+    OUT trade_status text,
+    OUT ev_id integer,
+    OUT ev_buy_for_price integer,
+    OUT ev_buy_against_price integer,
+    OUT ev_sell_for_price integer,
+    OUT ev_sell_against_price integer,
+    OUT ev_q_for integer,
+    OUT ev_q_against integer,
+    OUT ev_turnover integer,
+    OUT bt_id integer,
+    OUT bt_has integer,
+    OUT bt_bought integer,
+    OUT bt_sold integer,
+    OUT bt_bought_avg_price double precision,
+    OUT bt_sold_avg_price double precision,
+    OUT bt_rewarded_total integer,
+    OUT us_total_cash integer,
+    OUT us_portfolio_value integer,
+    OUT us_reputation numeric
+) AS $$
+DECLARE
+    ev events_event%ROWTYPE;
+    bt events_bet%ROWTYPE;
+    us accounts_userprofile%ROWTYPE;
+    prices record;
+    current_price integer;
+    tx_type integer;
+    delta integer;
+    new_q_for integer;
+    new_q_against integer;
+    total integer;
+BEGIN
+    SELECT * INTO ev FROM events_event WHERE id = p_event_id FOR UPDATE;
+    IF NOT FOUND THEN
+        trade_status := 'NONEXISTANT_EVENT';
+        RETURN;
+    END IF;
+
+    IF ev.outcome <> 1 THEN
+        trade_status := 'EVENT_NOT_IN_PROGRESS';
+        RETURN;
+    END IF;
+
+    IF p_buy AND p_outcome THEN
+        current_price := ev.current_buy_for_price;
+        tx_type := 1;
+    ELSIF p_buy THEN
+        current_price := ev.current_buy_against_price;
+        tx_type := 3;
+    ELSIF p_outcome THEN
+        current_price := ev.current_sell_for_price;
+        tx_type := 2;
+    ELSE
+        current_price := ev.current_sell_against_price;
+        tx_type := 4;
+    END IF;
+
+    SELECT * INTO bt FROM events_bet
+        WHERE user_id = p_user_id AND event_id = p_event_id AND outcome = p_outcome
+        FOR UPDATE;
+    IF NOT FOUND THEN
+        INSERT INTO events_bet (user_id, event_id, outcome, has, bought, sold,
+                                bought_avg_price, sold_avg_price, rewarded_total)
+            VALUES (p_user_id, p_event_id, p_outcome, 0, 0, 0, 0, 0, 0)
+            RETURNING * INTO bt;
+    END IF;
+
+    SELECT * INTO us FROM accounts_userprofile WHERE id = p_user_id FOR UPDATE;
+
+    IF p_buy THEN
+        delta := p_quantity;
+    ELSE
+        delta := -p_quantity;
+    END IF;
+
+    new_q_for := ev."Q_for";
+    new_q_against := ev."Q_against";
+    IF p_outcome THEN
+        new_q_for := new_q_for + delta;
+    ELSE
+        new_q_against := new_q_against + delta;
+    END IF;
+
+    IF p_quantity = 1 THEN
+        total := current_price;
+    ELSE
+        total := round((100 * abs(events_lmsr_cost(new_q_for, new_q_against, ev."B") -
+                                  events_lmsr_cost(ev."Q_for", ev."Q_against", ev."B")))::numeric);
+    END IF;
+
+    IF current_price <> p_price THEN
+        trade_status := 'PRICE_MISMATCH';
+    ELSIF p_buy AND us.total_cash < total THEN
+        trade_status := 'INSUFFICIENT_CASH';
+    ELSIF NOT p_buy AND bt.has < p_quantity THEN
+        trade_status := 'INSUFFICIENT_BETS';
+    ELSE
+        trade_status := 'OK';
+
+        INSERT INTO events_transaction (user_id, event_id, type, date, quantity, price)
+            VALUES (p_user_id, p_event_id, tx_type, now(), p_quantity, round(total::numeric / p_quantity));
+
+        IF p_buy THEN
+            UPDATE events_bet SET
+                bought_avg_price = (bought_avg_price * bought + total) / (bought + p_quantity),
+                has = has + p_quantity,
+                bought = bought + p_quantity
+                WHERE id = bt.id RETURNING * INTO bt;
+            UPDATE accounts_userprofile SET total_cash = total_cash - total
+                WHERE id = p_user_id RETURNING * INTO us;
+        ELSE
+            UPDATE events_bet SET
+                sold_avg_price = (sold_avg_price * sold + total) / (sold + p_quantity),
+                has = has - p_quantity,
+                sold = sold + p_quantity
+                WHERE id = bt.id RETURNING * INTO bt;
+            UPDATE accounts_userprofile SET total_cash = total_cash + total
+                WHERE id = p_user_id RETURNING * INTO us;
+        END IF;
+
+        SELECT * INTO prices FROM events_lmsr_prices(new_q_for, new_q_against, ev."B");
+        UPDATE events_event SET
+            "Q_for" = new_q_for,
+            "Q_against" = new_q_against,
+            current_buy_for_price = prices.buy_for,
+            current_buy_against_price = prices.buy_against,
+            current_sell_for_price = prices.sell_for,
+            current_sell_against_price = prices.sell_against,
+            turnover = turnover + CASE WHEN p_buy THEN p_quantity ELSE 0 END
+            WHERE id = p_event_id RETURNING * INTO ev;
+    END IF;
+
+    ev_id := ev.id;
+    ev_buy_for_price := ev.current_buy_for_price;
+    ev_buy_against_price := ev.current_buy_against_price;
+    ev_sell_for_price := ev.current_sell_for_price;
+    ev_sell_against_price := ev.current_sell_against_price;
+    ev_q_for := ev."Q_for";
+    ev_q_against := ev."Q_against";
+    ev_turnover := ev.turnover;
+
+    bt_id := bt.id;
+    bt_has := bt.has;
+    bt_bought := bt.bought;
+    bt_sold := bt.sold;
+    bt_bought_avg_price := bt.bought_avg_price;
+    bt_sold_avg_price := bt.sold_avg_price;
+    bt_rewarded_total := bt.rewarded_total;
+
+    us_total_cash := us.total_cash;
+    us_portfolio_value := us.portfolio_value;
+    us_reputation := us.reputation;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0002_auto_20151107_0037'),
+        ('accounts', '0007_auto_20151107_0037'),
+    ]
+
+    operations = [
+        migrations.RunSQL(LMSR_COST_SQL, "DROP FUNCTION events_lmsr_cost(integer, integer, double precision);"),
+        migrations.RunSQL(LMSR_PRICES_SQL, "DROP FUNCTION events_lmsr_prices(integer, integer, double precision);"),
+        migrations.RunSQL(
+            EXECUTE_TRADE_SQL,
+            "DROP FUNCTION events_execute_trade(integer, integer, boolean, boolean, integer, integer);"
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Every write to an event or bet bumps its version, whichever path it comes from
+# (ORM trade path, events_execute_trade, admin), so optimistic writers see all of them.
+BUMP_VERSION_SQL = """
+CREATE OR REPLACE FUNCTION events_bump_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER events_event_bump_version BEFORE UPDATE ON events_event
+    FOR EACH ROW WHEN (NEW.version = OLD.version) EXECUTE PROCEDURE events_bump_version();
+
+CREATE TRIGGER events_bet_bump_version BEFORE UPDATE ON events_bet
+    FOR EACH ROW WHEN (NEW.version = OLD.version) EXECUTE PROCEDURE events_bump_version();
+"""
+
+DROP_BUMP_VERSION_SQL = """
+DROP TRIGGER events_bet_bump_version ON events_bet;
+DROP TRIGGER events_event_bump_version ON events_event;
+DROP FUNCTION events_bump_version();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0003_trade_procedure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bet',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='wersja'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='wersja'),
+        ),
+        migrations.RunSQL(BUMP_VERSION_SQL, DROP_BUMP_VERSION_SQL),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0004_event_bet_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='is_hot',
+            field=models.BooleanField(default=False, verbose_name='gor\u0105cy rynek (transakcje przez kolejk\u0119)'),
+        ),
+    ]
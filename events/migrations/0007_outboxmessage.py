@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0006_trade_price_limit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel', models.CharField(max_length=255, verbose_name='kana\u0142')),
+                ('message', models.TextField(verbose_name='wiadomo\u015b\u0107 (JSON)')),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='nieudane pr\xf3by wys\u0142ania')),
+                ('next_attempt_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='data nast\u0119pnej pr\xf3by', db_index=True)),
+            ],
+        ),
+    ]
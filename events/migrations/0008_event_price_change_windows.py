@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0007_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='price_change_1h',
+            field=models.IntegerField(default=0, verbose_name='zmiana ceny w ci\u0105gu godziny'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='price_change_7d',
+            field=models.IntegerField(default=0, verbose_name='zmiana ceny w ci\u0105gu tygodnia'),
+        ),
+    ]
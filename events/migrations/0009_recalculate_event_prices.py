@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from events.lmsr import LMSRMarket
+
+
+def recalculate_prices(apps, schema_editor):
+    """ Stored prices become the cost of one whole share, see LMSRMarket.price. """
+    Event = apps.get_model('events', 'Event')
+    for event in Event.objects.all().iterator():
+        prices = LMSRMarket(event.Q_for, event.Q_against, event.B).prices()
+        Event.objects.filter(id=event.id).update(
+            current_buy_for_price=prices[0],
+            current_buy_against_price=prices[1],
+            current_sell_for_price=prices[2],
+            current_sell_against_price=prices[3],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0008_event_price_change_windows'),
+    ]
+
+    operations = [
+        migrations.RunPython(recalculate_prices, migrations.RunPython.noop),
+    ]
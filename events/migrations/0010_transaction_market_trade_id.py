@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0009_recalculate_event_prices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='market_trade_id',
+            field=models.BigIntegerField(verbose_name='identyfikator transakcji w Redis', unique=True, null=True,
+                                         editable=False),
+        ),
+    ]
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import models, migrations
+
+
+previous = import_module('events.migrations.0003_trade_procedure')
+PREVIOUS_LMSR_COST_SQL = previous.LMSR_COST_SQL
+PREVIOUS_LMSR_PRICES_SQL = previous.LMSR_PRICES_SQL
+PREVIOUS_EXECUTE_TRADE_SQL = import_module('events.migrations.0006_trade_price_limit').EXECUTE_TRADE_SQL
+
+# events.lmsr.LMSRMarket.cost: log-sum-exp, so that exp() never overflows for large Q
+LMSR_COST_SQL = """
+CREATE OR REPLACE FUNCTION events_lmsr_cost(q_for integer, q_against integer, b double precision)
+RETURNS double precision AS $$
+    SELECT greatest(q_for, q_against) + b * ln(1 + exp(-abs(q_for - q_against) / b));
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+# events.lmsr.LMSRMarket.cost_cents, all money moves as differences of it
+LMSR_COST_CENTS_SQL = """
+CREATE OR REPLACE FUNCTION events_lmsr_cost_cents(q_for integer, q_against integer, b double precision)
+RETURNS integer AS $$
+    SELECT floor(100 * events_lmsr_cost(q_for, q_against, b) + 0.5)::integer;
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+# events.lmsr.LMSRMarket.prices
+LMSR_PRICES_SQL = """
+CREATE OR REPLACE FUNCTION events_lmsr_prices(
+    q_for integer, q_against integer, b double precision,
+    OUT buy_for integer, OUT buy_against integer, OUT sell_for integer, OUT sell_against integer
+) AS $$
+DECLARE
+    cost integer := events_lmsr_cost_cents(q_for, q_against, b);
+BEGIN
+    buy_for := events_lmsr_cost_cents(q_for + 1, q_against, b) - cost;
+    buy_against := events_lmsr_cost_cents(q_for, q_against + 1, b) - cost;
+    sell_for := CASE WHEN q_for > 0 THEN cost - events_lmsr_cost_cents(q_for - 1, q_against, b) ELSE buy_for END;
+    sell_against := CASE WHEN q_against > 0 THEN cost - events_lmsr_cost_cents(q_for, q_against - 1, b)
+                    ELSE buy_against END;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+EXECUTE_TRADE_SQL = """
+CREATE OR REPLACE FUNCTION events_execute_trade(
+    p_user_id integer, p_event_id integer, p_outcome boolean, p_buy boolean,
+    p_price integer, p_quantity integer, p_price_limit integer,
+    OUT trade_status text,
+    OUT tx_quoted_price integer,
+    OUT ev_id integer,
+    OUT ev_buy_for_price integer,
+    OUT ev_buy_against_price integer,
+    OUT ev_sell_for_price integer,
+    OUT ev_sell_against_price integer,
+    OUT ev_q_for integer,
+    OUT ev_q_against integer,
+    OUT ev_turnover integer,
+    OUT bt_id integer,
+    OUT bt_has integer,
+    OUT bt_bought integer,
+    OUT bt_sold integer,
+    OUT bt_bought_avg_price double precision,
+    OUT bt_sold_avg_price double precision,
+    OUT bt_rewarded_total integer,
+    OUT us_total_cash integer,
+    OUT us_portfolio_value integer,
+    OUT us_reputation numeric
+) AS $$
+DECLARE
+    ev events_event%ROWTYPE;
+    bt events_bet%ROWTYPE;
+    us accounts_userprofile%ROWTYPE;
+    prices record;
+    current_price integer;
+    tx_type integer;
+    delta integer;
+    new_q_for integer;
+    new_q_against integer;
+    total integer;
+BEGIN
+    SELECT * INTO ev FROM events_event WHERE id = p_event_id FOR UPDATE;
+    IF NOT FOUND THEN
+        trade_status := 'NONEXISTANT_EVENT';
+        RETURN;
+    END IF;
+
+    IF ev.outcome <> 1 THEN
+        trade_status := 'EVENT_NOT_IN_PROGRESS';
+        RETURN;
+    END IF;
+
+    IF p_buy AND p_outcome THEN
+        current_price := ev.current_buy_for_price;
+        tx_type := 1;
+    ELSIF p_buy THEN
+        current_price := ev.current_buy_against_price;
+        tx_type := 3;
+    ELSIF p_outcome THEN
+        current_price := ev.current_sell_for_price;
+        tx_type := 2;
+    ELSE
+        current_price := ev.current_sell_against_price;
+        tx_type := 4;
+    END IF;
+    tx_quoted_price := current_price;
+
+    SELECT * INTO bt FROM events_bet
+        WHERE user_id = p_user_id AND event_id = p_event_id AND outcome = p_outcome
+        FOR UPDATE;
+    IF NOT FOUND THEN
+        -- version has no database default, Django drops it after adding the column in 0004
+        INSERT INTO events_bet (user_id, event_id, outcome, has, bought, sold,
+                                bought_avg_price, sold_avg_price, rewarded_total, version)
+            VALUES (p_user_id, p_event_id, p_outcome, 0, 0, 0, 0, 0, 0, 0)
+            RETURNING * INTO bt;
+    END IF;
+
+    SELECT * INTO us FROM accounts_userprofile WHERE id = p_user_id FOR UPDATE;
+
+    IF p_buy THEN
+        delta := p_quantity;
+    ELSE
+        delta := -p_quantity;
+    END IF;
+
+    new_q_for := ev."Q_for";
+    new_q_against := ev."Q_against";
+    IF p_outcome THEN
+        new_q_for := new_q_for + delta;
+    ELSE
+        new_q_against := new_q_against + delta;
+    END IF;
+
+    -- the same as LMSRMarket.cost_of, see events_lmsr_cost_cents
+    total := events_lmsr_cost_cents(new_q_for, new_q_against, ev."B") -
+             events_lmsr_cost_cents(ev."Q_for", ev."Q_against", ev."B");
+    IF NOT p_buy THEN
+        total := -total;
+    END IF;
+
+    -- without a limit the next share has to cost exactly p_price, with one the trade
+    -- is filled whenever the price per share is within it
+    IF NOT p_buy AND bt.has < p_quantity THEN
+        trade_status := 'INSUFFICIENT_BETS';
+    ELSIF (p_price_limit IS NULL AND current_price IS DISTINCT FROM p_price)
+       OR (p_price_limit IS NOT NULL AND p_buy AND total > p_price_limit * p_quantity)
+       OR (p_price_limit IS NOT NULL AND NOT p_buy AND total < p_price_limit * p_quantity) THEN
+        trade_status := 'PRICE_MISMATCH';
+    ELSIF p_buy AND us.total_cash < total THEN
+        trade_status := 'INSUFFICIENT_CASH';
+    ELSE
+        trade_status := 'OK';
+
+        INSERT INTO events_transaction (user_id, event_id, type, date, quantity, price)
+            VALUES (p_user_id, p_event_id, tx_type, now(), p_quantity, round(total::numeric / p_quantity));
+
+        IF p_buy THEN
+            UPDATE events_bet SET
+                bought_avg_price = (bought_avg_price * bought + total) / (bought + p_quantity),
+                has = has + p_quantity,
+                bought = bought + p_quantity
+                WHERE id = bt.id RETURNING * INTO bt;
+            UPDATE accounts_userprofile SET total_cash = total_cash - total
+                WHERE id = p_user_id RETURNING * INTO us;
+        ELSE
+            UPDATE events_bet SET
+                sold_avg_price = (sold_avg_price * sold + total) / (sold + p_quantity),
+                has = has - p_quantity,
+                sold = sold + p_quantity
+                WHERE id = bt.id RETURNING * INTO bt;
+            UPDATE accounts_userprofile SET total_cash = total_cash + total
+                WHERE id = p_user_id RETURNING * INTO us;
+        END IF;
+
+        SELECT * INTO prices FROM events_lmsr_prices(new_q_for, new_q_against, ev."B");
+        UPDATE events_event SET
+            "Q_for" = new_q_for,
+            "Q_against" = new_q_against,
+            current_buy_for_price = prices.buy_for,
+            current_buy_against_price = prices.buy_against,
+            current_sell_for_price = prices.sell_for,
+            current_sell_against_price = prices.sell_against,
+            turnover = turnover + CASE WHEN p_buy THEN p_quantity ELSE 0 END
+            WHERE id = p_event_id RETURNING * INTO ev;
+    END IF;
+
+    ev_id := ev.id;
+    ev_buy_for_price := ev.current_buy_for_price;
+    ev_buy_against_price := ev.current_buy_against_price;
+    ev_sell_for_price := ev.current_sell_for_price;
+    ev_sell_against_price := ev.current_sell_against_price;
+    ev_q_for := ev."Q_for";
+    ev_q_against := ev."Q_against";
+    ev_turnover := ev.turnover;
+
+    bt_id := bt.id;
+    bt_has := bt.has;
+    bt_bought := bt.bought;
+    bt_sold := bt.sold;
+    bt_bought_avg_price := bt.bought_avg_price;
+    bt_sold_avg_price := bt.sold_avg_price;
+    bt_rewarded_total := bt.rewarded_total;
+
+    us_total_cash := us.total_cash;
+    us_portfolio_value := us.portfolio_value;
+    us_reputation := us.reputation;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0010_transaction_market_trade_id'),
+    ]
+
+    operations = [
+        migrations.RunSQL(LMSR_COST_SQL, PREVIOUS_LMSR_COST_SQL),
+        migrations.RunSQL(LMSR_COST_CENTS_SQL,
+                          "DROP FUNCTION events_lmsr_cost_cents(integer, integer, double precision);"),
+        migrations.RunSQL(LMSR_PRICES_SQL, PREVIOUS_LMSR_PRICES_SQL),
+        migrations.RunSQL(EXECUTE_TRADE_SQL, PREVIOUS_EXECUTE_TRADE_SQL),
+    ]
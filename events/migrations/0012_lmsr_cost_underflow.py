@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import models, migrations
+
+
+PREVIOUS_LMSR_COST_SQL = import_module('events.migrations.0011_lmsr_log_sum_exp').LMSR_COST_SQL
+
+# exp() of double precision raises an underflow error instead of returning 0 past
+# -745; ln(1 + e^-700) is 0 in double precision already, as it is in events.lmsr
+LMSR_COST_SQL = """
+CREATE OR REPLACE FUNCTION events_lmsr_cost(q_for integer, q_against integer, b double precision)
+RETURNS double precision AS $$
+    SELECT greatest(q_for, q_against) + b * ln(1 + CASE
+        WHEN abs(q_for - q_against) / b > 700 THEN 0
+        ELSE exp(-abs(q_for - q_against) / b)
+    END);
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0011_lmsr_log_sum_exp'),
+    ]
+
+    operations = [
+        migrations.RunSQL(LMSR_COST_SQL, PREVIOUS_LMSR_COST_SQL),
+    ]
@@ -3,22 +3,22 @@
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 from django.template.defaultfilters import slugify
 from unidecode import unidecode
 
-from math import exp
-
 from bladepolska.snapshots import SnapshotAddon
 from bladepolska.site import current_domain
 from .exceptions import NonexistantEvent, PriceMismatch, EventNotInProgress, \
     UnknownOutcome, InsufficientCash, InsufficientBets
+from .lmsr import LMSRMarket
 
 from politikon.choices import Choices
 from .managers import EventManager, BetManager, TransactionManager
 
-from .managers import EventManager, BetManager, TransactionManager
+from .managers import EventManager, BetManager, TransactionManager, OutboxMessageManager
 
 class Event(models.Model):
 
@@ -53,6 +53,7 @@ class Event(models.Model):
 
     is_featured = models.BooleanField(u"featured", default=False)
     is_front = models.BooleanField(u"front", default=False)
+    is_hot = models.BooleanField(u"gorący rynek (transakcje przez kolejkę)", default=False)
     outcome = models.PositiveIntegerField(u"rozstrzygnięcie", choices=EVENT_OUTCOME_CHOICES, default=1)
 
     created_date = models.DateTimeField(auto_now_add=True)
@@ -70,11 +71,17 @@ class Event(models.Model):
     Q_against = models.IntegerField(u"zakładów na NIE", default=0)
     turnover = models.IntegerField(u"obrót", default=0, db_index=True)
 
+    # price changes of the YES shares, kept up to date by events.price_changes; the 24h ones
+    # are price_change and absolute_price_change, indexed for the 'changed' listing
     absolute_price_change = models.IntegerField(u"zmiana ceny (wartość absolutna)", db_index=True, default=0)
     price_change = models.IntegerField(u"zmiana ceny", default=0)
+    price_change_1h = models.IntegerField(u"zmiana ceny w ciągu godziny", default=0)
+    price_change_7d = models.IntegerField(u"zmiana ceny w ciągu tygodnia", default=0)
 
     B = models.FloatField(u"stała B", default=5)
 
+    version = models.PositiveIntegerField(u"wersja", default=0)
+
     def __unicode__(self):
         return self.title
 
@@ -127,33 +134,23 @@ class Event(models.Model):
 
         self.recalculate_prices()
 
-    def increment_turnover(self, by_amount):
-        self.turnover += by_amount;
-
-    def recalculate_prices(self):
-        factor = 100.
-
-        B = self.B
+    def price_for_quantity(self, outcome, quantity, direction='BUY'):
+        """ Total price of `quantity` shares, see LMSRMarket.cost_of. """
+        if outcome not in BET_OUTCOMES_TO_QUANTITY_ATTR:
+            raise UnknownOutcome()
 
-        Q_for = self.Q_for
-        Q_against = self.Q_against
-        Q_for_sell = max(0, Q_for - 1)
-        Q_against_sell = max(0, Q_against - 1)
+        return self.market.cost_of(outcome, quantity, direction)
 
-        e_for_buy = exp(Q_for / B)
-        e_against_buy = exp(Q_against / B)
-        e_for_sell = exp(Q_for_sell / B)
-        e_against_sell = exp(Q_against_sell / B)
+    def increment_turnover(self, by_amount):
+        self.turnover += by_amount;
 
-        buy_for_price = e_for_buy / float(e_for_buy + e_against_buy)
-        buy_against_price = e_against_buy / float(e_for_buy + e_against_buy)
-        sell_for_price = e_for_sell / float(e_for_sell + e_against_buy)
-        sell_against_price = e_against_sell / float(e_for_buy + e_against_sell)
+    @property
+    def market(self):
+        return LMSRMarket(self.Q_for, self.Q_against, self.B)
 
-        self.current_buy_for_price = round(factor * buy_for_price,0)
-        self.current_buy_against_price = round(factor * buy_against_price,0)
-        self.current_sell_for_price = round(factor * sell_for_price,0)
-        self.current_sell_against_price = round(factor * sell_against_price,0)
+    def recalculate_prices(self):
+        self.current_buy_for_price, self.current_buy_against_price, \
+            self.current_sell_for_price, self.current_sell_against_price = self.market.prices()
 
     def save(self, **kwargs):
         if not self.id:
@@ -194,6 +191,8 @@ class Bet(models.Model):
     sold_avg_price = models.FloatField(u"sprzedane po średniej cenie", default=0, null=False)
     rewarded_total = models.IntegerField(u"nagroda za wynik", default=0, null=False)
 
+    version = models.PositiveIntegerField(u"wersja", default=0)
+
     @property
     def bet_dict(self):
         return {
@@ -233,6 +232,37 @@ class Transaction(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     quantity = models.PositiveIntegerField(u"ilość", default=1)
     price = models.IntegerField(u"cena jednostkowa", default=0, null=False)
+    # set for trades executed in Redis, so that a batch is never written back twice
+    market_trade_id = models.BigIntegerField(u"identyfikator transakcji w Redis", null=True, unique=True,
+                                             editable=False)
 
     def __unicode__(self):
         return "%s przez %s" % (self.TRANSACTION_TYPE_CHOICES[self.type].label, self.user)
+
+
+class OutboxMessage(models.Model):
+    """
+    A realtime message saved in the same transaction as the change it announces and
+    published after the commit by events.outbox.deliver.
+    """
+    objects = OutboxMessageManager()
+
+    channel = models.CharField(u"kanał", max_length=255)
+    message = models.TextField(u"wiadomość (JSON)")
+    created_date = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(u"nieudane próby wysłania", default=0)
+    next_attempt_date = models.DateTimeField(u"data następnej próby", default=timezone.now, db_index=True)
+
+    def __unicode__(self):
+        return u"wiadomość na %s z %s" % (self.channel, self.created_date)
+
+
+EVENT_OUTCOME_CHOICES = Event.EVENT_OUTCOME_CHOICES
+EVENT_OUTCOMES_DICT = dict((choice.name, choice.value) for choice in EVENT_OUTCOME_CHOICES._choices)
+
+BET_OUTCOMES_DICT = dict((choice.name, choice.value) for choice in Bet.BET_OUTCOME_CHOICES._choices)
+BET_OUTCOMES_INV_DICT = dict((value, name) for name, value in BET_OUTCOMES_DICT.items())
+BET_OUTCOMES_TO_PRICE_ATTR = Bet.BET_OUTCOMES_TO_PRICE_ATTR
+BET_OUTCOMES_TO_QUANTITY_ATTR = Bet.BET_OUTCOMES_TO_QUANTITY_ATTR
+
+TRANSACTION_TYPES_DICT = dict((choice.name, choice.value) for choice in Transaction.TRANSACTION_TYPE_CHOICES._choices)
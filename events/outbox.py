@@ -0,0 +1,215 @@
+import json
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from bladepolska import realtime
+from bladepolska.redis_connection import RedisConnection
+from .stats import incr_trade_stat
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+CHANNEL_SLOT_KEY = 'broadcast:channel:%s'
+GLOBAL_SLOT_KEY = 'broadcast:global:%d'
+DELIVER_LOCK_KEY = 'broadcast:deliver:lock'
+
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _lock_delivery(token):
+    """ Only one publisher delivers at a time, the lock expires with the lease of its batch. """
+    try:
+        return bool(RedisConnection.redis().set(DELIVER_LOCK_KEY, token, nx=True, ex=settings.OUTBOX_LEASE))
+    except redis.RedisError:
+        logger.warning("Could not lock outbox delivery")
+        return True
+
+
+def _unlock_delivery(token):
+    try:
+        RedisConnection.redis().eval(UNLOCK_SCRIPT, 1, DELIVER_LOCK_KEY, token)
+    except redis.RedisError:
+        pass
+
+
+def _take_channel_slot(channel):
+    """ At most one broadcast per channel every OUTBOX_CHANNEL_WINDOW seconds. """
+    try:
+        return bool(RedisConnection.redis().set(CHANNEL_SLOT_KEY % channel, 1, nx=True,
+                                                px=int(settings.OUTBOX_CHANNEL_WINDOW * 1000)))
+    except redis.RedisError:
+        logger.warning("Could not rate limit broadcasts to %s" % channel)
+        return True
+
+
+def _channel_slot_wait(channel):
+    """ Seconds until a broadcast to the channel is allowed again. """
+    try:
+        return max(RedisConnection.redis().pttl(CHANNEL_SLOT_KEY % channel), 0) / 1000.
+    except redis.RedisError:
+        return settings.OUTBOX_CHANNEL_WINDOW
+
+
+def _release_channel_slot(channel):
+    try:
+        RedisConnection.redis().delete(CHANNEL_SLOT_KEY % channel)
+    except redis.RedisError:
+        pass
+
+
+def _take_global_slot():
+    """ At most OUTBOX_GLOBAL_RATE broadcasts per second over all channels. """
+    key = GLOBAL_SLOT_KEY % int(time.time())
+    try:
+        r = RedisConnection.redis()
+        with r.pipeline() as pipe:
+            sent, _ = pipe.incr(key).expire(key, 2).execute()
+        return sent <= settings.OUTBOX_GLOBAL_RATE
+    except redis.RedisError:
+        logger.warning("Could not rate limit broadcasts")
+        return True
+
+
+def coalesce(messages):
+    """
+    Merges event updates into one message with the latest state of every event and
+    the number of trades behind them. Other messages are kept as they are.
+    """
+    events = OrderedDict()
+    trades = 0
+    others = []
+    for message in messages:
+        if set(message) <= {'updates', 'trades'} and message.get('updates', {}).keys() == ['events']:
+            for event_dict in message['updates']['events']:
+                events[event_dict['event_id']] = event_dict
+            trades += message.get('trades', 0)
+        else:
+            others.append(message)
+
+    if not events:
+        return others
+
+    return [{'updates': {'events': events.values()}, 'trades': trades}] + others
+
+
+def claim(batch_size):
+    """
+    Leases a batch of due messages, oldest first, for OUTBOX_LEASE seconds and commits,
+    so that concurrent publishers skip them while they are being sent. Messages of a
+    publisher that died are sent again once their lease runs out.
+    """
+    from .models import OutboxMessage
+
+    with transaction.atomic():
+        messages = list(OutboxMessage.objects.due().select_for_update().order_by('id')[:batch_size])
+        OutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            next_attempt_date=timezone.now() + timedelta(seconds=settings.OUTBOX_LEASE))
+    return messages
+
+
+def deliver(batch_size=None):
+    """
+    Publishes one batch of due outbox messages, claimed beforehand so that no database
+    transaction is held open while they are sent. Messages of one channel are coalesced
+    into a single broadcast, sent at most once per OUTBOX_CHANNEL_WINDOW. Messages of a
+    channel that has to wait are put off until it may be broadcast to again, so that
+    they do not take the places of other channels' messages in the batches meanwhile,
+    and are then merged with whatever came in. Published messages are deleted, failed
+    ones are retried with exponential backoff and dropped, with an error logged, after
+    OUTBOX_MAX_ATTEMPTS.
+    Publishers take turns, as two of them sending batches of one channel at once could
+    broadcast an older state of an event after a newer one.
+    Returns the number of messages handled, 0 while another publisher is delivering.
+    """
+    if batch_size is None:
+        batch_size = settings.OUTBOX_BATCH_SIZE
+
+    token = uuid.uuid4().hex
+    if not _lock_delivery(token):
+        return 0
+    try:
+        return _deliver(batch_size)
+    finally:
+        _unlock_delivery(token)
+
+
+def _deliver(batch_size):
+    from .models import OutboxMessage
+
+    channels = OrderedDict()
+    for message in claim(batch_size):
+        channels.setdefault(message.channel, []).append(message)
+
+    broadcasts = []
+    # [(messages, seconds until they may be sent), ...]
+    waiting = []
+    throttled = False
+    for channel, messages in channels.items():
+        if throttled:
+            waiting.append((messages, 1 - time.time() % 1))
+            continue
+        if not _take_channel_slot(channel):
+            incr_trade_stat('broadcast', 'throttled_channel')
+            waiting.append((messages, _channel_slot_wait(channel)))
+            continue
+        if not _take_global_slot():
+            _release_channel_slot(channel)
+            incr_trade_stat('broadcast', 'throttled_global')
+            waiting.append((messages, 1 - time.time() % 1))
+            throttled = True
+            continue
+
+        broadcasts.append((channel, messages, coalesce([json.loads(message.message) for message in messages])))
+
+    # all broadcasts of the batch are sent at once, pipelined by backends that can
+    results = iter(realtime.publish_many([(channel, payload) for channel, messages, payloads in broadcasts
+                                          for payload in payloads]))
+
+    handled = 0
+    sent = []
+    dropped = []
+    for channel, messages, payloads in broadcasts:
+        handled += len(messages)
+        if all([next(results) for payload in payloads]):
+            sent.extend(message.id for message in messages)
+            incr_trade_stat('broadcast', 'messages', len(messages))
+            incr_trade_stat('broadcast', 'sent', len(payloads))
+            continue
+
+        incr_trade_stat('broadcast', 'failed')
+        logger.warning("Publishing %d outbox messages to %s failed" % (len(messages), channel))
+        for message in messages:
+            message.attempts += 1
+            if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                logger.error("Dropping outbox message #%d to %s after %d attempts: %s" % (
+                    message.id, channel, message.attempts, message.message))
+                dropped.append(message.id)
+                continue
+            backoff = min(2 ** message.attempts, settings.OUTBOX_MAX_BACKOFF)
+            message.next_attempt_date = timezone.now() + timedelta(seconds=backoff)
+            message.save(update_fields=['attempts', 'next_attempt_date'])
+
+    OutboxMessage.objects.filter(id__in=sent + dropped).delete()
+    for messages, wait in waiting:
+        OutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            next_attempt_date=timezone.now() + timedelta(seconds=wait))
+
+    return handled
+
+
+def deliver_all():
+    while deliver() == settings.OUTBOX_BATCH_SIZE:
+        pass
@@ -0,0 +1,77 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+
+MARKET_VERSION_KEY = 'market:version'
+
+
+def page_cache():
+    return caches[settings.PAGE_CACHE_ALIAS]
+
+
+def market_version():
+    """ Part of every page cache key, bumped whenever prices or events change. """
+    cache = page_cache()
+    version = cache.get(MARKET_VERSION_KEY)
+    if version is None:
+        # not 1, so that an evicted counter does not come back to versions still cached
+        cache.add(MARKET_VERSION_KEY, int(time.time()), None)
+        version = cache.get(MARKET_VERSION_KEY, 0)
+    return version
+
+
+def bump_market_version():
+    """
+    Drops all cached pages. A page rendered by a request racing the change may still be
+    cached under the new version, so pages also expire after PAGE_CACHE_TIMEOUT seconds.
+    """
+    cache = page_cache()
+    try:
+        cache.incr(MARKET_VERSION_KEY)
+    except ValueError:
+        cache.add(MARKET_VERSION_KEY, int(time.time()), None)
+
+
+def anonymous_page_cache(view):
+    """
+    Caches the pages of a view, function or class based, for anonymous GET requests, for
+    at most PAGE_CACHE_TIMEOUT seconds or until bump_market_version().
+    """
+    def cached(request, call):
+        if not settings.PAGE_CACHE_ENABLED or request.method not in ('GET', 'HEAD') \
+                or request.user.is_authenticated():
+            return call()
+
+        key = 'page:%s:%s' % (market_version(), hashlib.md5(request.get_full_path()).hexdigest())
+        cache = page_cache()
+        page = cache.get(key)
+        if page is not None:
+            content, content_type = page
+            return HttpResponse(content, content_type=content_type)
+
+        response = call()
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        if response.status_code == 200 and not response.cookies:
+            cache.set(key, (response.content, response['Content-Type']), settings.PAGE_CACHE_TIMEOUT)
+        return response
+
+    if isinstance(view, type):
+        dispatch = view.dispatch
+
+        def cached_dispatch(self, request, *args, **kwargs):
+            return cached(request, lambda: dispatch(self, request, *args, **kwargs))
+
+        view.dispatch = cached_dispatch
+        return view
+
+    @wraps(view)
+    def cached_view(request, *args, **kwargs):
+        return cached(request, lambda: view(request, *args, **kwargs))
+
+    return cached_view
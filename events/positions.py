@@ -0,0 +1,207 @@
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from threading import local
+
+import redis
+from django.conf import settings
+
+from bladepolska.redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+POSITIONS_KEY = 'positions:%d'
+# present once the hash holds all of the user's positions, not only those traded since
+BUILT_FIELD = 'built'
+# ids of the users holding shares of an event's outcome, the same positions indexed by event
+HOLDERS_KEY = 'holders:%d:%d'
+# set by manage.py rebuild_positions once all holder sets are complete
+HOLDERS_BUILT_KEY = 'holders:built'
+
+_deferred = local()
+
+
+def _field(event_id, outcome):
+    return '%d:%d' % (event_id, int(outcome))
+
+
+def _load(user_id):
+    from .models import Bet
+
+    return Bet.objects.filter(user_id=user_id, has__gt=0).values_list('event_id', 'outcome', 'has',
+                                                                       'bought_avg_price')
+
+
+def rebuild_positions(user_id, positions=None):
+    """
+    Replaces the user's positions hash with the user's bets in the database. It expires
+    after POSITIONS_TIMEOUT, so that a rebuild racing a trade does not last forever.
+    """
+    if positions is None:
+        positions = _load(user_id)
+    key = POSITIONS_KEY % user_id
+    with RedisConnection.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, BUILT_FIELD, 1)
+        for event_id, outcome, has, avg_price in positions:
+            pipe.hset(key, _field(event_id, outcome), '%d:%r' % (has, avg_price))
+        pipe.expire(key, settings.POSITIONS_TIMEOUT)
+        pipe.execute()
+
+
+def rebuild_holders(holders):
+    """ Replaces all holder sets with holders, {(event_id, outcome): [user_id, ...]}. """
+    r = RedisConnection.redis()
+    with RedisConnection.pipeline() as pipe:
+        pipe.delete(HOLDERS_BUILT_KEY)
+        for key in r.scan_iter(HOLDERS_KEY.replace('%d', '*')):
+            pipe.delete(key)
+        for (event_id, outcome), user_ids in holders.items():
+            pipe.sadd(HOLDERS_KEY % (event_id, outcome), *user_ids)
+        pipe.set(HOLDERS_BUILT_KEY, 1)
+        pipe.execute()
+
+
+@contextmanager
+def deferred_position_updates():
+    """
+    Within the block update_position only remembers the last state of each traded bet.
+    They are written when the block exits without an exception, so enter it before the
+    transaction of the trades and Redis only ever gets committed positions. Positions
+    passed to discard_position_updates, of trades rolled back to a savepoint, are
+    corrected from the database instead. Nested blocks join the outermost one.
+    """
+    if hasattr(_deferred, 'bets'):
+        yield
+        return
+
+    _deferred.bets = OrderedDict()
+    _deferred.discarded = set()
+    try:
+        yield
+        bets = _deferred.bets.values()
+        discarded = _deferred.discarded
+    finally:
+        del _deferred.bets, _deferred.discarded
+
+    for bet in bets:
+        if (bet.user_id, bet.event_id) not in discarded:
+            _write_position(bet)
+
+    event_ids = defaultdict(set)
+    for user_id, event_id in discarded:
+        event_ids[user_id].add(event_id)
+    for user_id, user_event_ids in event_ids.items():
+        invalidate_positions(user_id, user_event_ids)
+
+
+def discard_position_updates(user_id, event_id):
+    """ Within deferred_position_updates, for a trade rolled back to a savepoint after after_trade. """
+    _deferred.discarded.add((user_id, event_id))
+
+
+def update_position(bet, deferred=True):
+    """
+    Called by BetManager.after_trade with the bet as the trade left it. Written at the
+    end of deferred_position_updates unless not `deferred`, for trades already committed.
+    """
+    if deferred and hasattr(_deferred, 'bets'):
+        _deferred.bets[(bet.user_id, bet.event_id, bet.outcome)] = bet
+        return
+    _write_position(bet)
+
+
+def _write_position(bet):
+    key = POSITIONS_KEY % bet.user_id
+    field = _field(bet.event_id, bet.outcome)
+    holders_key = HOLDERS_KEY % (bet.event_id, bet.outcome)
+    try:
+        with RedisConnection.pipeline() as pipe:
+            if bet.has > 0:
+                pipe.hset(key, field, '%d:%r' % (bet.has, bet.bought_avg_price))
+                pipe.sadd(holders_key, bet.user_id)
+            else:
+                pipe.hdel(key, field)
+                pipe.srem(holders_key, bet.user_id)
+            pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not update the positions of user %d, dropping them" % bet.user_id)
+        invalidate_positions(bet.user_id, [bet.event_id])
+
+
+def invalidate_positions(user_id, event_ids=()):
+    """
+    For positions that may be wrong: the user's hash is rebuilt on the next read and the
+    holder sets of event_ids are corrected from the database.
+    """
+    from .models import Bet
+
+    held = set(Bet.objects.filter(user_id=user_id, event_id__in=event_ids, has__gt=0).values_list(
+        'event_id', 'outcome')) if event_ids else set()
+    try:
+        with RedisConnection.pipeline() as pipe:
+            pipe.delete(POSITIONS_KEY % user_id)
+            for event_id in event_ids:
+                for outcome in (True, False):
+                    if (event_id, outcome) in held:
+                        pipe.sadd(HOLDERS_KEY % (event_id, outcome), user_id)
+                    else:
+                        pipe.srem(HOLDERS_KEY % (event_id, outcome), user_id)
+            pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not drop the positions of user %d" % user_id)
+
+
+def get_positions(user_id, event_ids):
+    """ {event_id: [(outcome, has, avg_price), ...]} of the user's bets with shares, in one HMGET. """
+    fields = [BUILT_FIELD] + [_field(event_id, outcome) for event_id in event_ids for outcome in (True, False)]
+    key = POSITIONS_KEY % user_id
+    try:
+        values = RedisConnection.redis().hmget(key, fields)
+        if values[0] is None:
+            rebuild_positions(user_id)
+            values = RedisConnection.redis().hmget(key, fields)
+    except redis.RedisError:
+        event_ids = set(event_ids)
+        positions = {}
+        for event_id, outcome, has, avg_price in _load(user_id):
+            if event_id in event_ids:
+                positions.setdefault(event_id, []).append((outcome, has, avg_price))
+        return positions
+
+    positions = {}
+    for field, value in zip(fields[1:], values[1:]):
+        if value is not None:
+            event_id, outcome = field.split(':')
+            has, avg_price = value.split(':')
+            positions.setdefault(int(event_id), []).append((outcome == '1', int(has), float(avg_price)))
+    return positions
+
+
+def friend_holders(user, event_ids):
+    """
+    {(event_id, outcome): set of user ids} of the user's friends holding shares of the
+    events: one SINTER of the cached friend set and the holder set per event and outcome.
+    Falls back to the database until manage.py rebuild_positions built the holder sets.
+    """
+    from .models import Bet
+
+    keys = [(event_id, outcome) for event_id in event_ids for outcome in (True, False)]
+    try:
+        if RedisConnection.redis().exists(HOLDERS_BUILT_KEY):
+            friends_key = user.friends_key()
+            with RedisConnection.pipeline() as pipe:
+                for event_id, outcome in keys:
+                    pipe.sinter(friends_key, HOLDERS_KEY % (event_id, outcome))
+                results = pipe.execute()
+            return dict((key, set(int(user_id) for user_id in user_ids))
+                        for key, user_ids in zip(keys, results) if user_ids)
+    except redis.RedisError:
+        logger.warning("Could not read the holder sets, falling back to the database")
+
+    holders = {}
+    for user_id, event_id, outcome in Bet.objects.filter(user_id__in=user.friends_ids_set, event_id__in=event_ids,
+                                                         has__gt=0).values_list('user_id', 'event_id', 'outcome'):
+        holders.setdefault((event_id, outcome), set()).add(user_id)
+    return holders
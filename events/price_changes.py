@@ -0,0 +1,83 @@
+import time
+
+from bladepolska.redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# (window, Event fields, its length and the time between the reference prices kept, in seconds)
+WINDOWS = (
+    ('1h', ('price_change_1h',), 60 * 60, 5 * 60),
+    ('24h', ('price_change', 'absolute_price_change'), 24 * 60 * 60, 60 * 60),
+    ('7d', ('price_change_7d',), 7 * 24 * 60 * 60, 6 * 60 * 60),
+)
+
+# list of reference prices of an event, newest first, one per step of the window
+HISTORY_KEY = 'price_history:%s:%d'
+# taken with SET NX by the one tick pushing the reference prices of a window's step
+STEP_KEY = 'price_history:%s:step:%d'
+
+
+def _references(event_ids):
+    """ {event_id: {window: oldest reference price or None}}, read in one round trip. """
+    with RedisConnection.pipeline() as pipe:
+        for event_id in event_ids:
+            for window, fields, length, step in WINDOWS:
+                pipe.lindex(HISTORY_KEY % (window, event_id), -1)
+        prices = iter(pipe.execute())
+
+    return dict((event_id, dict((window, next(prices)) for window, fields, length, step in WINDOWS))
+                for event_id in event_ids)
+
+
+def price_changes(price, references):
+    """ Event field values for the current YES price, given the reference price of each window. """
+    changes = {}
+    for window, fields, length, step in WINDOWS:
+        reference = references.get(window)
+        change = price - int(reference) if reference is not None else 0
+        changes[fields[0]] = change
+        if window == '24h':
+            changes['absolute_price_change'] = abs(change)
+    return changes
+
+
+def tick(now=None):
+    """
+    Pushes the current price of every open event as a new reference price of each window
+    whose step has passed, drops the references older than the window and brings every
+    event's changes up to date, writing only those that changed. Trades leave the changes
+    alone, so they are as fresh as the schedule of events.tasks.tick_price_changes.
+    """
+    from .models import Event
+
+    now = now or time.time()
+    events = list(Event.objects.ongoing_only_queryset().values_list(
+        'id', 'current_buy_for_price', *[field for window, fields, length, step in WINDOWS for field in fields]))
+    if not events:
+        return
+
+    r = RedisConnection.redis()
+    with RedisConnection.pipeline() as pipe:
+        for window, fields, length, step in WINDOWS:
+            # concurrent ticks push each step only once
+            if not r.set(STEP_KEY % (window, int(now // step)), 1, nx=True, ex=2 * step):
+                continue
+            for event in events:
+                key = HISTORY_KEY % (window, event[0])
+                pipe.lpush(key, event[1])
+                # the oldest kept is the price of one window ago
+                pipe.ltrim(key, 0, length // step)
+                pipe.expire(key, length + 2 * step)
+        pipe.execute()
+
+    references = _references([event[0] for event in events])
+    field_names = [field for window, fields, length, step in WINDOWS for field in fields]
+    updated = 0
+    for event in events:
+        changes = price_changes(event[1], references[event[0]])
+        if any(changes[field] != value for field, value in zip(field_names, event[2:])):
+            Event.objects.filter(id=event[0]).update(**changes)
+            updated += 1
+    return updated
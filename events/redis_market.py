@@ -0,0 +1,466 @@
+import json
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib import auth
+from django.db import transaction
+from django.db.models import F
+from django.utils.translation import ugettext as _
+
+from bladepolska.redis_connection import RedisConnection
+from .exceptions import NonexistantEvent, PriceMismatch, EventNotInProgress, \
+    UnknownOutcome, InsufficientCash, InsufficientBets
+from .stats import incr_trade_stat
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+EVENT_KEY = 'market:event:%d'
+USER_KEY = 'market:user:%d'
+BET_KEY = 'market:bet:%d:%d:%d'
+WRITE_BEHIND_KEY = 'market:writebehind'
+WRITE_BEHIND_PROCESSING_KEY = 'market:writebehind:processing'
+# held by the one flush running at a time, expires if its process dies
+FLUSH_LOCK_KEY = 'market:writebehind:lock'
+# sequence of the trades executed in Redis, saved as Transaction.market_trade_id
+TRADE_ID_KEY = 'market:trade_id'
+
+EVENT_FIELDS = ['id', 'outcome', 'B', 'Q_for', 'Q_against', 'turnover', 'current_buy_for_price',
+                'current_buy_against_price', 'current_sell_for_price', 'current_sell_against_price']
+BET_FIELDS = ['id', 'has', 'bought', 'sold', 'bought_avg_price', 'sold_avg_price', 'rewarded_total']
+FLOAT_FIELDS = ['B', 'bought_avg_price', 'sold_avg_price']
+
+
+# Loads a hash only if nobody else has loaded it in the meantime.
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV))
+end
+return 1
+"""
+
+# Credits cash to a user loaded into Redis and queues the top up to be written behind,
+# like a trade but with no event.
+CREDIT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'LOAD_USER'}
+end
+local amount = tonumber(ARGV[2])
+local total_cash = redis.call('HINCRBY', KEYS[1], 'total_cash', amount)
+redis.call('RPUSH', KEYS[2], cjson.encode({
+    trade_id = redis.call('INCR', KEYS[3]),
+    user_id = tonumber(ARGV[1]),
+    type = tonumber(ARGV[3]),
+    quantity = 1,
+    price = amount,
+    cash = amount,
+    given = amount
+}))
+return {'OK', total_cash}
+"""
+
+# events.lmsr.LMSRMarket.cost_cents, the cost function rounded to cents, without overflow.
+COST_CENTS_LUA = """
+local function cost_cents(q_for, q_against, b)
+    local c = math.max(q_for, q_against) + b * math.log(1 + math.exp(-math.abs(q_for - q_against) / b))
+    return math.floor(100 * c + 0.5)
+end
+"""
+
+# Mirrors BetManager.buy_a_bet / sell_a_bet and events.lmsr.LMSRMarket: totals and prices
+# are differences of cost_cents.
+TRADE_SCRIPT = COST_CENTS_LUA + """
+local function hash(key)
+    local flat = redis.call('HGETALL', key)
+    local result = {}
+    for i = 1, #flat, 2 do
+        result[flat[i]] = flat[i + 1]
+    end
+    return result
+end
+
+local function round(x)
+    return math.floor(x + 0.5)
+end
+
+local event_key, user_key, bet_key, queue_key, trade_id_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local outcome_yes = ARGV[3] == '1'
+local buy = ARGV[4] == '1'
+local price = tonumber(ARGV[5])
+local quantity = tonumber(ARGV[6])
+local price_limit = tonumber(ARGV[8])
+
+if redis.call('EXISTS', event_key) == 0 then
+    return {'LOAD_EVENT'}
+end
+if redis.call('EXISTS', user_key) == 0 then
+    return {'LOAD_USER'}
+end
+if redis.call('EXISTS', bet_key) == 0 then
+    return {'LOAD_BET'}
+end
+
+local current_price
+
+local function reply(status)
+    return {status, redis.call('HGETALL', event_key), redis.call('HGETALL', user_key), redis.call('HGETALL', bet_key),
+            current_price}
+end
+
+local event = hash(event_key)
+if tonumber(event['outcome']) ~= 1 then
+    return {'EVENT_NOT_IN_PROGRESS'}
+end
+
+local price_field
+if buy and outcome_yes then
+    price_field = 'current_buy_for_price'
+elseif buy then
+    price_field = 'current_buy_against_price'
+elseif outcome_yes then
+    price_field = 'current_sell_for_price'
+else
+    price_field = 'current_sell_against_price'
+end
+
+current_price = tonumber(event[price_field])
+
+local b = tonumber(event['B'])
+local q_for = tonumber(event['Q_for'])
+local q_against = tonumber(event['Q_against'])
+local delta = quantity
+if not buy then
+    delta = -quantity
+end
+
+local new_q_for, new_q_against = q_for, q_against
+if outcome_yes then
+    new_q_for = q_for + delta
+else
+    new_q_against = q_against + delta
+end
+
+local bet = hash(bet_key)
+if not buy and tonumber(bet['has']) < quantity then
+    return reply('INSUFFICIENT_BETS')
+end
+
+local total = cost_cents(new_q_for, new_q_against, b) - cost_cents(q_for, q_against, b)
+if not buy then
+    total = -total
+end
+
+if price_limit == nil then
+    if current_price ~= price then
+        return reply('PRICE_MISMATCH')
+    end
+elseif (buy and total > price_limit * quantity) or (not buy and total < price_limit * quantity) then
+    return reply('PRICE_MISMATCH')
+end
+
+if buy and tonumber(redis.call('HGET', user_key, 'total_cash')) < total then
+    return reply('INSUFFICIENT_CASH')
+end
+
+if buy then
+    local bought = tonumber(bet['bought'])
+    redis.call('HMSET', bet_key,
+        'bought_avg_price', (tonumber(bet['bought_avg_price']) * bought + total) / (bought + quantity),
+        'bought', bought + quantity,
+        'has', tonumber(bet['has']) + quantity)
+    redis.call('HINCRBY', user_key, 'total_cash', -total)
+    redis.call('HINCRBY', event_key, 'turnover', quantity)
+else
+    local sold = tonumber(bet['sold'])
+    redis.call('HMSET', bet_key,
+        'sold_avg_price', (tonumber(bet['sold_avg_price']) * sold + total) / (sold + quantity),
+        'sold', sold + quantity,
+        'has', tonumber(bet['has']) - quantity)
+    redis.call('HINCRBY', user_key, 'total_cash', total)
+end
+
+local now = cost_cents(new_q_for, new_q_against, b)
+local buy_for = cost_cents(new_q_for + 1, new_q_against, b) - now
+local buy_against = cost_cents(new_q_for, new_q_against + 1, b) - now
+local sell_for, sell_against = buy_for, buy_against
+if new_q_for > 0 then
+    sell_for = now - cost_cents(new_q_for - 1, new_q_against, b)
+end
+if new_q_against > 0 then
+    sell_against = now - cost_cents(new_q_for, new_q_against - 1, b)
+end
+redis.call('HMSET', event_key,
+    'Q_for', new_q_for,
+    'Q_against', new_q_against,
+    'current_buy_for_price', buy_for,
+    'current_buy_against_price', buy_against,
+    'current_sell_for_price', sell_for,
+    'current_sell_against_price', sell_against)
+
+local cash = total
+if buy then
+    cash = -total
+end
+
+redis.call('RPUSH', queue_key, cjson.encode({
+    trade_id = redis.call('INCR', trade_id_key),
+    user_id = tonumber(ARGV[1]),
+    event_id = tonumber(ARGV[2]),
+    bet_id = tonumber(bet['id']),
+    outcome = tonumber(ARGV[3]),
+    type = tonumber(ARGV[7]),
+    quantity = quantity,
+    price = round(total / quantity),
+    cash = cash
+}))
+
+return reply('OK')
+"""
+
+# Moves a batch from the write-behind queue to the processing list, unless a previous
+# flush died half-way; then its batch is handed out again.
+CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    local batch = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #batch == 0 then
+        return batch
+    end
+    redis.call('RPUSH', KEYS[2], unpack(batch))
+    redis.call('LTRIM', KEYS[1], #batch, -1)
+end
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
+# Releases the flush lock only if it is still held under this flush's token.
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _flat_to_dict(flat):
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def _parse(state):
+    result = {}
+    for field, value in state.items():
+        if field in FLOAT_FIELDS:
+            result[field] = float(value)
+        else:
+            result[field] = int(float(value))
+    return result
+
+
+class RedisMarket(object):
+    """
+    Market engine keeping the state of traded events, users' cash and their bets in Redis.
+    Every trade is a single Lua script; Transactions and aggregates are written to
+    Postgres in batches by the flush_market_trades task.
+    """
+
+    def __init__(self):
+        self._scripts = {}
+
+    def run(self, name, source, keys, args):
+        r = RedisConnection.redis()
+        if name not in self._scripts:
+            self._scripts[name] = r.register_script(source)
+        return self._scripts[name](keys=keys, args=args, client=r)
+
+    def load_event(self, event_id):
+        from .models import Event
+
+        values = list(Event.objects.filter(id=event_id).values(*EVENT_FIELDS))
+        try:
+            values = values[0]
+        except IndexError:
+            raise NonexistantEvent(_("Requested event does not exist."))
+
+        self.load(EVENT_KEY % event_id, values)
+
+    def load_user(self, user_id):
+        values = auth.get_user_model().objects.filter(id=user_id).values('total_cash')[0]
+        self.load(USER_KEY % user_id, values)
+
+    def load_bet(self, user_id, event_id, bet_outcome):
+        from .models import Bet
+
+        bet, created = Bet.objects.get_or_create(user_id=user_id, event_id=event_id, outcome=bet_outcome)
+        self.load(BET_KEY % (user_id, event_id, bet_outcome), dict((field, getattr(bet, field)) for field in BET_FIELDS))
+
+    def load(self, key, values):
+        args = []
+        for field, value in values.items():
+            args.extend([field, value])
+        self.run('load', LOAD_SCRIPT, keys=[key], args=args)
+
+    def sync_event_settings(self, event):
+        """ Pushes admin-controlled fields of an already loaded event to Redis. """
+        key = EVENT_KEY % event.id
+        r = RedisConnection.redis()
+        if r.exists(key):
+            r.hmset(key, {'outcome': event.outcome, 'B': event.B})
+
+    def credit_user_cash(self, user_id, amount):
+        """
+        Tops up a user in Redis only; Postgres gets the cash, total_given_cash and the
+        Transaction from the flush, so a rolled back caller or a concurrent load_user
+        can't lose or double the top up.
+        """
+        from .models import Transaction
+
+        keys = [USER_KEY % user_id, WRITE_BEHIND_KEY, TRADE_ID_KEY]
+        args = [user_id, amount, Transaction.TRANSACTION_TYPE_CHOICES.TOPPED_UP_BY_APP]
+        result = self.run('credit', CREDIT_SCRIPT, keys=keys, args=args)
+        if result[0] == 'LOAD_USER':
+            self.load_user(user_id)
+            result = self.run('credit', CREDIT_SCRIPT, keys=keys, args=args)
+        return int(result[1])
+
+    def trade(self, user, event_id, for_outcome, price, quantity=1, price_limit=None, buy=True):
+        from .models import Event, Bet, Transaction, BET_OUTCOMES_DICT
+
+        if for_outcome not in BET_OUTCOMES_DICT:
+            raise UnknownOutcome()
+        bet_outcome = int(BET_OUTCOMES_DICT[for_outcome])
+        event_id = int(event_id)
+
+        if buy and for_outcome == 'YES':
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.BUY_YES
+        elif buy:
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.BUY_NO
+        elif for_outcome == 'YES':
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.SELL_YES
+        else:
+            transaction_type = Transaction.TRANSACTION_TYPE_CHOICES.SELL_NO
+
+        keys = [EVENT_KEY % event_id, USER_KEY % user.id, BET_KEY % (user.id, event_id, bet_outcome), WRITE_BEHIND_KEY,
+                TRADE_ID_KEY]
+        args = [user.id, event_id, bet_outcome, int(buy), '' if price is None else price, quantity,
+                transaction_type, '' if price_limit is None else price_limit]
+
+        loaders = {
+            'LOAD_EVENT': lambda: self.load_event(event_id),
+            'LOAD_USER': lambda: self.load_user(user.id),
+            'LOAD_BET': lambda: self.load_bet(user.id, event_id, bet_outcome),
+        }
+
+        reply = self.run('trade', TRADE_SCRIPT, keys=keys, args=args)
+        while reply[0] in loaders:
+            loaders.pop(reply[0])()
+            reply = self.run('trade', TRADE_SCRIPT, keys=keys, args=args)
+
+        status = reply[0]
+        if status == 'EVENT_NOT_IN_PROGRESS':
+            raise EventNotInProgress(_("Event is no longer in progress."))
+
+        event = Event(**_parse(_flat_to_dict(reply[1])))
+        user.total_cash = _parse(_flat_to_dict(reply[2]))['total_cash']
+        bet = Bet(user=user, event=event, outcome=bool(bet_outcome), **_parse(_flat_to_dict(reply[3])))
+
+        if status == 'PRICE_MISMATCH':
+            incr_trade_stat('redis', 'price_mismatches')
+            raise PriceMismatch(_("Price has changed."), event)
+        if status == 'INSUFFICIENT_CASH':
+            raise InsufficientCash(_("You don't have enough cash."), user)
+        if status == 'INSUFFICIENT_BETS':
+            raise InsufficientBets(_("You don't have enough shares."), bet)
+
+        if price is not None and price != int(reply[4]):
+            incr_trade_stat('redis', 'slippage_fills')
+
+        Bet.objects.after_trade(user, event, bet)
+
+        return user, event, bet
+
+    def flush(self, batch_size=None):
+        """
+        Writes one batch of trades executed in Redis to Postgres. Returns the number of
+        trades claimed, 0 when there are none or another flush is running.
+        """
+        if batch_size is None:
+            batch_size = settings.MARKET_FLUSH_BATCH_SIZE
+
+        token = uuid.uuid4().hex
+        r = RedisConnection.redis()
+        if not r.set(FLUSH_LOCK_KEY, token, nx=True, ex=settings.MARKET_FLUSH_LOCK_TIMEOUT):
+            return 0
+        try:
+            return self.write_back(batch_size)
+        finally:
+            self.run('unlock', UNLOCK_SCRIPT, keys=[FLUSH_LOCK_KEY], args=[token])
+
+    def write_back(self, batch_size):
+        """
+        Idempotent, for a batch handed out again after a flush died between its commit
+        and dropping the batch: trades already saved, by market_trade_id, are skipped.
+        Users' cash is changed by the records' amounts, not overwritten, so that it stays
+        editable in Postgres while no user is loaded; events and bets are Redis' to write.
+        Top ups (see credit_user_cash) are records with no event.
+        """
+        from .models import Event, Bet, Transaction
+
+        claimed = self.run('claim', CLAIM_SCRIPT, keys=[WRITE_BEHIND_KEY, WRITE_BEHIND_PROCESSING_KEY],
+                           args=[batch_size])
+        records = [json.loads(record) for record in claimed]
+        if not records:
+            return 0
+
+        trades = [record for record in records if record.get('event_id')]
+        event_ids = set(record['event_id'] for record in trades)
+        bet_keys = set((record['user_id'], record['event_id'], record['outcome']) for record in trades)
+
+        r = RedisConnection.redis()
+        pipe = r.pipeline(transaction=False)
+        for event_id in event_ids:
+            pipe.hgetall(EVENT_KEY % event_id)
+        for bet_key in bet_keys:
+            pipe.hgetall(BET_KEY % bet_key)
+        states = [_parse(state) for state in pipe.execute()]
+
+        event_states = states[:len(event_ids)]
+        bet_states = states[len(event_ids):]
+
+        with transaction.atomic():
+            written = set(Transaction.objects.filter(
+                market_trade_id__in=[record['trade_id'] for record in records]
+            ).values_list('market_trade_id', flat=True))
+            new_records = [record for record in records if record['trade_id'] not in written]
+
+            Transaction.objects.bulk_create([
+                Transaction(user_id=record['user_id'], event_id=record.get('event_id'), type=record['type'],
+                            quantity=record['quantity'], price=record['price'],
+                            market_trade_id=record['trade_id'])
+                for record in new_records
+            ])
+
+            cash = defaultdict(int)
+            given = defaultdict(int)
+            for record in new_records:
+                cash[record['user_id']] += record['cash']
+                given[record['user_id']] += record.get('given', 0)
+            for user_id, amount in cash.items():
+                auth.get_user_model().objects.filter(id=user_id).update(
+                    total_cash=F('total_cash') + amount, total_given_cash=F('total_given_cash') + given[user_id])
+
+            for state in event_states:
+                # outcome and B belong to the admin, see sync_event_settings
+                del state['outcome'], state['B']
+                Event.objects.filter(id=state.pop('id')).update(**state)
+            for state in bet_states:
+                del state['rewarded_total']
+                Bet.objects.filter(id=state.pop('id')).update(**state)
+
+        r.delete(WRITE_BEHIND_PROCESSING_KEY)
+
+        logger.debug("'events:redis_market:flush' wrote %d trades, %d already written." % (
+            len(new_records), len(records) - len(new_records)))
+
+        return len(records)
+
+market = RedisMarket()
@@ -0,0 +1,35 @@
+from collections import defaultdict
+
+import redis
+
+from bladepolska.redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TRADE_STATS_KEY = 'events:trade_stats'
+
+
+def incr_trade_stat(mode, name, amount=1):
+    """
+    Trade instrumentation counters, shared by all web workers. Failing to count
+    must never fail the trade itself.
+    """
+    try:
+        RedisConnection.redis().hincrby(TRADE_STATS_KEY, '%s:%s' % (mode, name), amount)
+    except redis.RedisError:
+        logger.warning("Could not increment trade stat '%s:%s'" % (mode, name))
+
+
+def get_trade_stats():
+    stats = defaultdict(dict)
+    for key, value in RedisConnection.redis().hgetall(TRADE_STATS_KEY).iteritems():
+        mode, name = key.split(':', 1)
+        stats[mode][name] = int(value)
+
+    return stats
+
+
+def reset_trade_stats():
+    RedisConnection.redis().delete(TRADE_STATS_KEY)
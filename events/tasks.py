@@ -19,3 +19,32 @@ def create_open_events_snapshot():
             logger.exception("Fatal error during create_open_events_snapshot of event #%d" % (event.id,))
 
     logger.debug("'events:tasks:create_open_events_snapshot' finished snapshotting Events.")
+
+
+@task
+def tick_price_changes():
+    from .price_changes import tick
+
+    tick()
+
+
+@task
+def flush_market_trades():
+    from .redis_market import market
+
+    while market.flush() > 0:
+        pass
+
+
+@task
+def deliver_outbox():
+    from .outbox import deliver_all
+
+    deliver_all()
+
+
+@task
+def publish_ticker():
+    from .ticker import tick
+
+    tick()
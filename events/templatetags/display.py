@@ -1,7 +1,53 @@
+import hashlib
+
 from django import template
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.safestring import mark_safe
 register = template.Library()
 
 
+def fragment_key(template_name, event, bet):
+    """
+    Changes with everything a card shows: the event's texts, image and prices and the
+    user's bet, so cached cards never need to be invalidated.
+    """
+    state = (
+        event.title,
+        event.short_title,
+        event.small_image.name if event.small_image else None,
+        event.current_buy_for_price,
+        event.current_buy_against_price,
+        event.current_sell_for_price,
+        event.current_sell_against_price,
+        sorted(bet.items()) if isinstance(bet, dict) else bet,
+    )
+    return 'fragment:%s:%d:%s' % (template_name, event.id, hashlib.md5(repr(state)).hexdigest())
+
+
+def render_cached_fragments(context, template_name, events, bets, people):
+    """ Renders template_name for each event, with all cached cards read in one get_many. """
+    cache = caches[settings.FRAGMENT_CACHE_ALIAS]
+    bets = bets or {}
+    keys = [fragment_key(template_name, event, bets.get(event.id)) for event in events]
+    fragments = cache.get_many(keys)
+
+    rendered = {}
+    if len(fragments) < len(keys):
+        card = context.template.engine.get_template(template_name)
+        for key, event in zip(keys, events):
+            if key not in fragments:
+                rendered[key] = card.render(context.new({
+                    'event': event,
+                    'bet': bets.get(event.id),
+                    'people': people,
+                }))
+        cache.set_many(rendered, settings.FRAGMENT_CACHE_TIMEOUT)
+        fragments.update(rendered)
+
+    return mark_safe(''.join(fragments[key] for key in keys))
+
+
 @register.inclusion_tag('render_bet.html')
 def render_bet(event, bet, render_current):
     return {
@@ -18,13 +64,9 @@ def render_event(event, bet, people):
         'people': people
     }
 
-@register.inclusion_tag('render_events.html')
-def render_events(events, bets, people):
-    return {
-        'events': events,
-        'bets': bets,
-        'people': people
-    }
+@register.simple_tag(takes_context=True)
+def render_events(context, events, bets, people):
+    return render_cached_fragments(context, 'render_event.html', events, bets, people)
 
 @register.inclusion_tag('render_featured_event.html')
 def render_featured_event(event, people):
@@ -33,9 +75,7 @@ def render_featured_event(event, people):
         'people': people
     }
 
-@register.inclusion_tag('render_featured_events.html')
-def render_featured_events(events, people):
-    return {
-        'events': events,
-        'people': people
-    }
+@register.simple_tag(takes_context=True)
+def render_featured_events(context, events, people):
+    return mark_safe('<div class="featured-events-box">%s</div>' % render_cached_fragments(
+        context, 'render_featured_event.html', events, None, people))
@@ -1,3 +1,659 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import timedelta
 
-# Create your tests here.
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from accounts.models import UserProfile
+from bladepolska import realtime
+from bladepolska.pubnub import HTTPConnectionPool
+from bladepolska.query_budget import QueryBudgetExceeded, query_budget
+from bladepolska.redis_connection import RedisConnection
+from bladepolska.testing import QueryBudgetTestMixin, RedisTestMixin, StubPubNubHandler, StubPubNubServer
+from . import managers
+from .exceptions import InsufficientBets, PriceMismatch
+from .lmsr import LMSRMarket
+from .models import Bet, Event, OutboxMessage, Transaction
+from .outbox import claim, deliver, CHANNEL_SLOT_KEY, DELIVER_LOCK_KEY
+from .positions import deferred_position_updates, HOLDERS_KEY
+from .price_changes import tick, HISTORY_KEY
+from .redis_market import market, COST_CENTS_LUA, FLUSH_LOCK_KEY, WRITE_BEHIND_KEY, WRITE_BEHIND_PROCESSING_KEY
+from .trade_queue import TradeQueueWorker, CANCELLED, REPLY_KEY, STATE_KEY
+from .utils import execute_trades
+
+
+class LMSRMarketTests(SimpleTestCase):
+    """ Money only moves as differences of the rounded cost function, so no order sequence makes money. """
+
+    def trade(self, market, outcome, quantity, direction):
+        """ Trades on market in place, returns the cash the trader receives (negative when paying). """
+        total = market.cost_of(outcome, quantity, direction)
+        if direction == 'BUY':
+            market.Q_for, market.Q_against = market.quantities_after(outcome, quantity)
+            return -total
+        market.Q_for, market.Q_against = market.quantities_after(outcome, -quantity)
+        return total
+
+    def test_buying_one_by_one_then_selling_at_once_nets_zero(self):
+        for B in (5., 10., 100.):
+            market = LMSRMarket(0, 0, B)
+            cash = sum(self.trade(market, 'YES', 1, 'BUY') for i in range(10))
+            cash += self.trade(market, 'YES', 10, 'SELL')
+            self.assertEqual(cash, 0)
+
+    def test_buying_at_once_then_selling_one_by_one_nets_zero(self):
+        market = LMSRMarket(3, 7, 5.)
+        cash = self.trade(market, 'NO', 12, 'BUY')
+        cash += sum(self.trade(market, 'NO', 1, 'SELL') for i in range(12))
+        self.assertEqual(cash, 0)
+
+    def test_any_round_trip_nets_zero(self):
+        market = LMSRMarket(20, 4, 5.)
+        orders = [('YES', 3, 'BUY'), ('NO', 2, 'BUY'), ('YES', 5, 'SELL'), ('YES', 1, 'BUY'), ('NO', 6, 'SELL'),
+                  ('YES', 1, 'BUY'), ('NO', 4, 'BUY')]
+        cash = sum(self.trade(market, *order) for order in orders)
+        self.assertEqual((market.Q_for, market.Q_against), (20, 4))
+        self.assertEqual(cash, 0)
+
+    def test_single_share_costs_its_price(self):
+        market = LMSRMarket(8, 3, 5.)
+        buy_for, buy_against, sell_for, sell_against = market.prices()
+        self.assertEqual(market.cost_of('YES', 1, 'BUY'), buy_for)
+        self.assertEqual(market.cost_of('NO', 1, 'BUY'), buy_against)
+        self.assertEqual(market.cost_of('YES', 1, 'SELL'), sell_for)
+        self.assertEqual(market.cost_of('NO', 1, 'SELL'), sell_against)
+
+    def test_selling_more_than_held_is_rejected(self):
+        self.assertRaises(ValueError, LMSRMarket(0, 0, 5.).cost_of, 'YES', 2, 'SELL')
+        self.assertRaises(ValueError, LMSRMarket(5, 1, 5.).cost_of, 'NO', 2, 'SELL')
+        self.assertRaises(ValueError, LMSRMarket(5, 1, 5.).cost_of, 'YES', 0, 'BUY')
+
+    def test_large_quantities_do_not_overflow(self):
+        self.assertEqual(LMSRMarket(5000, 0, 5.).prices(), (100, 0, 100, 0))
+
+
+# (Q_for, Q_against, B) on which the Python, SQL and Lua implementations are compared
+LMSR_STATES = [(q_for, q_against, B) for q_for in (0, 1, 3, 17, 250, 5000) for q_against in (0, 2, 40, 4999)
+               for B in (5., 10., 100.)]
+
+
+class LMSRSQLTests(TestCase):
+    """ events_lmsr_cost_cents and events_lmsr_prices of migrations 0011 and 0012 agree with LMSRMarket. """
+
+    def test_cost_cents_and_prices(self):
+        cursor = connection.cursor()
+        for state in LMSR_STATES:
+            cursor.execute("SELECT events_lmsr_cost_cents(%s, %s, %s)", state)
+            self.assertEqual(cursor.fetchone()[0], LMSRMarket(*state).cost_cents(), state)
+            cursor.execute("SELECT * FROM events_lmsr_prices(%s, %s, %s)", state)
+            self.assertEqual(tuple(cursor.fetchone()), LMSRMarket(*state).prices(), state)
+
+    def test_far_apart_quantities_do_not_underflow(self):
+        cursor = connection.cursor()
+        for state in [(10000, 0, 5.), (0, 9000, 5.), (3000, 2, 1.), (746, 0, 1.)]:
+            cursor.execute("SELECT * FROM events_lmsr_prices(%s, %s, %s)", state)
+            self.assertEqual(tuple(cursor.fetchone()), LMSRMarket(*state).prices(), state)
+
+
+class LMSRLuaTests(RedisTestMixin, SimpleTestCase):
+    """ cost_cents of the Redis trade script agrees with LMSRMarket. """
+
+    def test_cost_cents(self):
+        script = COST_CENTS_LUA + "return cost_cents(tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]))"
+        for state in LMSR_STATES:
+            self.assertEqual(RedisConnection.redis().eval(script, 0, *state), LMSRMarket(*state).cost_cents(),
+                             state)
+
+
+def create_event(**kwargs):
+    defaults = {
+        'title': u'Wydarzenie',
+        'short_title': u'Wydarzenie',
+        'title_fb_yes': u'TAK',
+        'title_fb_no': u'NIE',
+        'estimated_end_date': timezone.now() + timedelta(days=30),
+    }
+    defaults.update(kwargs)
+    return Event.objects.create(**defaults)
+
+
+def create_user(username, total_cash=10000):
+    user = UserProfile.objects.create_user(username, '%s@example.com' % username, 'password')
+    user.total_cash = total_cash
+    user.save()
+    return user
+
+
+@override_settings(TRADE_EXECUTION_MODE='procedure')
+class TradeProcedureTests(TestCase):
+    """ events_execute_trade, migrations 0003 and 0006. """
+
+    def test_first_trade_creates_the_bet(self):
+        user = create_user('procedure')
+        event = create_event()
+
+        user, event, bet = Bet.objects.buy_a_bet(user, event.id, 'YES', event.current_buy_for_price, 2,
+                                                  price_limit=100)
+
+        bet = Bet.objects.get(id=bet.id)
+        self.assertEqual((bet.has, bet.bought), (2, 2))
+        self.assertEqual(Event.objects.get(id=event.id).Q_for, 2)
+
+    def test_totals_and_prices_match_lmsr(self):
+        user = create_user('procedure')
+        event = create_event()
+        lmsr = LMSRMarket(0, 0, event.B)
+        total = lmsr.cost_of('NO', 7)
+
+        user, event, bet = Bet.objects.buy_a_bet(user, event.id, 'NO', None, 7, price_limit=100)
+
+        lmsr.Q_against = 7
+        self.assertEqual(user.total_cash, 10000 - total)
+        self.assertEqual((event.current_buy_for_price, event.current_buy_against_price,
+                          event.current_sell_for_price, event.current_sell_against_price), lmsr.prices())
+
+
+@override_settings(TRADE_EXECUTION_MODE='optimistic', TRADE_OPTIMISTIC_RETRIES=2)
+class TradeOptimisticTests(RedisTestMixin, TestCase):
+    """ BetManager.trade_optimistically and the version triggers of migration 0004. """
+
+    def setUp(self):
+        super(TradeOptimisticTests, self).setUp()
+        self.user = create_user('optimistic')
+        self.event = create_event()
+        self.conflicts = 0
+
+    def lose_attempts(self, times):
+        """ The next `times` attempts lose to a write of the event after they read it. """
+        check_trade_price = managers.check_trade_price
+
+        def check_after_concurrent_write(*args, **kwargs):
+            if self.conflicts < times:
+                self.conflicts += 1
+                Event.objects.filter(id=self.event.id).update(turnover=F('turnover'))
+            return check_trade_price(*args, **kwargs)
+
+        managers.check_trade_price = check_after_concurrent_write
+        self.addCleanup(setattr, managers, 'check_trade_price', check_trade_price)
+
+    def buy(self, quantity):
+        return Bet.objects.buy_a_bet(self.user, self.event.id, 'YES', None, quantity, price_limit=100)
+
+    def test_every_write_bumps_the_version(self):
+        Event.objects.filter(id=self.event.id).update(title=u'Inny tytu\u0142')
+        self.assertEqual(Event.objects.get(id=self.event.id).version, 1)
+
+        user, event, bet = self.buy(1)
+        Bet.objects.filter(id=bet.id).update(rewarded_total=0)
+
+        self.assertEqual(Event.objects.get(id=self.event.id).version, 2)
+        self.assertEqual(Bet.objects.get(id=bet.id).version, 2)
+
+    def test_conflicting_attempt_is_retried(self):
+        self.lose_attempts(2)
+
+        user, event, bet = self.buy(2)
+
+        self.assertEqual(self.conflicts, 2)
+        self.assertEqual((bet.has, Event.objects.get(id=self.event.id).Q_for), (2, 2))
+        self.assertEqual(user.total_cash, 10000 - LMSRMarket(0, 0, self.event.B).cost_of('YES', 2))
+        self.assertEqual(Transaction.objects.filter(user_id=self.user.id).count(), 1)
+
+    def test_exhausted_retries_change_nothing(self):
+        self.lose_attempts(3)
+
+        self.assertRaises(PriceMismatch, self.buy, 2)
+
+        self.assertEqual(self.conflicts, 3)
+        self.assertEqual(Event.objects.get(id=self.event.id).Q_for, 0)
+        self.assertEqual(UserProfile.objects.get(id=self.user.id).total_cash, 10000)
+        self.assertFalse(Bet.objects.filter(user_id=self.user.id, has__gt=0).exists())
+        self.assertFalse(Transaction.objects.filter(user_id=self.user.id).exists())
+
+
+@override_settings(TRADE_EXECUTION_MODE='redis')
+class RedisMarketTests(RedisTestMixin, TestCase):
+    """ Trades executed by the Lua script of events.redis_market and written behind by flush(). """
+
+    def setUp(self):
+        super(RedisMarketTests, self).setUp()
+        self.user = create_user('redis')
+        self.event = create_event()
+
+    def trade(self, quantity, outcome='YES', buy=True):
+        return market.trade(self.user, self.event.id, outcome, None, quantity, price_limit=100 if buy else 0,
+                            buy=buy)
+
+    def test_totals_and_prices_match_lmsr(self):
+        lmsr = LMSRMarket(0, 0, self.event.B)
+        total = lmsr.cost_of('YES', 3)
+
+        user, event, bet = self.trade(3)
+
+        lmsr.Q_for = 3
+        self.assertEqual(user.total_cash, 10000 - total)
+        self.assertEqual((event.current_buy_for_price, event.current_buy_against_price,
+                          event.current_sell_for_price, event.current_sell_against_price), lmsr.prices())
+
+    def test_large_quantities_do_not_overflow(self):
+        Event.objects.filter(id=self.event.id).update(Q_for=5000)
+
+        user, event, bet = self.trade(1, 'NO')
+
+        self.assertEqual((event.current_buy_for_price, event.current_buy_against_price,
+                          event.current_sell_for_price, event.current_sell_against_price),
+                         LMSRMarket(5000, 1, self.event.B).prices())
+
+    def test_selling_more_than_held_is_rejected(self):
+        self.trade(1)
+        self.assertRaises(InsufficientBets, self.trade, 2, buy=False)
+
+    def test_flush_writes_each_trade_once(self):
+        self.trade(2)
+        self.trade(1, buy=False)
+        records = RedisConnection.redis().lrange(WRITE_BEHIND_KEY, 0, -1)
+
+        self.assertEqual(market.flush(), 2)
+        # a flush dying after its commit hands the same batch out again
+        RedisConnection.redis().rpush(WRITE_BEHIND_PROCESSING_KEY, *records)
+        market.flush()
+
+        self.assertEqual(Transaction.objects.filter(user_id=self.user.id).count(), 2)
+        self.assertEqual(UserProfile.objects.get(id=self.user.id).total_cash, self.user.total_cash)
+        self.assertEqual(Bet.objects.get(user_id=self.user.id, event_id=self.event.id).has, 1)
+
+    def test_flush_waits_for_a_running_flush(self):
+        self.trade(1)
+
+        RedisConnection.redis().set(FLUSH_LOCK_KEY, 'another flush')
+        self.assertEqual(market.flush(), 0)
+        RedisConnection.redis().delete(FLUSH_LOCK_KEY)
+        self.assertEqual(market.flush(), 1)
+
+        self.assertEqual(Transaction.objects.filter(user_id=self.user.id).count(), 1)
+
+    def test_flush_keeps_cash_changed_in_postgres(self):
+        user, event, bet = self.trade(2)
+        paid = 10000 - user.total_cash
+        UserProfile.objects.filter(id=self.user.id).update(total_cash=F('total_cash') + 500)
+
+        market.flush()
+
+        self.assertEqual(UserProfile.objects.get(id=self.user.id).total_cash, 10500 - paid)
+
+    def test_topup_is_credited_in_redis_and_written_behind_once(self):
+        self.user.topup_cash(500)
+        # nothing reaches Postgres before the flush, a rolled back caller has nothing to undo
+        self.assertEqual(UserProfile.objects.get(id=self.user.id).total_cash, 10000)
+
+        user, event, bet = self.trade(1)
+        paid = 10500 - user.total_cash
+        records = RedisConnection.redis().lrange(WRITE_BEHIND_KEY, 0, -1)
+
+        self.assertEqual(market.flush(), 2)
+        RedisConnection.redis().rpush(WRITE_BEHIND_PROCESSING_KEY, *records)
+        market.flush()
+
+        user = UserProfile.objects.get(id=self.user.id)
+        self.assertEqual((user.total_cash, user.total_given_cash), (10500 - paid, 500))
+        self.assertEqual(Transaction.objects.filter(
+            user_id=self.user.id, type=Transaction.TRANSACTION_TYPE_CHOICES.TOPPED_UP_BY_APP).count(), 1)
+
+
+class TradeQueueTests(RedisTestMixin, TestCase):
+    """ A queued trade is either executed and replied to, or given up on by its submitter, never both. """
+
+    def setUp(self):
+        super(TradeQueueTests, self).setUp()
+        self.user = create_user('queue')
+        self.event = create_event(is_hot=True)
+        self.worker = TradeQueueWorker(0)
+
+    def request(self, request_id, expires_in=10):
+        return {
+            'id': request_id,
+            'user_id': self.user.id,
+            'event_id': self.event.id,
+            'buy': True,
+            'outcome': 'YES',
+            'for_price': self.event.current_buy_for_price,
+            'quantity': 1,
+            'price_limit': None,
+            'expires_at': time.time() + expires_in,
+        }
+
+    def test_claimed_request_is_executed_and_replied_to(self):
+        self.worker.process_batch([self.request('a')])
+
+        self.assertEqual(Bet.objects.get(user_id=self.user.id, event_id=self.event.id).has, 1)
+        self.assertEqual(json.loads(RedisConnection.redis().lpop(REPLY_KEY % 'a'))['status'], 200)
+
+    def test_expired_and_cancelled_requests_are_not_executed(self):
+        RedisConnection.redis().set(STATE_KEY % 'cancelled', CANCELLED)
+
+        self.worker.process_batch([self.request('a'), self.request('expired', expires_in=-1),
+                                   self.request('cancelled')])
+
+        self.assertEqual(Bet.objects.get(user_id=self.user.id, event_id=self.event.id).has, 1)
+        self.assertIsNone(RedisConnection.redis().lpop(REPLY_KEY % 'expired'))
+        self.assertIsNone(RedisConnection.redis().lpop(REPLY_KEY % 'cancelled'))
+
+
+class PositionsTests(RedisTestMixin, TestCase):
+    """ Positions and holder sets in Redis only ever show committed trades. """
+
+    def setUp(self):
+        super(PositionsTests, self).setUp()
+        self.user = create_user('positions')
+        self.event = create_event()
+
+    def holders(self):
+        return RedisConnection.redis().smembers(HOLDERS_KEY % (self.event.id, True))
+
+    def order(self, for_price):
+        return {'event_id': self.event.id, 'buy': True, 'outcome': 'YES', 'for_price': for_price, 'quantity': 1,
+                'price_limit': None}
+
+    def test_positions_are_written_after_the_commit(self):
+        with deferred_position_updates():
+            with transaction.atomic():
+                Bet.objects.buy_a_bet(self.user, self.event.id, 'YES', self.event.current_buy_for_price)
+            self.assertEqual(self.holders(), set())
+
+        self.assertEqual(self.holders(), {str(self.user.id)})
+
+    def test_rolled_back_trade_leaves_no_position(self):
+        try:
+            with deferred_position_updates(), transaction.atomic():
+                Bet.objects.buy_a_bet(self.user, self.event.id, 'YES', self.event.current_buy_for_price)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(self.holders(), set())
+
+    def test_failed_batch_leaves_no_position(self):
+        # the second order's price is never right, so the whole batch is rolled back
+        success, result = execute_trades(self.user, [self.order(self.event.current_buy_for_price), self.order(0)])
+
+        self.assertFalse(success)
+        self.assertEqual(self.holders(), set())
+
+
+class PriceChangesTests(RedisTestMixin, TestCase):
+    """ events.price_changes.tick, the only writer of the events' price changes. """
+
+    def test_each_step_is_pushed_once(self):
+        event = create_event(current_buy_for_price=40)
+        now = time.time()
+
+        tick(now)
+        Event.objects.filter(id=event.id).update(current_buy_for_price=55)
+        tick(now)
+
+        self.assertEqual(RedisConnection.redis().lrange(HISTORY_KEY % ('1h', event.id), 0, -1), ['40'])
+        event = Event.objects.get(id=event.id)
+        self.assertEqual((event.price_change_1h, event.price_change, event.absolute_price_change), (15, 15, 15))
+
+
+class CreateTransactionsTests(RedisTestMixin, TestCase):
+    """ Batches of orders, events.views.handle_create_transactions. """
+
+    def test_batch_with_a_hot_event_is_rejected(self):
+        user = create_user('batch')
+        events = [create_event(), create_event(is_hot=True)]
+        self.assertTrue(self.client.login(username='batch', password='password'))
+
+        response = self.client.post(reverse('events:create_transactions'), json.dumps({'orders': [
+            {'event_id': event.id, 'buy': 'True', 'outcome': 'YES', 'for_price': event.current_buy_for_price}
+            for event in events
+        ]}), content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['order'], 1)
+        self.assertFalse(Transaction.objects.filter(user_id=user.id).exists())
+
+
+@override_settings(QUOTE_CACHE_TIMEOUT=0)
+class EventQuoteTests(RedisTestMixin, TestCase):
+    """ A quote is priced by the same LMSRMarket.cost_of as the trade it quotes. """
+
+    def quote(self, event, quantity, shares=None):
+        response = self.client.get(reverse('events:event_quote', kwargs={'event_id': event.id}),
+                                   {'outcome': 'YES', 'quantity': quantity, 'shares': shares or quantity})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_quoted_totals_are_executed(self):
+        user = create_user('quote')
+        event = create_event(Q_for=3, Q_against=1)
+
+        quote = self.quote(event, 4)
+        self.assertEqual(sum(quote['buy']), quote['buy_total'])
+        user, event, bet = Bet.objects.buy_a_bet(user, event.id, 'YES', None, 4, price_limit=100)
+        self.assertEqual(user.total_cash, 10000 - quote['buy_total'])
+
+        quote = self.quote(event, 4)
+        self.assertEqual(sum(quote['sell']), quote['sell_total'])
+        user, event, bet = Bet.objects.sell_a_bet(user, event.id, 'YES', None, 4, price_limit=0)
+        self.assertEqual(user.total_cash, 10000)
+
+    def test_selling_more_than_held_has_no_total(self):
+        event = create_event(Q_for=3)
+
+        quote = self.quote(event, 5)
+        self.assertEqual(len(quote['sell']), 3)
+        self.assertIsNone(quote['sell_total'])
+
+    def test_sell_total_beyond_the_quoted_ladder(self):
+        event = create_event(Q_for=8)
+
+        quote = self.quote(event, 5, shares=2)
+        self.assertEqual(len(quote['sell']), 2)
+        self.assertEqual(quote['sell_total'], event.market.cost_of('YES', 5, 'SELL'))
+
+
+class IdempotencyTests(RedisTestMixin, TestCase):
+    """ bladepolska.idempotency on create_transaction. """
+
+    def setUp(self):
+        super(IdempotencyTests, self).setUp()
+        self.user = create_user('idempotent')
+        self.event = create_event()
+        self.assertTrue(self.client.login(username='idempotent', password='password'))
+
+    def buy(self, quantity):
+        return self.client.post(
+            reverse('events:create_transaction', kwargs={'event_id': self.event.id}),
+            json.dumps({'buy': 'True', 'outcome': 'YES', 'for_price': self.event.current_buy_for_price,
+                        'quantity': quantity}),
+            content_type='application/json', HTTP_IDEMPOTENCY_KEY='buy-1')
+
+    def test_repeat_gets_the_first_response(self):
+        first = self.buy(1)
+        repeat = self.buy(1)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual((repeat.status_code, repeat.content), (first.status_code, first.content))
+        self.assertEqual(Transaction.objects.filter(user_id=self.user.id).count(), 1)
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        self.buy(1)
+
+        self.assertEqual(self.buy(2).status_code, 422)
+        self.assertEqual(Transaction.objects.filter(user_id=self.user.id).count(), 1)
+
+
+class FailingBackend(realtime.RealtimeBackend):
+    def publish(self, channel, message):
+        return False
+
+
+class RecordingBackend(realtime.RealtimeBackend):
+    def __init__(self):
+        self.channels = []
+
+    def publish(self, channel, message):
+        self.channels.append(channel)
+        return True
+
+
+@override_settings(OUTBOX_MAX_ATTEMPTS=2)
+class OutboxTests(RedisTestMixin, TestCase):
+    """ events.outbox.deliver with a realtime backend that is down. """
+
+    def setUp(self):
+        super(OutboxTests, self).setUp()
+        realtime._backend = FailingBackend()
+        self.message = OutboxMessage.objects.enqueue('event_1', {'updates': {'events': [{'event_id': 1}]}})
+
+    def tearDown(self):
+        realtime._backend = None
+        super(OutboxTests, self).tearDown()
+
+    def retry_now(self):
+        RedisConnection.redis().delete(CHANNEL_SLOT_KEY % 'event_1')
+        OutboxMessage.objects.update(next_attempt_date=timezone.now())
+
+    def test_claimed_messages_are_leased(self):
+        self.assertEqual([message.id for message in claim(10)], [self.message.id])
+        self.assertEqual(claim(10), [])
+
+    def test_failed_message_is_retried_then_dropped(self):
+        self.assertEqual(deliver(), 1)
+        self.assertEqual(OutboxMessage.objects.get(id=self.message.id).attempts, 1)
+
+        self.retry_now()
+        self.assertEqual(deliver(), 1)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_throttled_channel_does_not_hold_up_others(self):
+        realtime._backend = RecordingBackend()
+        RedisConnection.redis().set(CHANNEL_SLOT_KEY % 'event_1', 1, px=60000)
+        OutboxMessage.objects.enqueue('event_2', {'updates': {'events': [{'event_id': 2}]}})
+
+        self.assertEqual(deliver(batch_size=1), 0)
+        self.assertEqual(deliver(batch_size=1), 1)
+
+        self.assertEqual(realtime._backend.channels, ['event_2'])
+        self.assertTrue(OutboxMessage.objects.get(id=self.message.id).next_attempt_date >
+                        timezone.now() + timedelta(seconds=30))
+
+    def test_one_publisher_delivers_at_a_time(self):
+        realtime._backend = RecordingBackend()
+        RedisConnection.redis().set(DELIVER_LOCK_KEY, 'another publisher')
+
+        self.assertEqual(deliver(), 0)
+        self.assertEqual(realtime._backend.channels, [])
+
+        RedisConnection.redis().delete(DELIVER_LOCK_KEY)
+        self.assertEqual(deliver(), 1)
+        self.assertIsNone(RedisConnection.redis().get(DELIVER_LOCK_KEY))
+
+
+class HTTPConnectionPoolTests(SimpleTestCase):
+    """ bladepolska.pubnub.HTTPConnectionPool against a local stub PubNub server. """
+
+    def setUp(self):
+        self.server = StubPubNubServer(('127.0.0.1', 0), StubPubNubHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.pool = HTTPConnectionPool('127.0.0.1', self.server.server_address[1], pipeline_depth=3)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pipelined_responses_come_back_in_order(self):
+        results = self.pool.request_many(['/publish/%d' % i for i in range(7)])
+
+        self.assertEqual(results, [[1, 'Sent', '13710000000000000']] * 7)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_reconnects_after_the_server_closed_the_connection(self):
+        self.pool.request_many(['/publish/1'])
+        self.server.drop_connections()
+
+        self.assertEqual(self.pool.request_many(['/publish/2', '/publish/3']),
+                         [[1, 'Sent', '13710000000000000']] * 2)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_partial_failures(self):
+        results = self.pool.request_many(['/publish/1', '/publish/close', '/publish/3', '/publish/fail',
+                                          '/publish/5'])
+
+        sent = [1, 'Sent', '13710000000000000']
+        # the rest of a pipeline cut short by a closed connection is reported as failed
+        self.assertEqual(results, [sent, sent, None, None, sent])
+        self.assertEqual(len(self.server.connections), 2)
+
+
+class QueryBudgetTests(RedisTestMixin, QueryBudgetTestMixin, TestCase):
+    """ The pages and trades stay within their query budgets however many events and bets there are. """
+
+    def setUp(self):
+        super(QueryBudgetTests, self).setUp()
+        self.user = create_user('budget')
+        friends = [create_user('friend%d' % i) for i in range(5)]
+        self.user.friends.add(*friends)
+
+        self.events = []
+        for i in range(20):
+            self.events.append(create_event(
+                title=u'Wydarzenie %d' % i,
+                short_title=u'Wydarzenie %d' % i,
+                title_fb_yes=u'TAK %d' % i,
+                title_fb_no=u'NIE %d' % i,
+                is_front=(i == 0),
+                is_featured=(i < 4),
+                estimated_end_date=timezone.now() + timedelta(days=30 + i),
+            ))
+        for i, event in enumerate(self.events[:10]):
+            for user in [self.user] + friends:
+                Bet.objects.create(user=user, event=event, outcome=bool(i % 2), has=5, bought=5,
+                                   bought_avg_price=50)
+
+        self.assertTrue(self.client.login(username='budget', password='password'))
+
+    def test_n_plus_one_goes_over_the_budget(self):
+        def holders(bets):
+            return HttpResponse(', '.join(bet.user.username for bet in bets))
+
+        @query_budget(queries=5, duplicates=2)
+        def n_plus_one(request):
+            return holders(Bet.objects.all())
+
+        @query_budget(queries=5, duplicates=2)
+        def joined(request):
+            return holders(Bet.objects.select_related('user'))
+
+        request = RequestFactory().get('/')
+        with override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_RAISE=True):
+            self.assertRaises(QueryBudgetExceeded, n_plus_one, request)
+            self.assertEqual(joined(request).query_stats.count, 1)
+
+    def test_home(self):
+        self.assertWithinQueryBudget('get', reverse('home'))
+
+    def test_events_list(self):
+        for mode in ['popular', 'latest', 'changed', 'finished']:
+            self.assertWithinQueryBudget('get', reverse('events:events', kwargs={'mode': mode}))
+
+    def test_event_detail(self):
+        self.assertWithinQueryBudget('get', self.events[0].get_relative_url())
+
+    def test_create_transaction(self):
+        event = self.events[15]
+        response = self.assertWithinQueryBudget(
+            'post', reverse('events:create_transaction', kwargs={'event_id': event.id}),
+            json.dumps({'buy': 'True', 'outcome': 'YES', 'for_price': event.current_buy_for_price}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
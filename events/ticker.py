@@ -0,0 +1,82 @@
+from bladepolska import realtime
+from bladepolska.redis_connection import RedisConnection
+
+
+TICKER_CHANNEL = 'ticker'
+STATE_KEY = 'ticker:state'
+SEQ_KEY = 'ticker:seq'
+LOCK_KEY = 'ticker:lock'
+
+PRICE_FIELDS = ['current_buy_for_price', 'current_buy_against_price',
+                'current_sell_for_price', 'current_sell_against_price']
+
+
+def _decode(prices):
+    return [int(price) for price in prices.split(',')]
+
+
+def _encode(prices):
+    return ','.join(str(price) for price in prices)
+
+
+def tick():
+    """
+    Publishes one ticker message with the price changes of all open events since the
+    previous tick:
+
+        {"seq": 42, "d": {"<event id>": [d_buy_for, d_buy_against, d_sell_for, d_sell_against]},
+         "x": [<ids of events no longer open>]}
+
+    Changes are differences from the previously published prices, and from zeros for
+    events that were not on the ticker yet. A client applies them on top of snapshot()
+    and fetches a new snapshot when it sees a gap in seq.
+    Nothing is published when no price has changed. Returns the message or None.
+    """
+    from .models import Event
+
+    r = RedisConnection.redis()
+    if not r.set(LOCK_KEY, 1, nx=True, ex=60):
+        return None
+
+    try:
+        previous = dict((int(event_id), _decode(prices)) for event_id, prices in r.hgetall(STATE_KEY).iteritems())
+        current = dict((row[0], list(row[1:])) for row in
+                       Event.objects.ongoing_only_queryset().values_list('id', *PRICE_FIELDS))
+
+        deltas = {}
+        for event_id, prices in current.iteritems():
+            before = previous.get(event_id, [0] * len(PRICE_FIELDS))
+            if prices != before:
+                deltas[event_id] = [price - old for price, old in zip(prices, before)]
+        closed = [event_id for event_id in previous if event_id not in current]
+
+        if not deltas and not closed:
+            return None
+
+        with r.pipeline() as pipe:
+            if deltas:
+                pipe.hmset(STATE_KEY, dict((event_id, _encode(current[event_id])) for event_id in deltas))
+            if closed:
+                pipe.hdel(STATE_KEY, *closed)
+            pipe.incr(SEQ_KEY)
+            seq = pipe.execute()[-1]
+
+        message = {'seq': seq, 'd': deltas}
+        if closed:
+            message['x'] = closed
+
+        realtime.publish(TICKER_CHANNEL, message)
+        return message
+    finally:
+        r.delete(LOCK_KEY)
+
+
+def snapshot():
+    """ {"seq": n, "events": {"<event id>": [buy_for, buy_against, sell_for, sell_against]}} as of tick n. """
+    with RedisConnection.redis().pipeline() as pipe:
+        seq, state = pipe.get(SEQ_KEY).hgetall(STATE_KEY).execute()
+
+    return {
+        'seq': int(seq or 0),
+        'events': dict((event_id, _decode(prices)) for event_id, prices in state.iteritems()),
+    }
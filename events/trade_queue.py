@@ -0,0 +1,151 @@
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib import auth
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from bladepolska.redis_connection import RedisConnection
+from .exceptions import NonexistantEvent
+from .positions import deferred_position_updates, discard_position_updates
+from .utils import execute_trade
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+QUEUE_KEY = 'trade_queue:%d'
+REPLY_KEY = 'trade_queue:reply:%s'
+# set with NX by whoever comes first: the worker taking the trade up or the submitter giving up on it
+STATE_KEY = 'trade_queue:state:%s'
+CLAIMED = 'claimed'
+CANCELLED = 'cancelled'
+
+
+def shard_for_event(event_id):
+    return int(event_id) % settings.TRADE_QUEUE_SHARDS
+
+
+def submit_trade(user, event_id, buy, outcome, for_price, quantity=1, price_limit=None):
+    """
+    Hands a trade on a hot event over to the single worker of its shard and waits
+    for the result. Returns (status, result) like the worker replies, or None if the
+    worker did not take the trade up within TRADE_QUEUE_TIMEOUT seconds; it is then
+    cancelled and never executed. A trade taken up in time is waited for until its
+    batch is done, for at most another TRADE_QUEUE_TIMEOUT seconds, after which None
+    only means that its result is unknown.
+    """
+    request_id = uuid.uuid4().hex
+    timeout = settings.TRADE_QUEUE_TIMEOUT
+
+    r = RedisConnection.redis()
+    r.rpush(QUEUE_KEY % shard_for_event(event_id), json.dumps({
+        'id': request_id,
+        'user_id': user.id,
+        'event_id': int(event_id),
+        'buy': buy,
+        'outcome': outcome,
+        'for_price': for_price,
+        'quantity': quantity,
+        'price_limit': price_limit,
+        'expires_at': time.time() + timeout,
+    }))
+
+    blocking = RedisConnection.blocking_redis()
+    reply = blocking.blpop(REPLY_KEY % request_id, timeout)
+    if reply is None:
+        if r.set(STATE_KEY % request_id, CANCELLED, nx=True, ex=2 * timeout):
+            return None
+        reply = blocking.blpop(REPLY_KEY % request_id, timeout)
+        if reply is None:
+            logger.error("Trade %s was taken up by the worker but its result never came" % request_id)
+            return None
+
+    reply = json.loads(reply[1])
+    return reply['status'], reply['result']
+
+
+class TradeQueueWorker(object):
+    """
+    The only writer for the events of one shard. Trades are applied in arrival order
+    and a whole batch is committed in one DB transaction, so the event row locks are
+    never contended and commits are amortized over the batch.
+    """
+
+    def __init__(self, shard, batch_size=None):
+        self.shard = shard
+        self.batch_size = batch_size or settings.TRADE_QUEUE_BATCH_SIZE
+        self.queue_key = QUEUE_KEY % shard
+
+    def next_batch(self, timeout=1):
+        first = RedisConnection.blocking_redis().blpop(self.queue_key, timeout)
+        if first is None:
+            return []
+
+        r = RedisConnection.redis()
+
+        pipe = r.pipeline()
+        pipe.lrange(self.queue_key, 0, self.batch_size - 2)
+        pipe.ltrim(self.queue_key, self.batch_size - 1, -1)
+        rest, trimmed = pipe.execute()
+
+        return [json.loads(request) for request in [first[1]] + rest]
+
+    def claim(self, request):
+        """
+        Takes the request up unless it expired or its submitter gave up on it, right before
+        executing it: a request either gets executed or its submitter returns None.
+        """
+        if request['expires_at'] <= time.time():
+            return False
+        return RedisConnection.redis().set(STATE_KEY % request['id'], CLAIMED, nx=True,
+                                           ex=2 * settings.TRADE_QUEUE_TIMEOUT)
+
+    def process_batch(self, requests):
+        if not requests:
+            return
+
+        users = auth.get_user_model().objects.in_bulk(set(request['user_id'] for request in requests))
+
+        replies = []
+        try:
+            with deferred_position_updates(), transaction.atomic():
+                for request in requests:
+                    if self.claim(request):
+                        replies.append((request['id'], self.process(request, users.get(request['user_id']))))
+        except:
+            logger.exception("Fatal error committing a batch of %d trades" % len(replies))
+            replies = [(request_id, {'status': 500, 'result': {}}) for request_id, reply in replies]
+
+        pipe = RedisConnection.redis().pipeline()
+        for request_id, reply in replies:
+            key = REPLY_KEY % request_id
+            pipe.rpush(key, json.dumps(reply, cls=DjangoJSONEncoder))
+            pipe.expire(key, settings.TRADE_QUEUE_TIMEOUT)
+        pipe.execute()
+
+    def process(self, request, user):
+        if user is None:
+            return {'status': 404, 'result': {}}
+
+        try:
+            with transaction.atomic():
+                success, result = execute_trade(user, request['event_id'], request['buy'], request['outcome'],
+                                                request['for_price'], request['quantity'], request['price_limit'])
+        except NonexistantEvent:
+            return {'status': 404, 'result': {}}
+        except:
+            logger.exception("Fatal error during trade %s on event #%d" % (request['id'], request['event_id']))
+            discard_position_updates(user.id, request['event_id'])
+            return {'status': 500, 'result': {}}
+
+        if success:
+            return {'status': 200, 'result': result}
+        return {'status': 400, 'result': result}
+
+    def run(self):
+        logger.debug("'events:trade_queue' worker for shard %d up" % self.shard)
+        while True:
+            self.process_batch(self.next_batch())
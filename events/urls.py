@@ -8,4 +8,7 @@ urlpatterns = patterns('',
     url(r'^events/$', EventsListView.as_view(), {'mode': 'popular'}, name="events"),
     url(r'^events/(?P<mode>popular|latest|changed|finished)$', EventsListView.as_view(), name="events"),
     url(r'^event/(?P<event_id>\d+)/transaction/create/$', 'events.views.create_transaction', name="create_transaction"),
+    url(r'^events/transactions/create/$', 'events.views.create_transactions', name="create_transactions"),
+    url(r'^events/ticker/$', 'events.views.ticker', name="ticker"),
+    url(r'^event/(?P<event_id>\d+)/quote/$', 'events.views.event_quote', name="event_quote"),
 )
@@ -1,43 +1,191 @@
-from .models import Bet
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .exceptions import PriceMismatch, EventNotInProgress, UnknownOutcome, \
+    InsufficientBets, InsufficientCash
+from .lmsr import LMSRMarket
+from .managers import coalesced_publishes
+from .models import Bet, Event
+from .positions import deferred_position_updates, get_positions
 
 
 def create_bets_dict(user, events):
-    bets = dict()
-    if user is not None:
-        bets = Bet.objects.get_users_bets_for_events(user, events)
-        bets = dict((bet.event_id, bet) for bet in bets)
+    """ What the event cards show about the user's bets, from the positions cache of events.positions. """
+    events = [event for event in events if event is not None]
+    positions = dict()
+    if user is not None and user.is_authenticated():
+        positions = get_positions(user.id, [event.id for event in events])
 
     all_bets = dict()
-    if len(events) > 1 and len(bets) > 0:
-        for event in events:
-            if event.id in bets and bets[event.id].has>0:
-                bet = bets[event.id]
-                all_bets[event.id]={
-                    'has_any' : True,
-                    'buyYES': bet.outcome,
-                    'buyNO' : not bet.outcome,
-                    'outcomeYES' : "YES" if bet.outcome else "NO",
-                    'outcomeNO' : "YES" if bet.outcome else "NO",
-                    'priceYES' : event.current_buy_for_price if bet.outcome else event.current_sell_against_price,
-                    'priceNO' : event.current_sell_for_price if bet.outcome else event.current_buy_against_price,
-                    'textYES' : "+" if bet.outcome else "-",
-                    'textNO' : "-" if bet.outcome else "+",
-                    'has' : bet.has,
-                    'classOutcome' : "YES" if bet.outcome else "NO",
-                    'textOutcome' : "TAK" if bet.outcome else "NIE",
-                    'avgPrice' : round(bet.bought_avg_price,2),
-                }
-            else:
-                all_bets[event.id]={
-                    'has_any' : False,
-                    'buyYES': True,
-                    'buyNO' : True,
-                    'outcomeYES' : "YES",
-                    'outcomeNO' : "NO",
-                    'priceYES' : event.current_buy_for_price,
-                    'priceNO' : event.current_buy_against_price,
-                    'textYES' : "TAK",
-                    'textNO' : "NIE"
-                }
+    for event in events:
+        if event.id in positions:
+            # the outcome with the most shares, should the user hold both
+            outcome, has, avg_price = max(positions[event.id], key=lambda position: position[1])
+            all_bets[event.id]={
+                'has_any' : True,
+                'buyYES': outcome,
+                'buyNO' : not outcome,
+                'outcomeYES' : "YES" if outcome else "NO",
+                'outcomeNO' : "YES" if outcome else "NO",
+                'priceYES' : event.current_buy_for_price if outcome else event.current_sell_against_price,
+                'priceNO' : event.current_sell_for_price if outcome else event.current_buy_against_price,
+                'textYES' : "+" if outcome else "-",
+                'textNO' : "-" if outcome else "+",
+                'has' : has,
+                'classOutcome' : "YES" if outcome else "NO",
+                'textOutcome' : "TAK" if outcome else "NIE",
+                'avgPrice' : round(avg_price,2),
+            }
+        else:
+            all_bets[event.id]={
+                'has_any' : False,
+                'buyYES': True,
+                'buyNO' : True,
+                'outcomeYES' : "YES",
+                'outcomeNO' : "NO",
+                'priceYES' : event.current_buy_for_price,
+                'priceNO' : event.current_buy_against_price,
+                'textYES' : "TAK",
+                'textNO' : "NIE"
+            }
 
     return all_bets
+
+
+def execute_trade(user, event_id, buy, outcome, for_price, quantity=1, price_limit=None):
+    """
+    Runs a single trade and returns (success, result) with result in the format of the
+    create_transaction JSON response. NonexistantEvent is left for the caller.
+    With a price_limit the trade is filled at any price per share within it instead
+    of only at exactly for_price.
+    Always remember about wrapping this in a transaction!
+    """
+    try:
+        if buy:
+            user, event, bet = Bet.objects.buy_a_bet(user, event_id, outcome, for_price, quantity, price_limit)
+        else:
+            user, event, bet = Bet.objects.sell_a_bet(user, event_id, outcome, for_price, quantity, price_limit)
+    except PriceMismatch as e:
+        result = {
+            'error': unicode(e),
+            'updates': {
+                'events': [
+                    e.updated_event.event_dict
+                ]
+            }
+        }
+        return False, result
+    except InsufficientCash as e:
+        result = {
+            'error': unicode(e),
+            'updates': {
+                'user': [
+                    e.updated_user.statistics_dict
+                ]
+            }
+        }
+        return False, result
+    except InsufficientBets as e:
+        result = {
+            'error': unicode(e),
+            'updates': {
+                'bets': [
+                    e.updated_bet.bet_dict
+                ]
+            }
+        }
+        return False, result
+    except EventNotInProgress as e:
+        result = {
+            'error': unicode(e),
+        }
+        return False, result
+    except UnknownOutcome as e:
+        result = {
+            'error': unicode(e),
+        }
+        return False, result
+
+    result = {
+        'updates': {
+            'bets': [
+                bet.bet_dict
+            ],
+            'events': [
+                event.event_dict
+            ],
+            'user': user.statistics_dict
+        }
+    }
+    return True, result
+
+
+class _BatchFailed(Exception):
+    def __init__(self, result):
+        super(_BatchFailed, self).__init__()
+        self.result = result
+
+
+def execute_trades(user, orders):
+    """
+    Runs a batch of orders in one transaction, either all of them are filled or none.
+    Each order is a dict of execute_trade arguments (event_id, buy, outcome, for_price,
+    quantity, price_limit). Rows are locked up front in a fixed order and every traded
+    event is published once, after the commit.
+    Returns (success, result) like execute_trade, with the last state of each event and
+    bet in one updates payload. A failed batch returns the result of the first order
+    that failed, with its index under 'order'. NonexistantEvent is left for the caller.
+    """
+    events = OrderedDict()
+    bets = OrderedDict()
+    user_dict = None
+
+    try:
+        with deferred_position_updates(), transaction.atomic(), coalesced_publishes():
+            Bet.objects.lock_events_and_user(user, sorted(set(order['event_id'] for order in orders)))
+
+            for i, order in enumerate(orders):
+                success, result = execute_trade(user, order['event_id'], order['buy'], order['outcome'],
+                                                order['for_price'], order['quantity'], order['price_limit'])
+                if not success:
+                    result['order'] = i
+                    raise _BatchFailed(result)
+
+                updates = result['updates']
+                for event_dict in updates['events']:
+                    events[event_dict['event_id']] = event_dict
+                for bet_dict in updates['bets']:
+                    bets[(bet_dict['event_id'], bet_dict['outcome'])] = bet_dict
+                user_dict = updates['user']
+    except _BatchFailed as e:
+        return False, e.result
+
+    result = {
+        'updates': {
+            'bets': bets.values(),
+            'events': events.values(),
+            'user': user_dict
+        }
+    }
+    return True, result
+
+
+def get_cached_market(event_id):
+    """
+    (is_in_progress, LMSRMarket) of an event from a short-lived cache, without any row locks.
+    Returns None for nonexistent events.
+    """
+    key = 'event_market:%d' % int(event_id)
+    state = cache.get(key)
+    if state is None:
+        state = list(Event.objects.filter(id=event_id).values_list('outcome', 'Q_for', 'Q_against', 'B'))
+        if not state:
+            return None
+        state = state[0]
+        cache.set(key, state, settings.QUOTE_CACHE_TIMEOUT)
+
+    outcome, Q_for, Q_against, B = state
+    return outcome == Event.EVENT_OUTCOME_CHOICES.IN_PROGRESS, LMSRMarket(Q_for, Q_against, B)
@@ -6,7 +6,7 @@ from django.shortcuts import render_to_response
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.http import Http404, HttpResponseBadRequest
+from django.http import Http404, HttpResponseBadRequest, HttpResponseServerError
 from django.shortcuts import get_object_or_404
 from django.template import RequestContext
 from django.utils.translation import ugettext as _
@@ -14,14 +14,23 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.generic import DetailView, ListView
 
-from .exceptions import NonexistantEvent, PriceMismatch, EventNotInProgress, \
-    UnknownOutcome, InsufficientBets, InsufficientCash
+from .exceptions import NonexistantEvent
 from .models import Event, Bet, Transaction
-from .utils import create_bets_dict
+from .page_cache import anonymous_page_cache
+from .positions import deferred_position_updates
+from .ticker import snapshot as ticker_snapshot
+from .trade_queue import submit_trade
+from .utils import create_bets_dict, execute_trade, execute_trades, get_cached_market
 
-from bladepolska.http import JSONResponse, JSONResponseBadRequest
+from bladepolska.http import HttpResponseNotImplemented, HttpResponseServiceUnavailable, JSONResponse, \
+    JSONResponseBadRequest
+from bladepolska.idempotency import idempotent
+from bladepolska.query_budget import query_budget
+from bladepolska.query_helpers import get_int_from_dict_or_fallback
 
 
+@anonymous_page_cache
+@query_budget(queries=15, duplicates=2)
 class EventsListView(ListView):
     template_name = 'events.html'
 
@@ -47,6 +56,8 @@ class EventFacebookObjectDetailView(DetailView):
         return get_object_or_404(Event, id=self.kwargs['pk'])
 
 
+@anonymous_page_cache
+@query_budget(queries=15, duplicates=2)
 class EventDetailView(DetailView):
     template_name = 'event_detail.html'
     context_object_name = 'event'
@@ -79,80 +90,155 @@ class EventDetailView(DetailView):
         return context
 
 
+def handle_create_transaction(request, event_id):
+    """ create_transaction without the authentication, shared with events.api. """
+    data = json.loads(request.body)
+    try:
+        buy = (data['buy'] == 'True')
+        outcome = data['outcome']
+        for_price = data.get('for_price')
+        quantity = int(data.get('quantity', 1))
+        # the worst price per share the user accepts: max_price when buying, min_price when selling
+        price_limit = data.get('max_price' if buy else 'min_price')
+        if price_limit is not None:
+            price_limit = int(price_limit)
+    except:
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+    if quantity < 1 or (for_price is None and price_limit is None):
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    if Event.objects.filter(id=event_id, is_hot=True).exists():
+        reply = submit_trade(request.user, event_id, buy, outcome, for_price, quantity, price_limit)
+        if reply is None:
+            return HttpResponseServiceUnavailable(_("Something went wrong, try again in a few seconds."))
+
+        status, result = reply
+        if status == 404:
+            raise Http404
+        if status == 500:
+            return HttpResponseServerError(_("Something went wrong, try again in a few seconds."))
+        success = (status == 200)
+    else:
+        try:
+            with deferred_position_updates(), transaction.atomic():
+                success, result = execute_trade(request.user, event_id, buy, outcome, for_price, quantity,
+                                                price_limit)
+        except NonexistantEvent:
+            raise Http404
+
+    if not success:
+        return JSONResponseBadRequest(json.dumps(result))
+
+    return JSONResponse(json.dumps(result))
+
+
 @login_required
 @require_http_methods(["POST"])
 @csrf_exempt
-@transaction.atomic
+@idempotent
+@query_budget(queries=20, duplicates=2)
 def create_transaction(request, event_id):
+    return handle_create_transaction(request, event_id)
+
+
+def handle_create_transactions(request):
+    """
+    Executes a batch of orders, each like the body of create_transaction plus its
+    event_id, in one database transaction. Shared with events.api. Orders on hot
+    events are rejected: those only go through the single writer of their shard
+    (see events.trade_queue), which cannot take part in the batch's transaction.
+    """
+    if settings.TRADE_EXECUTION_MODE == 'redis':
+        # trades executed in Redis cannot be rolled back together
+        return HttpResponseNotImplemented(_("Something went wrong, try again in a few seconds."))
+
     data = json.loads(request.body)
     try:
-        buy = (data['buy'] == 'True')
-        outcome = data['outcome']
-        for_price = data['for_price']
+        orders = []
+        for order in data['orders']:
+            buy = (order['buy'] == 'True')
+            price_limit = order.get('max_price' if buy else 'min_price')
+            orders.append({
+                'event_id': int(order['event_id']),
+                'buy': buy,
+                'outcome': order['outcome'],
+                'for_price': order.get('for_price'),
+                'quantity': int(order.get('quantity', 1)),
+                'price_limit': int(price_limit) if price_limit is not None else None,
+            })
     except:
         return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+    if not 0 < len(orders) <= settings.TRADE_BATCH_MAX_ORDERS:
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+    for order in orders:
+        if order['quantity'] < 1 or (order['for_price'] is None and order['price_limit'] is None):
+            return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    hot_event_ids = set(Event.objects.filter(id__in=[order['event_id'] for order in orders],
+                                             is_hot=True).values_list('id', flat=True))
+    for i, order in enumerate(orders):
+        if order['event_id'] in hot_event_ids:
+            result = {
+                'error': _("This event can only be traded one order at a time."),
+                'order': i,
+            }
+            return JSONResponseBadRequest(json.dumps(result))
+
     try:
-        if buy:
-            user, event, bet = Bet.objects.buy_a_bet(request.user, event_id, outcome, for_price)
-        else:
-            user, event, bet = Bet.objects.sell_a_bet(request.user, event_id, outcome, for_price)
+        success, result = execute_trades(request.user, orders)
     except NonexistantEvent:
         raise Http404
-    except PriceMismatch as e:
-        result = {
-            'error': unicode(e),
-            'updates': {
-                'events': [
-                    e.updated_event.event_dict
-                ]
-            }
-        }
-        return JSONResponseBadRequest(json.dumps(result))
-    except InsufficientCash as e:
-        result = {
-            'error': unicode(e),
-            'updates': {
-                'user': [
-                    e.updated_user.statistics_dict
-                ]
-            }
-        }
 
+    if not success:
         return JSONResponseBadRequest(json.dumps(result))
-    except InsufficientBets as e:
-        result = {
-            'error': unicode(e),
-            'updates': {
-                'bets': [
-                    e.updated_bet.bet_dict
-                ]
-            }
-        }
 
-        return JSONResponseBadRequest(json.dumps(result))
-    except EventNotInProgress as e:
-        result = {
-            'error': unicode(e),
-        }
+    return JSONResponse(json.dumps(result))
 
-        return JSONResponseBadRequest(json.dumps(result))
-    except UnknownOutcome as e:
+
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+@idempotent
+def create_transactions(request):
+    return handle_create_transactions(request)
+
+
+@require_http_methods(["GET"])
+def event_quote(request, event_id):
+    outcome = request.GET.get('outcome', 'YES')
+    if outcome not in ('YES', 'NO'):
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    shares = get_int_from_dict_or_fallback(request.GET, 'shares', 10)
+    shares = max(1, min(shares, settings.QUOTE_MAX_SHARES))
+    quantity = get_int_from_dict_or_fallback(request.GET, 'quantity', 1)
+    quantity = max(1, min(quantity, settings.QUOTE_MAX_SHARES))
+
+    cached = get_cached_market(event_id)
+    if cached is None:
+        raise Http404
+    is_in_progress, market = cached
+    if not is_in_progress:
         result = {
-            'error': unicode(e),
+            'error': _("Event is no longer in progress."),
         }
-
         return JSONResponseBadRequest(json.dumps(result))
 
     result = {
-        'updates': {
-            'bets': [
-                bet.bet_dict
-            ],
-            'events': [
-                event.event_dict
-            ],
-            'user': user.statistics_dict
-        }
+        'event_id': int(event_id),
+        'outcome': outcome,
+        'buy': market.ladder(outcome, 'BUY', shares),
+        'sell': market.ladder(outcome, 'SELL', shares),
+        'quantity': quantity,
+        'buy_total': market.cost_of(outcome, quantity, 'BUY'),
+        # no more shares can be sold than all users hold
+        'sell_total': market.cost_of(outcome, quantity, 'SELL') if quantity <= market.held(outcome) else None,
     }
 
     return JSONResponse(json.dumps(result))
+
+
+@require_http_methods(["GET"])
+def ticker(request):
+    """ Prices of all open events for clients joining the ticker channel, see events.ticker. """
+    return JSONResponse(json.dumps(ticker_snapshot()))
@@ -23,6 +23,8 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 SERVE_STATIC_FILES = False
 CELERY_ALWAYS_EAGER = True
+QUERY_BUDGET_ENABLED = True
+QUERY_BUDGET_RAISE = True
 
 # Since below these are test app settings, it should be safe to open-source it
 FACEBOOK_APPLICATION_ID = "1623549301266280"
@@ -42,6 +42,17 @@ REDIS_HOST = REDIS_PARAMS.hostname
 REDIS_PORT = REDIS_PARAMS.port
 REDIS_DB = 0
 REDIS_CONNECT_RETRY = True
+# Every process shares one blocking pool of at most REDIS_MAX_CONNECTIONS connections,
+# waiting up to REDIS_POOL_TIMEOUT seconds for a free one (see manage.py redis_pool_stats).
+# Short commands hold a connection for one round trip (the idempotency wait polls, it
+# does not hold one while sleeping), so this must cover the request threads of a process.
+REDIS_MAX_CONNECTIONS = 20
+# Commands that wait on the server get a pool of their own (RedisConnection.blocking_redis):
+# one connection per request thread waiting in events.trade_queue.submit_trade, plus one
+# each for the config invalidation listener and the SSE hub subscription.
+REDIS_BLOCKING_MAX_CONNECTIONS = REDIS_MAX_CONNECTIONS + 2
+REDIS_POOL_TIMEOUT = 5
+REDIS_POOL_STATS_INTERVAL = 60
 
 BROKER_URL = REDIS_BASE_URL + "/0"
 CELERY_RESULT_BACKEND = REDIS_BASE_URL + "/0"
@@ -62,6 +73,22 @@ CELERYBEAT_SCHEDULE = {
         'task': 'events.tasks.create_open_events_snapshot',
         'schedule': crontab(minute=11)
     },
+    'tick_price_changes': {
+        'task': 'events.tasks.tick_price_changes',
+        'schedule': timedelta(minutes=1)
+    },
+    'flush_market_trades': {
+        'task': 'events.tasks.flush_market_trades',
+        'schedule': timedelta(seconds=5)
+    },
+    'deliver_outbox': {
+        'task': 'events.tasks.deliver_outbox',
+        'schedule': timedelta(seconds=10)
+    },
+    'publish_ticker': {
+        'task': 'events.tasks.publish_ticker',
+        'schedule': timedelta(seconds=2)
+    },
     'create_hourly_accounts_snapshot': {
         'task': 'accounts.tasks.create_accounts_snapshot',
         'schedule': crontab(minute=31)
@@ -84,7 +111,115 @@ CELERYBEAT_SCHEDULE = {
     },
 }
 
-CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
+# How BetManager.buy_a_bet / sell_a_bet execute a trade:
+#   'orm'       - locks event, bet and user through the ORM and updates them one by one,
+#   'procedure' - a single call to the events_execute_trade PL/pgSQL function,
+#   'optimistic' - no row locks, versioned conditional updates retried on conflict,
+#   'redis'      - market state lives in Redis, trades are Lua scripts written behind to
+#                  Postgres by events.tasks.flush_market_trades. Users' cash is Redis' too:
+#                  change it only with UserProfile.topup_cash (the admin shows it read-only),
+#                  a total_cash written straight to Postgres is not seen by loaded users.
+TRADE_EXECUTION_MODE = os.environ.get('TRADE_EXECUTION_MODE', 'orm')
+TRADE_OPTIMISTIC_RETRIES = int(os.environ.get('TRADE_OPTIMISTIC_RETRIES', 3))
+MARKET_FLUSH_BATCH_SIZE = 500
+# seconds after which the flush lock of a dead flush expires; a flush must finish sooner
+MARKET_FLUSH_LOCK_TIMEOUT = 60
+
+# Trades on events marked as hot go through a per-shard queue with a single writer
+# (manage.py run_trade_queue --shard N, one process per shard).
+TRADE_QUEUE_SHARDS = 1
+TRADE_QUEUE_TIMEOUT = 10
+TRADE_QUEUE_BATCH_SIZE = 50
+
+# Realtime messages are saved to events.OutboxMessage with the trade and published after
+# the commit by manage.py run_outbox_publisher, with events.tasks.deliver_outbox sweeping
+# up behind it; the two take turns under a Redis lock so that broadcasts stay in order.
+# Failed messages are retried with backoff of up to OUTBOX_MAX_BACKOFF seconds.
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 0.2
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_MAX_BACKOFF = 300
+# a claimed batch must be sent within OUTBOX_LEASE seconds, or it is claimed again
+OUTBOX_LEASE = 30
+# Updates of one event channel are merged and broadcast at most once per OUTBOX_CHANNEL_WINDOW
+# seconds, with at most OUTBOX_GLOBAL_RATE broadcasts per second over all channels.
+OUTBOX_CHANNEL_WINDOW = 0.25
+OUTBOX_GLOBAL_RATE = 100
+
+# Publishing to PubNub goes through a pool of keep-alive connections, shared by the threads
+# of a process, pipelining up to PUBNUB_PIPELINE_DEPTH messages per round trip.
+PUBNUB_ORIGIN = 'pubsub.pubnub.com'
+PUBNUB_POOL_SIZE = 4
+PUBNUB_CONNECT_TIMEOUT = 2
+PUBNUB_READ_TIMEOUT = 5
+PUBNUB_PIPELINE_DEPTH = 50
+
+# Where realtime messages go: bladepolska.realtime.PubNubBackend (hosted) or
+# bladepolska.realtime.RedisBackend (Redis pub/sub, served to browsers by the SSE gateway
+# in politikon.sse; set REALTIME_SSE_URL to where it is reachable).
+REALTIME_BACKEND = os.environ.get('REALTIME_BACKEND', 'bladepolska.realtime.PubNubBackend')
+REALTIME_REDIS_PREFIX = 'realtime:'
+REALTIME_SSE_URL = os.environ.get('REALTIME_SSE_URL')
+SSE_HEARTBEAT = 15
+SSE_RETRY_MS = 3000
+SSE_QUEUE_SIZE = 100
+SSE_MAX_CHANNELS = 20
+
+# /api/ tokens (accounts:api_token) are valid for API_TOKEN_MAX_AGE seconds.
+API_TOKEN_MAX_AGE = 30 * 24 * 60 * 60
+API_EVENTS_LIMIT = 100
+
+# Most orders accepted by a single events:create_transactions batch.
+TRADE_BATCH_MAX_ORDERS = 50
+
+# Quotes (events:event_quote) are computed from event state cached for this many seconds.
+QUOTE_CACHE_TIMEOUT = 2
+QUOTE_MAX_SHARES = 100
+
+# Responses of views decorated with bladepolska.idempotency.idempotent are kept per
+# Idempotency-Key header for IDEMPOTENCY_KEY_TIMEOUT seconds. A repeated request waits
+# up to IDEMPOTENCY_WAIT_TIMEOUT seconds for the one in flight.
+IDEMPOTENCY_KEY_TIMEOUT = 24 * 60 * 60
+IDEMPOTENCY_WAIT_TIMEOUT = 10
+IDEMPOTENCY_IN_FLIGHT_TIMEOUT = 30
+
+# bladepolska.middleware.SamplingProfilerMiddleware samples the stacks of this fraction of
+# requests (and of requests with an X-Profile header set to PROFILER_SECRET) every
+# PROFILER_INTERVAL seconds. Without a secret the header is ignored.
+# Collapsed stacks for flamegraph.pl are served to staff at admin/profiler/stacks/.
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+PROFILER_SECRET = os.environ.get('PROFILER_SECRET')
+PROFILER_INTERVAL = 0.005
+PROFILER_FLUSH_INTERVAL = 10
+
+# Pages of events.page_cache.anonymous_page_cache views are cached for anonymous visitors
+# until the next trade or admin edit of an event, and for at most PAGE_CACHE_TIMEOUT seconds.
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_ALIAS = 'default'
+PAGE_CACHE_TIMEOUT = 30
+
+# Users' positions for the event cards (events.positions) are kept in Redis hashes, updated
+# by every trade and rebuilt from the database on a miss, or at the latest after POSITIONS_TIMEOUT.
+POSITIONS_TIMEOUT = 24 * 60 * 60
+# Friends holding shares of an event are found by intersecting per event holder sets, kept up
+# to date by every trade, with a Redis copy of the user's friends kept this long.
+FRIENDS_CACHE_TIMEOUT = 60 * 60
+
+# Event cards of the render_events and render_featured_events tags are cached per event,
+# price and bet state; FRAGMENT_CACHE_TIMEOUT bounds how long a config change takes to show.
+FRAGMENT_CACHE_ALIAS = 'default'
+FRAGMENT_CACHE_TIMEOUT = 10 * 60
+
+# Views decorated with bladepolska.query_budget.query_budget count their queries when
+# QUERY_BUDGET_ENABLED; going over the budget is logged, or raised with QUERY_BUDGET_RAISE.
+# Both are on in devsettings only, counting keeps every query of a request in memory.
+QUERY_BUDGET_ENABLED = False
+QUERY_BUDGET_RAISE = False
+
+# The database backend, with all values kept in memory for CONSTANCE_CACHE_TIMEOUT seconds
+# or until a value is changed in any process.
+CONSTANCE_BACKEND = 'bladepolska.config_backend.CachedDatabaseBackend'
+CONSTANCE_CACHE_TIMEOUT = 30
 # CONSTANCE_DATABASE_CACHE_BACKEND = 'default' # prior to changes in django-constances
 
 CONSTANCE_CONFIG = {
@@ -160,6 +295,7 @@ TEMPLATES = [
                 'django.template.context_processors.tz',
                 'social.apps.django_app.context_processors.backends',
                 'social.apps.django_app.context_processors.login_redirect',
+                'bladepolska.context_processors.realtime',
             ],
         },
     },
@@ -200,6 +336,8 @@ SOCIAL_AUTH_FACEBOOK_PROFILE_EXTRA_PARAMS = {
 }
 
 MIDDLEWARE_CLASSES = (
+    # first, so that the whole request is sampled
+    'bladepolska.middleware.SamplingProfilerMiddleware',
     # forcing one hostname on production
     'politikon.modules.HostnameRedirectMiddleware',
     # forcing SSL using https://github.com/rdegges/django-sslify. This need to be the first middleware
@@ -207,12 +345,14 @@ MIDDLEWARE_CLASSES = (
     # adding basic auth
     'politikon.modules.BasicAuthMiddleware',
 
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # /api/ requests skip sessions, CSRF and messages and are authenticated by a signed token
+    'bladepolska.middleware.SessionMiddlewareOmitApi',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'bladepolska.middleware.CsrfViewMiddlewareOmitApi',
+    'bladepolska.middleware.TokenAuthenticationMiddleware',
+    'bladepolska.middleware.AuthenticationMiddlewareOmitApi',
+    'bladepolska.middleware.SessionAuthenticationMiddlewareOmitApi',
+    'bladepolska.middleware.MessageMiddlewareOmitApi',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
 )
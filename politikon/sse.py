@@ -0,0 +1,109 @@
+"""
+Server-Sent Events gateway for the self-hosted realtime backend
+(bladepolska.realtime.RedisBackend).
+
+Every open stream is a greenlet waiting on its queue, and each process keeps a single
+Redis subscription, so one process holds tens of thousands of idle connections:
+
+    gunicorn -k gevent --worker-connections 20000 politikon.sse:application
+
+GET /?channel=event_1&channel=event_2 streams everything published to those channels.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from collections import defaultdict
+from urlparse import parse_qs
+
+import gevent
+from gevent.queue import Queue, Empty, Full
+import redis
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "politikon.settings")
+
+from django.conf import settings
+
+from bladepolska.redis_connection import RedisConnection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Hub(object):
+    """ Fans the messages of the process' Redis subscription out to the open streams. """
+
+    def __init__(self):
+        self.streams = defaultdict(set)
+        self.listener = None
+
+    def subscribe(self, channels, queue):
+        for channel in channels:
+            self.streams[channel].add(queue)
+
+        if self.listener is None or self.listener.dead:
+            self.listener = gevent.spawn(self.listen)
+
+    def unsubscribe(self, channels, queue):
+        for channel in channels:
+            self.streams[channel].discard(queue)
+            if not self.streams[channel]:
+                del self.streams[channel]
+
+    def dispatch(self, channel, data):
+        for queue in list(self.streams.get(channel, ())):
+            try:
+                queue.put_nowait(data)
+            except Full:
+                # a stream that cannot keep up skips states, the next message supersedes them
+                pass
+
+    def listen(self):
+        prefix = settings.REALTIME_REDIS_PREFIX
+        while True:
+            try:
+                pubsub = RedisConnection.blocking_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(prefix + '*')
+                for message in pubsub.listen():
+                    self.dispatch(message['channel'][len(prefix):], message['data'])
+            except redis.ConnectionError:
+                logger.warning("Lost the realtime subscription, reconnecting")
+                gevent.sleep(1)
+
+
+hub = Hub()
+
+
+def stream(channels):
+    queue = Queue(maxsize=settings.SSE_QUEUE_SIZE)
+    hub.subscribe(channels, queue)
+    try:
+        yield 'retry: %d\n\n' % settings.SSE_RETRY_MS
+        while True:
+            try:
+                yield 'data: %s\n\n' % queue.get(timeout=settings.SSE_HEARTBEAT)
+            except Empty:
+                # keeps proxies from closing an idle connection
+                yield ':\n\n'
+    finally:
+        hub.unsubscribe(channels, queue)
+
+
+def application(environ, start_response):
+    if environ['REQUEST_METHOD'] != 'GET':
+        start_response('405 Method Not Allowed', [('Allow', 'GET')])
+        return []
+
+    channels = [channel for channel in parse_qs(environ.get('QUERY_STRING', '')).get('channel', []) if channel]
+    channels = channels[:settings.SSE_MAX_CHANNELS]
+    if not channels:
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return ['channel is required']
+
+    start_response('200 OK', [
+        ('Content-Type', 'text/event-stream'),
+        ('Cache-Control', 'no-cache'),
+        ('X-Accel-Buffering', 'no'),
+        ('Access-Control-Allow-Origin', '*'),
+    ])
+    return stream(channels)
@@ -2,7 +2,7 @@ from django.conf import settings
 from django.conf.urls import patterns, include, url
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
-from .views import HomeView
+from .views import HomeView, profiler_stacks
 
 from django.contrib import admin
 admin.autodiscover()
@@ -10,6 +10,7 @@ admin.autodiscover()
 
 urlpatterns = patterns('',
     #   Admin url patterns
+    url(r'^admin/profiler/stacks/$', profiler_stacks, name='profiler_stacks'),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^grappelli/', include('grappelli.urls')),
 
@@ -17,6 +18,9 @@ urlpatterns = patterns('',
     url('', include('social.apps.django_app.urls', namespace='social')),
     url(r'^accounts/', include('accounts.urls', namespace='accounts')),
 
+    #   Lean API for bots and mobile clients, see bladepolska.middleware.TokenAuthenticationMiddleware
+    url(r'^api/', include('events.api_urls', namespace='api')),
+
     #   Application url patterns
     url(r'^', include('events.urls', namespace='events')),
 
@@ -1,10 +1,18 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
+from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView
 
 from accounts.models import UserProfile
+from bladepolska.profiling import Profiler, collapsed_stacks, reset_stacks
+from bladepolska.query_budget import query_budget
 from events.models import Event
+from events.page_cache import anonymous_page_cache
 from events.views import create_bets_dict
 
 
+@anonymous_page_cache
+@query_budget(queries=25, duplicates=3)
 class HomeView(TemplateView):
     template_name = 'home.html'
 
@@ -25,3 +33,18 @@ class HomeView(TemplateView):
             'users': UserProfile.objects.filter(is_active=True, is_deleted=False)[:30],
         })
         return context
+
+
+@staff_member_required
+@require_http_methods(["GET", "POST"])
+def profiler_stacks(request):
+    """
+    Stacks sampled by bladepolska.middleware.SamplingProfilerMiddleware in all processes,
+    in collapsed-stack format: `curl ... | flamegraph.pl > requests.svg`. POST clears them.
+    """
+    if request.method == 'POST':
+        reset_stacks()
+        return HttpResponse(status=204)
+
+    Profiler.flush(force=True)
+    return HttpResponse(collapsed_stacks(), content_type='text/plain')
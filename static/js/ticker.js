@@ -0,0 +1,66 @@
+// Ticker: prices of all open events on one channel, as deltas on top of a snapshot.
+// See events/ticker.py for the message format.
+function startTicker(snapshotUrl, sseUrl, pubnubSubscribeKey) {
+    var prices = null;
+    var seq = 0;
+    var loading = false;
+
+    function render(eventId) {
+        var p = prices[eventId];
+        $('.a_bet[data-event_id="' + eventId + '"]').each(function() {
+            var buy = String($(this).data('buy')) == 'True';
+            var yes = $(this).data('outcome') == 'YES';
+            var price = buy ? (yes ? p[0] : p[1]) : (yes ? p[2] : p[3]);
+            $(this).data('price', price).attr('data-price', price);
+            $(this).find('.value').text(price);
+        });
+    }
+
+    function loadSnapshot() {
+        loading = true;
+        $.getJSON(snapshotUrl, function(data) {
+            prices = data.events;
+            seq = data.seq;
+            loading = false;
+            for (var eventId in prices) {
+                render(eventId);
+            }
+        });
+    }
+
+    function onMessage(message) {
+        if (prices === null || loading || message.seq <= seq) {
+            return;
+        }
+        if (message.seq != seq + 1) {
+            loadSnapshot();
+            return;
+        }
+        seq = message.seq;
+        for (var eventId in message.d) {
+            var p = prices[eventId] || [0, 0, 0, 0];
+            for (var i = 0; i < 4; i++) {
+                p[i] += message.d[eventId][i];
+            }
+            prices[eventId] = p;
+            render(eventId);
+        }
+        $.each(message.x || [], function(i, eventId) {
+            delete prices[eventId];
+        });
+    }
+
+    if (sseUrl) {
+        var source = new EventSource(sseUrl + '?channel=ticker');
+        source.onmessage = function(e) {
+            onMessage(JSON.parse(e.data));
+        };
+    } else {
+        PUBNUB.init({subscribe_key: pubnubSubscribeKey}).subscribe({
+            channel: 'ticker',
+            restore: false,
+            callback: onMessage
+        });
+    }
+    loadSnapshot();
+}